@@ -0,0 +1,278 @@
+import os
+import sys
+import shutil
+import timeit
+import tempfile
+import numpy as np
+from scipy.sparse import random as sparse_random
+from cylinder import CyDet, TrackCenters
+from tracking import Hough, HoughScan
+from cache import DiskCache
+from hits import BackgroundHits
+from metrics import roc_auc
+from legacy import legacy_point_neighbours, \
+    legacy_wire_track_correspondence, legacy_prepare_hough, GeometryOnly
+
+"""
+Timing of the geometry and tracking builders.  Run as
+
+    python benchmarks.py [name ...]
+
+to run the named benchmarks, or all of them if none are given.  The
+reference implementations of replaced builders are taken from legacy.py,
+so that the speed-up can be measured.
+"""
+
+
+def _best_time(statement, repeat=3):
+    """
+    Returns the best wall time in seconds of calling statement repeat times
+    """
+    return min(timeit.repeat(statement, number=1, repeat=repeat))
+
+
+def bench_neighbours(rho_bins=120, arc_res=4.):
+    """
+    Compares the array based neighbour builder against the legacy one for
+    the CyDet geometry and a fine TrackCenters geometry
+    """
+    geometries = [("CyDet", CyDet()),
+                  ("TrackCenters(rho_bins={}, arc_res={})".format(rho_bins,
+                                                                  arc_res),
+                   TrackCenters(rho_bins=rho_bins, arc_res=arc_res))]
+    for name, geom in geometries:
+        new = _best_time(geom._prepare_point_neighbours)
+        old = _best_time(lambda: legacy_point_neighbours(geom), repeat=1)
+        print("{:<40} {:>7} points  legacy {:8.4f} s  new {:8.4f} s  "
+              "x{:.0f}".format(name, geom.n_points, old, new, old / new))
+
+
+def bench_construction():
+    """
+    Times the construction of the CyDet and of fine TrackCenters geometries
+    """
+    print("{:<40} {:8.4f} s".format("CyDet", _best_time(CyDet)))
+    for rho_bins in [20, 100, 200]:
+        name = "TrackCenters(rho_bins={})".format(rho_bins)
+        timing = _best_time(lambda: TrackCenters(rho_bins=rho_bins))
+        print("{:<40} {:8.4f} s".format(name, timing))
+
+
+def bench_hough(rho_bins=4):
+    """
+    Times the construction of the Hough transform with default settings, and
+    compares the correspondence builder with the legacy one for a coarse
+    track center geometry
+    """
+    hits = GeometryOnly(CyDet())
+    print("{:<40} {:8.4f} s".format("Hough()",
+                                    _best_time(lambda: Hough(hits))))
+    hough = Hough(hits, rho_bins=rho_bins)
+    new = _best_time(hough._prepare_wire_track_correspondence)
+    old = _best_time(lambda: legacy_wire_track_correspondence(hough), repeat=1)
+    print("{:<40} legacy {:8.4f} s  new {:8.4f} s  x{:.0f}".format(
+        "Hough(rho_bins={}) correspondence".format(rho_bins), old, new,
+        old / new))
+
+
+def bench_hough_scaling(rho_bins_list=(10, 20, 50, 100),
+                        arc_res_list=(0, 1., 0.5)):
+    """
+    Times the construction of the Hough transform against the number of
+    radial layers and the arc length between track centers, comparing the
+    memory of the correspondence with that of the dense distance matrix it
+    used to be selected from
+    """
+    hits = GeometryOnly(CyDet())
+    print("{:>8} {:>8} {:>9} {:>10} {:>9} {:>11} {:>11}".format(
+        "rho_bins", "arc_res", "centers", "non-zeros", "time s", "sparse MB",
+        "dense MB"))
+    for rho_bins in rho_bins_list:
+        for arc_res in arc_res_list:
+            timing = _best_time(lambda: Hough(hits, rho_bins=rho_bins,
+                                              arc_res=arc_res), repeat=1)
+            hough = Hough(hits, rho_bins=rho_bins, arc_res=arc_res)
+            corsp = hough.correspondence
+            sparse_mb = (corsp.data.nbytes + corsp.indices.nbytes +
+                         corsp.indptr.nbytes) / 1e6
+            dense_mb = 8. * hits.cydet.n_points * hough.track.n_points / 1e6
+            print("{:>8} {:>8} {:>9} {:>10} {:>9.3f} {:>11.1f} {:>11.1f}"
+                  .format(rho_bins, arc_res, hough.track.n_points, corsp.nnz,
+                          timing, sparse_mb, dense_mb))
+
+
+def bench_hough_batch(occupancy=0.12, n_events=2000, chunk_size=500):
+    """
+    Times the batched Hough transform of random events, see
+    Hough.get_track_scores
+    """
+    hits = GeometryOnly(CyDet())
+    hough = Hough(hits)
+    hough.get_normalized_correspondence()
+    weights = sparse_random(n_events, hits.cydet.n_points, density=occupancy,
+                            format='csr', random_state=np.random.RandomState(0))
+    for size in [None, chunk_size]:
+        timing = _best_time(lambda: hough.get_track_scores(
+            weights, chunk_size=size))
+        print("{:<40} {:8.6f} s per event".format(
+            "Hough scores, chunks of {}".format(size or n_events),
+            timing / n_events))
+
+
+def bench_top_tracks(n_events=10000, occupancy=0.12, k_list=(1, 5)):
+    """
+    Times finding the best track centers of random events, see
+    Hough.get_top_tracks
+    """
+    hits = GeometryOnly(CyDet())
+    hough = Hough(hits)
+    weights = sparse_random(n_events, hits.cydet.n_points, density=occupancy,
+                            format='csr', random_state=np.random.RandomState(0))
+    scores = hough.get_track_scores(weights)
+    for k in k_list:
+        timing = _best_time(lambda: hough.get_top_tracks(scores, k=k))
+        print("{:<40} {:8.4f} s".format(
+            "Top {} tracks of {} events".format(k, n_events), timing))
+
+
+def bench_even_odd(n_events=2000, occupancy=0.12, chunk_size=250):
+    """
+    Times the even and odd Hough transforms of random events against the
+    notebook, see Hough.get_even_odd_predictions
+    """
+    hits = GeometryOnly(CyDet())
+    hough = Hough(hits)
+    weights = sparse_random(n_events, hits.cydet.n_points, density=occupancy,
+                            format='csr', random_state=np.random.RandomState(0))
+    hough.get_even_odd_correspondence()
+    hough.get_even_odd_correspondence(None)
+    dense = weights.toarray()
+    timings = [
+        ("Notebook prepare_hough",
+         _best_time(lambda: legacy_prepare_hough(hough, dense))),
+        ("Fused even/odd Hough",
+         _best_time(lambda: hough.get_even_odd_predictions(weights))),
+        ("Fused even/odd Hough, chunks of {}".format(chunk_size),
+         _best_time(lambda: hough.get_even_odd_predictions(
+             weights, chunk_size=chunk_size)))]
+    for name, timing in timings:
+        print("{:<40} {:8.6f} s per event".format(name, timing / n_events))
+
+
+def bench_alpha_scan(n_events=500, occupancy=0.12, n_alphas=20):
+    """
+    Times a scan of the reweighting exponent against evaluating each alpha
+    on its own, see Hough.scan_alphas
+    """
+    hits = GeometryOnly(CyDet())
+    hough = Hough(hits)
+    random = np.random.RandomState(0)
+    weights = sparse_random(n_events, hits.cydet.n_points, density=occupancy,
+                            format='csr', random_state=random)
+    labels = random.randint(0, 2, size=weights.nnz)
+    alphas = np.linspace(9., 13., n_alphas)
+    rows = np.repeat(np.arange(n_events), np.diff(weights.indptr))
+
+    def evaluate(alpha):
+        even, odd, _, _ = hough.get_even_odd_predictions(weights, alpha)
+        preds = even / even.max() + odd / odd.max()
+        return roc_auc(labels, preds[rows, weights.indices])
+
+    hough.get_even_odd_correspondence()
+    hough.get_even_odd_correspondence(None)
+    timings = [("One alpha", _best_time(lambda: evaluate(alphas[0]))),
+               ("Scan of {} alphas".format(n_alphas),
+                _best_time(lambda: hough.scan_alphas(weights, labels,
+                                                     alphas)))]
+    for name, timing in timings:
+        print("{:<40} {:8.6f} s per event".format(name, timing / n_events))
+
+
+def bench_hough_scan(rho_bins=20):
+    """
+    Times building the Hough transforms of a grid of signal track settings,
+    one at a time and with HoughScan
+    """
+    hits = GeometryOnly(CyDet())
+    settings = [dict(sig_rho=sig_rho, sig_rho_min=sig_rho_min,
+                     sig_rho_max=sig_rho_max, sig_rho_sgma=sig_rho_sgma)
+                for sig_rho_max in [34.5, 35.]
+                for sig_rho_min in [28., 30., 31.5]
+                for sig_rho in [33., 34.]
+                for sig_rho_sgma in [1.5, 2., 3.]]
+
+    def rebuild():
+        for setting in settings:
+            Hough(hits, rho_bins=rho_bins, **setting)
+
+    def scan():
+        for _ in HoughScan(hits, rho_bins=rho_bins).iter_houghs(settings):
+            pass
+
+    for name, build in [("Hough of each setting", rebuild),
+                        ("HoughScan", scan)]:
+        print("{:<40} {:8.4f} s per setting".format(
+            name, _best_time(build) / len(settings)))
+
+
+def bench_cache():
+    """
+    Times building the CyDet and a Hough transform with an empty cache, and
+    loading them back from it
+    """
+    path = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(path)
+
+        def build():
+            Hough(GeometryOnly(CyDet(cache=cache)), cache=cache)
+        cold = _best_time(build, repeat=1)
+        warm = _best_time(build)
+        print("{:<40} cold {:8.4f} s  warm {:8.4f} s".format(
+            "CyDet() + Hough()", cold, warm))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_resample(path="../data/proton_from_muon_capture_bg.root",
+                   occupancy=0.10, n_samples=100):
+    """
+    Times generating background events by resampling, see
+    BackgroundHits._draw_sample
+    """
+    if not os.path.exists(path):
+        print("No background data at {}, skipping".format(path))
+        return
+    cydet = CyDet()
+    n_hits = int(round(occupancy * cydet.n_points))
+    background = BackgroundHits(cydet, path=path, hits=n_hits)
+
+    def draw():
+        for event_id in range(n_samples):
+            background._draw_sample(event_id, n_hits)
+    print("{:<40} {:8.6f} s per event".format(
+        "BackgroundHits {:.0%} occupancy".format(occupancy),
+        _best_time(draw) / n_samples))
+
+
+BENCHMARKS = {"cache": bench_cache,
+              "neighbours": bench_neighbours,
+              "construction": bench_construction,
+              "hough": bench_hough,
+              "hough_scaling": bench_hough_scaling,
+              "hough_batch": bench_hough_batch,
+              "top_tracks": bench_top_tracks,
+              "even_odd": bench_even_odd,
+              "alpha_scan": bench_alpha_scan,
+              "hough_scan": bench_hough_scan,
+              "resample": bench_resample}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        print("== {}".format(name))
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,344 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix
+
+"""
+Content addressed cache of built arrays on disk.  Each entry is a directory
+named by the hash of its key, holding one .npy file per array so that they
+can be memory mapped on load.  Sparse matrices are stored as their
+data/indices/indptr/shape arrays, see pack_sparse and unpack_sparse.
+
+LRUCache keeps dicts of arrays in memory instead, for values that are
+cheap enough to rebuild but requested many times in a row.
+"""
+
+
+def code_version(*objects):
+    """
+    Returns a hash of the source files defining the given modules, classes
+    or functions, so that cache entries are invalidated when the code that
+    built them changes
+
+    :return: hexadecimal string
+    """
+    digest = hashlib.sha1()
+    for obj in objects:
+        with open(inspect.getsourcefile(obj), 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def file_version(path):
+    """
+    Returns a hash of the names, sizes and modification times of a file, or of
+    all the files of a directory, so that keys made from it change when the
+    data is rewritten, without reading the data
+
+    :return: hexadecimal string
+    """
+    path = os.path.abspath(path)
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, file_name)
+                       for root, _, file_names in os.walk(path)
+                       for file_name in file_names)
+    digest = hashlib.sha1()
+    for file_path in paths:
+        stat = os.stat(file_path)
+        digest.update(u"{}:{}:{}\n".format(
+            os.path.relpath(file_path, path), stat.st_size,
+            int(stat.st_mtime * 1e6)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _to_json(value):
+    """
+    Converts numpy values in a key to their python equivalents
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot hash {!r} in a cache key".format(value))
+
+
+def hash_key(*parts):
+    """
+    Returns a hash of the parts of a key, which may be nested lists, dicts,
+    strings and numbers, including numpy arrays and scalars
+
+    :return: hexadecimal string
+    """
+    text = json.dumps(parts, sort_keys=True, default=_to_json)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def pack_sparse(name, matrix):
+    """
+    Returns the arrays defining a sparse matrix, named after name
+
+    :return: dict of numpy.arrays
+    """
+    matrix = csr_matrix(matrix)
+    return {name + '.data': matrix.data,
+            name + '.indices': matrix.indices,
+            name + '.indptr': matrix.indptr,
+            name + '.shape': np.asarray(matrix.shape)}
+
+
+def unpack_sparse(arrays, name):
+    """
+    Rebuilds the sparse matrix named name from the arrays made by
+    pack_sparse, without copying them
+
+    :return: scipy.sparse.csr_matrix
+    """
+    return csr_matrix((arrays[name + '.data'], arrays[name + '.indices'],
+                       arrays[name + '.indptr']),
+                      shape=tuple(arrays[name + '.shape']), copy=False)
+
+
+class DiskCache(object):
+    # pylint: disable=bad-continuation
+    def __init__(self, path="../cache", max_bytes=2 * 1024 ** 3):
+        """
+        Stores dicts of numpy arrays on disk, keyed by the hash of their key.
+        Loaded arrays are memory mapped copy-on-write, so they may be
+        modified in memory without changing the cache.  When the cache grows
+        beyond max_bytes, the least recently used entries are removed.
+
+        :param path: directory of the cache
+        :param max_bytes: maximal total size of the stored arrays
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def load(self, key):
+        """
+        Returns the arrays stored under key, or None if there are none
+
+        :return: dict of memory mapped numpy.arrays
+        """
+        entry = self._entry_path(key)
+        if not os.path.isdir(entry):
+            return None
+        arrays = {}
+        for file_name in os.listdir(entry):
+            if file_name.endswith('.npy'):
+                arrays[file_name[:-4]] = np.load(os.path.join(entry, file_name),
+                                                 mmap_mode='c')
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        Stores the dict of numpy.arrays under key, then removes least recently
+        used entries if the cache is too large
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Write next to the entry first, so that a partial entry is never seen
+        tmp_entry = tempfile.mkdtemp(dir=self.path, prefix='.tmp')
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_entry, name + '.npy'), np.asarray(array))
+        entry = self._entry_path(key)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp_entry, entry)
+        self.evict()
+
+    def fetch(self, key, builder):
+        """
+        Returns the arrays stored under key, calling builder to make and store
+        them if there are none
+
+        :param builder: function with no arguments returning a dict of
+                        numpy.arrays
+        :return: dict of numpy.arrays
+        """
+        arrays = self.load(key)
+        if arrays is None:
+            self.save(key, builder())
+            arrays = self.load(key)
+        return arrays
+
+    def _entry_sizes(self):
+        """
+        Returns the stored entries with their last use and size in bytes,
+        least recently used first
+
+        :return: list of (last_use, size, key)
+        """
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for key in os.listdir(self.path):
+            entry = self._entry_path(key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, file_name))
+                       for file_name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, key))
+        return sorted(entries)
+
+    @property
+    def size(self):
+        """
+        Total size of the stored arrays in bytes
+        """
+        return sum(size for _, size, _ in self._entry_sizes())
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes,
+        always keeping the most recent one
+        """
+        entries = self._entry_sizes()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_path(key))
+            total -= size
+
+    def clear(self):
+        """
+        Removes all entries
+        """
+        for _, _, key in self._entry_sizes():
+            shutil.rmtree(self._entry_path(key))
+
+
+def _entry_nbytes(arrays):
+    """
+    Returns the total size of a dict of numpy.arrays in bytes
+    """
+    return sum(array.nbytes for array in arrays.values())
+
+
+class LRUCache(object):
+    # pylint: disable=bad-continuation
+    def __init__(self, max_entries=None, max_bytes=None):
+        """
+        Stores dicts of numpy arrays in memory, keyed by any hashable key.
+        Stored arrays are made read only, so that callers cannot modify the
+        cached values.  When the cache holds more than max_entries entries or
+        max_bytes bytes, the least recently used entries are removed.  The
+        numbers of hits and misses are counted for tuning the limits.
+
+        :param max_entries: maximal number of entries, unbounded if None
+        :param max_bytes: maximal total size of the stored arrays, unbounded
+                          if None
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def load(self, key):
+        """
+        Returns the arrays stored under key, or None if there are none
+
+        :return: dict of read only numpy.arrays
+        """
+        arrays = self.entries.pop(key, None)
+        if arrays is None:
+            return None
+        # Mark the entry as recently used
+        self.entries[key] = arrays
+        return arrays
+
+    def save(self, key, arrays, copy=True):
+        """
+        Stores the dict of numpy.arrays under key, then removes least recently
+        used entries if the cache is too large
+
+        :param copy: if true, writeable arrays are copied, so that the caller
+                     keeps its arrays writeable and cannot modify the stored
+                     ones.  Otherwise the cache takes ownership of the arrays,
+                     which are made read only in place.
+        :return: dict of read only numpy.arrays as stored
+        """
+        stored = {}
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if array.flags.writeable:
+                if copy:
+                    array = array.copy()
+                array.setflags(write=False)
+            stored[name] = array
+        self.discard(key)
+        self.entries[key] = stored
+        self.nbytes += _entry_nbytes(stored)
+        self.evict()
+        return stored
+
+    def fetch(self, key, builder):
+        """
+        Returns the arrays stored under key, calling builder to make and store
+        them if there are none
+
+        :param builder: function with no arguments returning a dict of
+                        numpy.arrays, which the cache takes ownership of
+        :return: dict of read only numpy.arrays
+        """
+        arrays = self.load(key)
+        if arrays is not None:
+            self.hits += 1
+            return arrays
+        self.misses += 1
+        return self.save(key, builder(), copy=False)
+
+    def discard(self, key):
+        """
+        Removes the entry stored under key, if any
+        """
+        arrays = self.entries.pop(key, None)
+        if arrays is not None:
+            self.nbytes -= _entry_nbytes(arrays)
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in its
+        limits, always keeping the most recent one
+        """
+        while len(self.entries) > 1 and \
+                ((self.max_entries is not None and
+                  len(self.entries) > self.max_entries) or
+                 (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            self.discard(next(iter(self.entries)))
+
+    def clear(self):
+        """
+        Removes all entries, keeping the statistics
+        """
+        self.entries.clear()
+        self.nbytes = 0
+
+    @property
+    def stats(self):
+        """
+        Numbers of hits, misses and entries, and size of the entries in bytes
+
+        :return: dict
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self.entries), "bytes": self.nbytes}
@@ -0,0 +1,192 @@
+import numpy as np
+from sklearn.ensemble import GradientBoostingClassifier
+from events import HitMatrix
+from features import FEATURES, FeaturePlan
+
+"""
+Two stage classifier of the hit wires, as in LocalBasedFiltering.ipynb.  The
+first stage scores each hit from its own wire features.  The second stage
+adds the sum of the first stage scores over the neighbours of each hit,
+sig_like_neigh and sig_like_lr, to all the wire features.
+
+Only the hit wires are scored, and the first stage scores are summed over the
+neighbours as sparse vectors of the events, so that the cost scales with the
+number of hits rather than with n_events * n_wires.
+"""
+
+# Features of the first stage
+WIRE_FEATURES = ["deposit", "rel_time", "layer_id"]
+# Features made from the first stage scores
+SIG_LIKE_FEATURES = ["sig_like_lr", "sig_like_neigh"]
+
+
+class WireClassifier(object):
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, wire_features=None, features=None, wire_estimator=None,
+                 estimator=None):
+        """
+        Two stage classifier of the hit wires, with the labels of
+        features.FEATURES, i.e. 1 for signal hits and 0 for background hits
+
+        :param wire_features: features of the first stage, WIRE_FEATURES by
+                              default
+        :param features: features of the second stage, besides
+                         SIG_LIKE_FEATURES, all of features.FEATURES but the
+                         labels by default
+        :param wire_estimator: classifier of the first stage with the fit and
+                               predict_proba methods of scikit-learn, a
+                               GradientBoostingClassifier of 10 trees by
+                               default
+        :param estimator: classifier of the second stage, a
+                          GradientBoostingClassifier of 100 trees by default
+        """
+        if wire_features is None:
+            wire_features = WIRE_FEATURES
+        if features is None:
+            features = [name for name in FEATURES if name != "labels"]
+        if wire_estimator is None:
+            wire_estimator = GradientBoostingClassifier(n_estimators=10)
+        if estimator is None:
+            estimator = GradientBoostingClassifier(n_estimators=100)
+        self.wire_features = list(wire_features)
+        self.features = list(features)
+        self.wire_estimator = wire_estimator
+        self.estimator = estimator
+        # Features of the hits, computed once for both stages
+        self.base_names = self.features + [name for name in self.wire_features
+                                           if name not in self.features]
+        self._base_plan = FeaturePlan(self.base_names)
+        self._label_plan = FeaturePlan(self.base_names + ["labels"])
+        self._sig_like_plan = FeaturePlan(SIG_LIKE_FEATURES,
+                                          provided=["wire_prob"])
+        self._wire_columns = [self.base_names.index(name)
+                              for name in self.wire_features]
+        self._columns = [self.base_names.index(name) for name in self.features]
+
+    def _get_batch(self, hits, event_ids, with_labels=False):
+        """
+        Returns the HitMatrix of a batch of events and the features of its
+        hits, see base_names
+
+        :param with_labels: if true, the labels are the last column
+        :return: tuple of events.HitMatrix and numpy.array of shape
+                 [n_hits, len(base_names) + with_labels]
+        """
+        plan = self._label_plan if with_labels else self._base_plan
+        hit_matrix = hits.get_hit_matrix(
+            event_ids, plan.get_measurements(hits.measurements))
+        return hit_matrix, plan.compute(hit_matrix, hits.cydet)
+
+    def _get_features(self, hits, event_ids, batch_size, with_labels=False):
+        """
+        Returns the features of the hits of the events, batch by batch
+
+        :return: generator of tuples of events.HitMatrix and numpy.array, see
+                 _get_batch
+        """
+        event_ids = np.asarray(event_ids, dtype=int)
+        for start in range(0, len(event_ids), batch_size):
+            yield self._get_batch(hits, event_ids[start:start + batch_size],
+                                  with_labels)
+
+    def _get_stage_features(self, hit_matrix, cydet, base, wire_probs):
+        """
+        Returns the features of the second stage of the hits of a HitMatrix,
+        summing the first stage scores over the neighbours of the hits in one
+        sparse product
+
+        :param base: numpy.array of the features of the hits, see base_names
+        :param wire_probs: numpy.array of the first stage scores of the hits
+        :return: numpy.array of shape [n_hits, len(features) + 2]
+        """
+        sig_like = self._sig_like_plan.compute(hit_matrix, cydet,
+                                               {"wire_prob": wire_probs})
+        return np.column_stack([base[:, self._columns], sig_like])
+
+    def _get_wire_probs(self, base):
+        """
+        Returns the first stage scores of hits from their features, see
+        base_names
+
+        :return: numpy.array of shape [n_hits]
+        """
+        if len(base) == 0:
+            return np.zeros(0)
+        return self.wire_estimator.predict_proba(
+            base[:, self._wire_columns])[:, 1]
+
+    def fit(self, hits, wire_event_ids, event_ids, batch_size=100):
+        """
+        Trains the first stage on the hits of some events, then the second
+        stage on the hits of other events, as in the notebook
+
+        :param hits: SignalHits or ResampledHits
+        :param wire_event_ids: event_ids of the training events of the first
+                               stage
+        :param event_ids: event_ids of the training events of the second stage
+        :param batch_size: number of events read at once
+        :return: self
+        """
+        data = np.concatenate([features for _, features in self._get_features(
+            hits, wire_event_ids, batch_size, with_labels=True)])
+        self.wire_estimator.fit(data[:, self._wire_columns], data[:, -1])
+        stage_data, labels = [], []
+        for hit_matrix, features in self._get_features(
+                hits, event_ids, batch_size, with_labels=True):
+            base = features[:, :-1]
+            stage_data.append(self._get_stage_features(
+                hit_matrix, hits.cydet, base, self._get_wire_probs(base)))
+            labels.append(features[:, -1])
+        self.estimator.fit(np.concatenate(stage_data), np.concatenate(labels))
+        return self
+
+    def predict_hit_matrix(self, hit_matrix, cydet):
+        """
+        Scores the hits of a HitMatrix, which must hold the measurements of the
+        features, see get_measurements
+
+        :return: tuple of numpy.arrays of shape [n_hits], of the first and of
+                 the second stage scores
+        """
+        base = self._base_plan.compute(hit_matrix, cydet)
+        wire_probs = self._get_wire_probs(base)
+        if len(base) == 0:
+            return wire_probs, np.zeros(0)
+        probs = self.estimator.predict_proba(self._get_stage_features(
+            hit_matrix, cydet, base, wire_probs))[:, 1]
+        return wire_probs, probs
+
+    def get_measurements(self, available):
+        """
+        Returns the measurements of the hits read by the classifier
+
+        :param available: names of the measurements available
+        :return: list of names of measurements
+        """
+        return self._base_plan.get_measurements(available)
+
+    def predict(self, hits, event_ids, batch_size=100):
+        """
+        Scores the hits of the events, batch by batch
+
+        :param hits: SignalHits or ResampledHits
+        :param event_ids: event_ids of the events
+        :param batch_size: number of events read at once
+        :return: events.HitMatrix of the events with the "wire_prob" and
+                 "signal_prob" columns of the first and second stage scores
+                 of each hit, e.g. get_csr("signal_prob") for the sparse
+                 vectors of the events
+        """
+        event_ids = np.asarray(event_ids, dtype=int)
+        batches = []
+        for start in range(0, len(event_ids), batch_size):
+            hit_matrix = hits.get_hit_matrix(
+                event_ids[start:start + batch_size],
+                self.get_measurements(hits.measurements))
+            wire_probs, probs = self.predict_hit_matrix(hit_matrix,
+                                                        hits.cydet)
+            batches.append(HitMatrix(hit_matrix.n_wires, hit_matrix.event_ids,
+                                     hit_matrix.indptr, hit_matrix.wires,
+                                     {"wire_prob": wire_probs,
+                                      "signal_prob": probs}))
+        return HitMatrix.concatenate(batches)
@@ -0,0 +1,568 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+try:
+    from root_numpy import root2array
+except ImportError:
+    root2array = None
+
+"""
+Columnar store of events.  A store is a directory holding
+ - offsets.npy, of shape [n_events + 1], such that the hits of event i are
+   offsets[i]:offsets[i+1] in the hit columns
+ - one <branch>.npy per jagged (hit level) branch, with the values of all
+   events concatenated
+ - one <branch>.npy per event level branch, of shape [n_events, ...]
+ - branches.json, listing the branches of both kinds
+
+Jagged branches whose events are not of the same lengths as the others keep
+their own offsets in <branch>.offsets.npy.
+
+Large datasets may be written as chunks, i.e. a directory of stores of
+consecutive events listed in chunks.json, see write_chunks_index and
+ChunkedEvents.
+
+Notation used below:
+ - event_id is the index of the event in the store
+ - hit_id is the index of the hit in the concatenated hit columns
+"""
+
+BRANCHES_FILE = "branches.json"
+CHUNKS_FILE = "chunks.json"
+
+
+def is_store(path):
+    """
+    Returns whether path is a columnar store
+
+    :return: bool
+    """
+    return os.path.isfile(os.path.join(path, BRANCHES_FILE))
+
+
+def is_chunked_store(path):
+    """
+    Returns whether path is a chunked columnar store
+
+    :return: bool
+    """
+    return os.path.isfile(os.path.join(path, CHUNKS_FILE))
+
+
+def write_store(path, offsets, hit_columns, event_columns=None,
+                hit_offsets=None):
+    """
+    Writes a columnar store
+
+    :param path: directory of the store, created if missing
+    :param offsets: numpy.array of shape [n_events + 1] of the hit offsets of
+                    each event
+    :param hit_columns: dict of branch name to concatenated hit values
+    :param event_columns: dict of branch name to values of each event
+    :param hit_offsets: dict of branch name to offsets, for hit columns that
+                        do not follow offsets
+    """
+    event_columns = event_columns or {}
+    hit_offsets = hit_offsets or {}
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, "offsets.npy"), np.asarray(offsets, dtype=int))
+    for name, values in list(hit_columns.items()) + list(event_columns.items()):
+        np.save(os.path.join(path, name + ".npy"), np.asarray(values))
+    for name, values in hit_offsets.items():
+        np.save(os.path.join(path, name + ".offsets.npy"),
+                np.asarray(values, dtype=int))
+    with open(os.path.join(path, BRANCHES_FILE), 'w') as branches:
+        json.dump({"hit": sorted(hit_columns), "event": sorted(event_columns),
+                   "own_offsets": sorted(hit_offsets)}, branches, indent=1)
+
+
+def write_chunks_index(path, chunks, metadata=None):
+    """
+    Lists the chunks of a chunked store, which makes it readable.  Writing it
+    last ensures that partially written stores are never read.
+
+    :param path: directory of the chunked store
+    :param chunks: names of the stores of the chunks, relative to path, in
+                   order of their events
+    :param metadata: dict of json serializable values describing the store
+    """
+    with open(os.path.join(path, CHUNKS_FILE), 'w') as index:
+        json.dump({"chunks": list(chunks), "metadata": metadata or {}}, index,
+                  indent=1)
+
+
+def get_hit_ids(starts, counts):
+    """
+    Returns the positions of consecutive blocks of hits in the concatenated
+    hit columns
+
+    :param starts: numpy.array of the position of the first hit of each block
+    :param counts: numpy.array of the number of hits of each block
+    :return: numpy.array of shape [sum(counts)]
+    """
+    # Move each hit from its place in the blocks to its place in the columns
+    block_starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) + np.repeat(starts - block_starts, counts)
+
+
+def _counts_to_offsets(counts):
+    """
+    Returns the offsets of consecutive blocks of the given sizes
+
+    :return: numpy.array of shape [len(counts) + 1]
+    """
+    offsets = np.zeros(len(counts) + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def convert(root_path, store_path, tree='tree', branches=None):
+    """
+    Reads a ROOT tree once and writes it as a columnar store
+
+    :param root_path: path to rootfile
+    :param store_path: directory of the new store
+    :param tree: name of the tree in root dataset
+    :param branches: names of the branches to keep, all by default
+    :return: ColumnarEvents of the new store
+    """
+    records = RootEvents(root_path, tree=tree, branches=branches)
+    hit_columns = dict((name, records.get_hits(name))
+                       for name in records.hit_branches)
+    event_columns = dict((name, records.data[name])
+                         for name in records.event_branches)
+    hit_offsets = dict((name, records.get_offsets(name))
+                       for name in records.hit_branches
+                       if records.get_offsets(name) is not records.offsets)
+    write_store(store_path, records.offsets, hit_columns, event_columns,
+                hit_offsets)
+    return ColumnarEvents(store_path)
+
+
+class ColumnarEvent(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self, events, event_id):
+        """
+        View of one event of a columnar store, sliced by branch name as a
+        record of root2array would be.  Hit level branches are returned as
+        slices of the store's columns, without copying them.
+        """
+        self.events = events
+        self.event_id = event_id
+
+    def __getitem__(self, name):
+        return self.events.get_event_values(self.event_id, name)
+
+
+class ColumnarEvents(object):
+    # pylint: disable=bad-continuation
+    def __init__(self, path):
+        """
+        Events of a columnar store.  All columns are memory mapped, so that
+        opening the store reads nothing but its index.  Events are selected
+        as events[event_id][branch], as for the records from root2array.
+
+        :param path: directory of the store
+        """
+        self.path = path
+        with open(os.path.join(path, BRANCHES_FILE)) as branches:
+            branches = json.load(branches)
+        self.hit_branches = [str(name) for name in branches["hit"]]
+        self.event_branches = [str(name) for name in branches["event"]]
+        self.offsets = self._load("offsets")
+        self.n_events = len(self.offsets) - 1
+        self._own_offsets = dict((str(name), self._load(name + ".offsets"))
+                                 for name in branches["own_offsets"])
+        self._columns = {}
+
+    def _load(self, name):
+        """
+        Memory maps the named array of the store
+
+        :return: read only numpy.array
+        """
+        return np.load(os.path.join(self.path, name + ".npy"),
+                       mmap_mode='r').view(np.ndarray)
+
+    def __len__(self):
+        return self.n_events
+
+    def __getitem__(self, event_id):
+        return ColumnarEvent(self, event_id)
+
+    def get_column(self, name):
+        """
+        Returns the column of a branch, which is the concatenated hits for hit
+        level branches, and the value of each event otherwise
+
+        :return: read only numpy.array
+        """
+        if name not in self._columns:
+            if name not in self.hit_branches + self.event_branches:
+                raise KeyError("No branch {} in {}".format(name, self.path))
+            self._columns[name] = self._load(name)
+        return self._columns[name]
+
+    def get_hits(self, name):
+        """
+        Returns the concatenated values of a hit level branch over all events
+
+        :return: read only numpy.array of shape [n_hits]
+        """
+        return self.get_column(name)
+
+    def get_offsets(self, name=None):
+        """
+        Returns the offsets of the events in the column of a hit level branch
+
+        :return: numpy.array of shape [n_events + 1]
+        """
+        return self._own_offsets.get(name, self.offsets)
+
+    def get_event_values(self, event_id, name):
+        """
+        Returns the values of branch name in event event_id, as a slice of the
+        column for hit level branches
+
+        :return: numpy.array for hit level branches, value of the event
+                 otherwise
+        """
+        column = self.get_column(name)
+        if name in self.event_branches:
+            return column[event_id]
+        offsets = self.get_offsets(name)
+        return column[offsets[event_id]:offsets[event_id + 1]]
+
+    def get_batch(self, event_ids, names):
+        """
+        Returns the values of the given branches for a batch of events, with
+        the hits of the events concatenated in order of event_ids.  All hit
+        level branches should follow the common offsets.
+
+        :param event_ids: numpy.array of event_ids
+        :return: tuple of numpy.array of the number of hits of each event,
+                 and dict of branch name to numpy.array of values, of one
+                 value per hit for hit level branches and per event otherwise
+        """
+        event_ids = np.asarray(event_ids, dtype=int)
+        starts = self.offsets[event_ids]
+        counts = self.offsets[event_ids + 1] - starts
+        hit_ids = get_hit_ids(starts, counts)
+        values = {}
+        for name in names:
+            if name in self.event_branches:
+                values[name] = self.get_column(name)[event_ids]
+            else:
+                values[name] = self.get_hits(name)[hit_ids]
+        return counts, values
+
+
+class RootEvents(object):
+    # pylint: disable=bad-continuation
+    def __init__(self, path, tree='tree', branches=None):
+        """
+        Events read from a ROOT tree with root2array, which provides the same
+        interface as ColumnarEvents.  The concatenated hit columns are built
+        on first use.
+
+        :param path: path to rootfile
+        :param tree: name of the tree in root dataset
+        :param branches: names of the branches to read, all by default
+        """
+        if root2array is None:
+            raise ImportError("root_numpy is needed to read {}, or convert it "
+                              "to a columnar store first".format(path))
+        self.path = path
+        self.data = root2array(path, treename=tree, branches=branches)
+        self.n_events = len(self.data)
+        names = self.data.dtype.names
+        self.hit_branches = [name for name in names
+                             if self.data.dtype[name] == object]
+        self.event_branches = [name for name in names
+                               if self.data.dtype[name] != object]
+        self._counts = {}
+        self._columns = {}
+        self._offsets = {}
+        self.offsets = self._get_common_offsets()
+
+    def __len__(self):
+        return self.n_events
+
+    def __getitem__(self, event_id):
+        return self.data[event_id]
+
+    def _get_common_offsets(self):
+        """
+        Returns the offsets followed by most of the hit level branches
+
+        :return: numpy.array of shape [n_events + 1]
+        """
+        if not self.hit_branches:
+            return np.zeros(self.n_events + 1, dtype=int)
+        counts = [np.fromiter((len(values) for values in self.data[name]),
+                              dtype=int, count=self.n_events)
+                  for name in self.hit_branches]
+        # Share the offsets between branches of equal event lengths
+        offsets = []
+        for name, this_counts in zip(self.hit_branches, counts):
+            for other in offsets:
+                if np.array_equal(np.diff(other), this_counts):
+                    self._offsets[name] = other
+                    break
+            else:
+                offsets.append(_counts_to_offsets(this_counts))
+                self._offsets[name] = offsets[-1]
+        users = [sum(this is other for this in self._offsets.values())
+                 for other in offsets]
+        return offsets[int(np.argmax(users))]
+
+    def get_column(self, name):
+        """
+        Returns the concatenated hits for hit level branches, and the value of
+        each event otherwise
+
+        :return: numpy.array
+        """
+        if name in self.event_branches:
+            return self.data[name]
+        return self.get_hits(name)
+
+    def get_hits(self, name):
+        """
+        Returns the concatenated values of a hit level branch over all events
+
+        :return: numpy.array of shape [n_hits]
+        """
+        if name not in self._columns:
+            values = list(self.data[name])
+            self._columns[name] = np.concatenate(values) if values else \
+                np.zeros(0)
+        return self._columns[name]
+
+    def get_offsets(self, name=None):
+        """
+        Returns the offsets of the events in the column of a hit level branch
+
+        :return: numpy.array of shape [n_events + 1]
+        """
+        return self._offsets.get(name, self.offsets)
+
+    def get_event_values(self, event_id, name):
+        """
+        Returns the values of branch name in event event_id
+
+        :return: numpy.array for hit level branches, value of the event
+                 otherwise
+        """
+        return self.data[event_id][name]
+
+
+class ChunkedColumn(object):
+    def __init__(self, columns):
+        """
+        Column of a branch across the chunks of a chunked store, indexed as
+        the concatenated columns of the chunks without concatenating them.
+        Only the chunks holding the requested positions are read.
+
+        :param columns: list of the memory mapped columns of the chunks
+        """
+        self.columns = columns
+        self.starts = _counts_to_offsets([len(column) for column in columns])
+        self.dtype = np.result_type(*[column.dtype for column in columns])
+
+    def __len__(self):
+        return self.starts[-1]
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def __getitem__(self, index):
+        """
+        Returns the values at the given positions, a slice, an integer, an
+        array of integers or a boolean mask
+
+        :return: numpy.array, or one value for an integer
+        """
+        if isinstance(index, slice):
+            index = np.arange(len(self))[index]
+        positions = np.asarray(index)
+        if positions.dtype == bool:
+            positions = np.flatnonzero(positions)
+        positions = np.where(positions < 0, positions + len(self), positions)
+        chunk_ids = np.searchsorted(self.starts, positions, side='right') - 1
+        if positions.ndim == 0:
+            return self.columns[chunk_ids][positions - self.starts[chunk_ids]]
+        values = np.empty(positions.shape, dtype=self.dtype)
+        for chunk_id in np.unique(chunk_ids):
+            in_chunk = chunk_ids == chunk_id
+            values[in_chunk] = self.columns[chunk_id][
+                positions[in_chunk] - self.starts[chunk_id]]
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        # pylint: disable=unused-argument
+        values = np.concatenate(self.columns)
+        return values if dtype is None else values.astype(dtype)
+
+
+class ChunkedEvents(object):
+    # pylint: disable=bad-continuation
+    def __init__(self, path):
+        """
+        Events of a chunked columnar store, indexed across its chunks as the
+        events of a single store.  Each chunk is a ColumnarEvents, so that
+        columns are memory mapped chunk by chunk.
+
+        :param path: directory of the chunked store
+        """
+        self.path = path
+        with open(os.path.join(path, CHUNKS_FILE)) as index:
+            index = json.load(index)
+        self.metadata = index["metadata"]
+        self.chunks = [ColumnarEvents(os.path.join(path, str(chunk)))
+                       for chunk in index["chunks"]]
+        assert self.chunks, 'No chunks in {}'.format(path)
+        self.chunk_starts = _counts_to_offsets([chunk.n_events
+                                                for chunk in self.chunks])
+        self.n_events = self.chunk_starts[-1]
+        self.hit_branches = self.chunks[0].hit_branches
+        self.event_branches = self.chunks[0].event_branches
+        self._columns = {}
+        self._offsets = {}
+        self.offsets = self.get_offsets()
+
+    def __len__(self):
+        return self.n_events
+
+    def get_column(self, name):
+        """
+        Returns the column of a branch across all chunks, see
+        ColumnarEvents.get_column.  The columns of the chunks stay memory
+        mapped, and are only read where the column is indexed.
+
+        :return: ChunkedColumn
+        """
+        if name not in self._columns:
+            self._columns[name] = ChunkedColumn([chunk.get_column(name)
+                                                 for chunk in self.chunks])
+        return self._columns[name]
+
+    def get_hits(self, name):
+        """
+        Returns the concatenated values of a hit level branch over all events
+
+        :return: ChunkedColumn of length n_hits
+        """
+        return self.get_column(name)
+
+    def get_offsets(self, name=None):
+        """
+        Returns the offsets of the events in the column of a hit level branch,
+        across all chunks, found on first use
+
+        :return: read only numpy.array of shape [n_events + 1]
+        """
+        if name not in self._offsets:
+            offsets = [np.zeros(1, dtype=int)]
+            for chunk in self.chunks:
+                offsets.append(chunk.get_offsets(name)[1:] + offsets[-1][-1])
+            offsets = np.concatenate(offsets)
+            offsets.setflags(write=False)
+            self._offsets[name] = offsets
+        return self._offsets[name]
+
+    def _locate(self, event_ids):
+        """
+        Returns the chunk of each event, and its event_id in the chunk
+        """
+        chunk_ids = np.searchsorted(self.chunk_starts, event_ids,
+                                    side='right') - 1
+        return chunk_ids, event_ids - self.chunk_starts[chunk_ids]
+
+    def __getitem__(self, event_id):
+        chunk_id, local_id = self._locate(event_id)
+        return self.chunks[chunk_id][local_id]
+
+    def get_event_values(self, event_id, name):
+        """
+        Returns the values of branch name in event event_id, as a slice of the
+        column of its chunk for hit level branches
+
+        :return: numpy.array for hit level branches, value of the event
+                 otherwise
+        """
+        chunk_id, local_id = self._locate(event_id)
+        return self.chunks[chunk_id].get_event_values(local_id, name)
+
+    def get_batch(self, event_ids, names):
+        """
+        Returns the values of the given branches for a batch of events, see
+        ColumnarEvents.get_batch.  Each chunk is read once.
+
+        :param event_ids: numpy.array of event_ids
+        :return: tuple of numpy.array of the number of hits of each event,
+                 and dict of branch name to numpy.array of values
+        """
+        event_ids = np.asarray(event_ids, dtype=int)
+        chunk_ids, local_ids = self._locate(event_ids)
+        counts = np.zeros(len(event_ids), dtype=int)
+        # Gather the events of each chunk, remembering where they go
+        places, hit_places, pieces = [], [], []
+        for chunk_id in np.unique(chunk_ids):
+            in_chunk = np.where(chunk_ids == chunk_id)[0]
+            chunk_counts, values = self.chunks[chunk_id].get_batch(
+                local_ids[in_chunk], names)
+            counts[in_chunk] = chunk_counts
+            places.append(in_chunk)
+            hit_places.append(np.repeat(in_chunk, chunk_counts))
+            pieces.append(values)
+        # Put the hits back in order of event_ids, keeping their order within
+        # each event
+        event_order = np.argsort(np.concatenate(places), kind='mergesort')
+        hit_order = np.argsort(np.concatenate(hit_places), kind='mergesort')
+        values = {}
+        for name in names:
+            order = event_order if name in self.event_branches else hit_order
+            values[name] = np.concatenate([piece[name]
+                                           for piece in pieces])[order]
+        return counts, values
+
+
+def open_events(path, tree='tree'):
+    """
+    Opens the events at path, either a columnar store, a chunked columnar
+    store or a rootfile
+
+    :param path: directory of a columnar store or of a chunked one, or path
+                 to rootfile
+    :param tree: name of the tree in root dataset, when reading a rootfile
+    :return: ColumnarEvents, ChunkedEvents or RootEvents
+    """
+    if is_store(path):
+        return ColumnarEvents(path)
+    if is_chunked_store(path):
+        return ChunkedEvents(path)
+    return RootEvents(path, tree=tree)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Convert a ROOT tree to a columnar store of events")
+    parser.add_argument("root_path", help="path to rootfile")
+    parser.add_argument("store_path", help="directory of the new store")
+    parser.add_argument("--tree", default="tree",
+                        help="name of the tree in root dataset")
+    parser.add_argument("--branches", nargs="+", default=None,
+                        help="branches to keep, all by default")
+    args = parser.parse_args(argv)
+    events = convert(args.root_path, args.store_path, tree=args.tree,
+                     branches=args.branches)
+    print("Wrote {} events to {}".format(events.n_events, args.store_path))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
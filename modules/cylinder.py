@@ -1,7 +1,9 @@
 import numpy as np
 import math
-from scipy.sparse import lil_matrix, find
-from scipy.spatial.distance import pdist, squareform
+from scipy.sparse import csr_matrix, find
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist, cdist, squareform
+from cache import hash_key, code_version, pack_sparse, unpack_sparse
 
 """
 Notation used below:
@@ -11,22 +13,168 @@ Notation used below:
 """
 
 
+def _round_half_away(values):
+    """
+    Rounds to the nearest integer, with halves rounded away from zero as done
+    by the python built-in round
+
+    :return: numpy.array of rounded values, as floats
+    """
+    values = np.asarray(values, dtype=float)
+    magnitude = np.abs(values)
+    rounded = np.floor(magnitude)
+    rounded += (magnitude - rounded) >= 0.5
+    return np.copysign(rounded, values)
+
+
+def _prepare_adjacency(rows, cols, n_points):
+    """
+    Builds a sparse adjacency matrix with unit values from arrays of (row,
+    column) pairs.  Repeated pairs are only stored once.
+
+    :return: scipy.sparse Compressed Sparse Row of shape [n_points,n_points]
+    """
+    # Sort by row then column, dropping repeated pairs
+    flat = np.unique(rows * n_points + cols)
+    rows, cols = flat // n_points, flat % n_points
+    indptr = np.zeros(n_points + 1, dtype=int)
+    np.cumsum(np.bincount(rows, minlength=n_points), out=indptr[1:])
+    return csr_matrix((np.ones(len(flat)), cols, indptr),
+                      shape=(n_points, n_points))
+
+
+class PointDistances(object):
+    def __init__(self, point_x, point_y):
+        """
+        Provides the pairwise distances between points without storing the
+        dense matrix of all of them.  Distances are computed when requested,
+        either by slicing as for the dense matrix, i.e. dists[point_0, :] or
+        dists[point_0, neighs], or through the methods below.  A KD-tree over
+        the points is built on first use for radius queries.
+
+        :param point_x: numpy.array of x coordinates of the points
+        :param point_y: numpy.array of y coordinates of the points
+        """
+        self.point_xy = np.column_stack((point_x, point_y))
+        self.n_points = len(self.point_xy)
+        self.shape = (self.n_points, self.n_points)
+        self._tree = None
+        self._full = None
+
+    @property
+    def tree(self):
+        """
+        KD-tree index of the points, built on first use
+
+        :return: scipy.spatial.cKDTree
+        """
+        if self._tree is None:
+            self._tree = cKDTree(self.point_xy)
+        return self._tree
+
+    def __getitem__(self, key):
+        """
+        Returns the distances selected by key, following numpy indexing of the
+        dense [n_points,n_points] matrix of distances
+        """
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        all_ids = np.arange(self.n_points)
+        rows, cols = all_ids[key[0]], all_ids[key[1]]
+        if isinstance(key[0], slice) or isinstance(key[1], slice):
+            # Slices select along their own axis
+            shape = np.shape(rows) + np.shape(cols)
+            rows, cols = np.ix_(np.ravel(rows), np.ravel(cols))
+        else:
+            # Index arrays are paired with each other
+            shape = np.broadcast(rows, cols).shape
+        return self._get_paired_distances(rows, cols).reshape(shape)
+
+    def _get_paired_distances(self, rows, cols):
+        """
+        Returns the distances between the points of broadcastable arrays of
+        point_ids rows and cols
+        """
+        d_x = self.point_xy[rows, 0] - self.point_xy[cols, 0]
+        d_y = self.point_xy[rows, 1] - self.point_xy[cols, 1]
+        return np.sqrt(d_x * d_x + d_y * d_y)
+
+    def get_distance(self, point_a, point_b):
+        """
+        Returns the distance between two points
+
+        :return: float distance between point_a and point_b
+        """
+        return float(self._get_paired_distances(point_a, point_b))
+
+    def get_row(self, point_id):
+        """
+        Returns the distances from a point to all points
+
+        :return: numpy.array of shape [n_points]
+        """
+        return self.get_block([point_id], slice(None))[0]
+
+    def get_block(self, rows, cols):
+        """
+        Returns the distances between two sets of points
+
+        :param rows: point_ids, or a slice of them, of the first set
+        :param cols: point_ids, or a slice of them, of the second set
+        :return: numpy.array of shape [len(rows), len(cols)]
+        """
+        all_ids = np.arange(self.n_points)
+        return cdist(self.point_xy[all_ids[rows]],
+                     self.point_xy[all_ids[cols]])
+
+    def get_within(self, point_id, radius):
+        """
+        Returns the points within radius of the point point_id, including
+        itself, using the KD-tree index
+
+        :return: sorted numpy.array of point_ids
+        """
+        near = self.tree.query_ball_point(self.point_xy[point_id], radius)
+        return np.sort(np.asarray(near, dtype=int))
+
+    def get_full(self):
+        """
+        Returns the dense matrix of distances between all points.  It is
+        computed on the first call only.
+
+        :return: numpy array of shape [n_points,n_points]
+        """
+        if self._full is None:
+            self._full = squareform(pdist(self.point_xy))
+        return self._full
+
+
 class CylindricalArray(object):
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=bad-continuation
-    def __init__(self, n_by_layer, r_by_layer, phi0_by_layer):
+    # Arrays stored when the geometry is cached
+    cached_arrays = ['first_point', 'point_layer', 'point_index',
+                     'dphi_by_layer', 'point_lookup', 'point_rhos', 'point_phis',
+                     'point_x', 'point_y', 'point_pol']
+    cached_matrices = ['point_neighbours', 'lr_neighbours']
+
+    def __init__(self, n_by_layer, r_by_layer, phi0_by_layer, cache=None):
         """
         This defines a cylindrical array of points from a layers.  It returns a
         flat enumerator of the points in the array, as well as pairwise
         distances between all points, and the neighbours of each point.  It also
         stores the position in both cartesian and polar coordinates of each
-        point.
+        point.  The pairwise distances are computed on demand, see
+        PointDistances.
 
         :param n_by_layer: list of number of points by layer, sorted by radii of
                            corresponding layer
         :param r_by_layer: list of radii of each layer, sorted by radii
         :param phi0_by_layer: angular displacement of the first point of each
                               layer
+        :param cache: optional cache.DiskCache, from which the arrays are
+                      loaded if this geometry was built before, and in which
+                      they are stored otherwise
 
         """
         self.n_by_layer = n_by_layer
@@ -34,17 +182,55 @@ class CylindricalArray(object):
         self.phi0_by_layer = phi0_by_layer
         self.n_points = sum(self.n_by_layer)
 
+        # Hash of the geometry and of the code building it
+        self.geometry_key = hash_key("CylindricalArray", n_by_layer,
+                                     r_by_layer, phi0_by_layer,
+                                     code_version(CylindricalArray))
+        if cache is None:
+            self._prepare_arrays()
+        else:
+            self._set_cached_arrays(cache.fetch(self.geometry_key,
+                                                self._get_cached_arrays))
+        self.point_dists = self._prepare_point_distances()
+
+    def _prepare_arrays(self):
+        """
+        Builds all lookup tables and neighbour relations of the geometry
+        """
         self.first_point = self._get_first_point()
+        self.point_layer = self._prepare_point_layer()
+        self.point_index = self._prepare_point_index()
         self.dphi_by_layer = self._prepare_dphi_by_layer()
         self.point_lookup = self._prepare_points_lookup()
         self.point_rhos = self._prepare_point_rho()
         self.point_phis = self._prepare_point_phi()
         self.point_x, self.point_y = self._prepare_point_cartesian()
         self.point_pol = self._prepare_polarity()
-        self.point_dists = self._prepare_point_distances()
         self.point_neighbours, self.lr_neighbours = \
             self._prepare_point_neighbours()
 
+    def _get_cached_arrays(self):
+        """
+        Builds the geometry and returns the arrays to be cached
+
+        :return: dict of numpy.arrays
+        """
+        self._prepare_arrays()
+        arrays = dict((name, getattr(self, name))
+                      for name in self.cached_arrays)
+        for name in self.cached_matrices:
+            arrays.update(pack_sparse(name, getattr(self, name)))
+        return arrays
+
+    def _set_cached_arrays(self, arrays):
+        """
+        Sets the geometry from the arrays returned by _get_cached_arrays
+        """
+        for name in self.cached_arrays:
+            setattr(self, name, arrays[name])
+        for name in self.cached_matrices:
+            setattr(self, name, unpack_sparse(arrays, name))
+
     def _get_first_point(self):
         """
         Returns the point_id of the first point in each layer
@@ -56,6 +242,22 @@ class CylindricalArray(object):
             first_point[i] = sum(self.n_by_layer[:i])
         return first_point
 
+    def _prepare_point_layer(self):
+        """
+        Prepares lookup table to map from point_id to layer_id
+
+        :return: numpy.array of shape [n_points]
+        """
+        return np.repeat(np.arange(len(self.n_by_layer)), self.n_by_layer)
+
+    def _prepare_point_index(self):
+        """
+        Prepares lookup table to map from point_id to point_index
+
+        :return: numpy.array of shape [n_points]
+        """
+        return np.arange(self.n_points) - self.first_point[self.point_layer]
+
     def _prepare_points_lookup(self):
         """
         Prepares lookup table to map from [layer_id, point_index] -> point_id
@@ -114,13 +316,11 @@ class CylindricalArray(object):
 
     def _prepare_point_distances(self):
         """
-        Returns a numpy array of distances between points
+        Returns a lazy provider of the distances between points
 
-        :return: numpy array of shape [n_points,n_points]
+        :return: PointDistances of shape [n_points,n_points]
         """
-        point_xy = np.column_stack((self.point_x, self.point_y))
-        distances = pdist(point_xy)
-        return squareform(distances)
+        return PointDistances(self.point_x, self.point_y)
 
     def _prepare_point_neighbours(self):
         """
@@ -128,64 +328,56 @@ class CylindricalArray(object):
         done in the row index, i.e. find(neighbours[point_0,:]) will return the
         neighbours of point_0
 
+        The relations of all points are found at once as arrays of (row,
+        column) pairs, which are then assembled into the sparse matrices
+        directly.
+
         :return: scipy.sparse Compressed Sparse Row of shape
         [n_points,n_points]
         """
-        # All neighbours
-        neigh = lil_matrix((self.n_points, self.n_points))
-        # Only left and right neighbours
-        lr_neigh = lil_matrix((self.n_points, self.n_points))
-        # Loop over all layers
-        for lay, n_points in enumerate(self.n_by_layer):
-            # Define adjacent layers, noting outer most layers only have one
-            # adjacent layer
-            if lay == 0:
-                adjacent_layers = [lay + 1]
-            elif lay == len(self.n_by_layer) - 1:
-                adjacent_layers = [lay - 1]
-            else:
-                adjacent_layers = [lay - 1, lay + 1]
-            # Loop over points in current layer
-            for point_index in range(n_points):
-                # Define current wire, and wire counter-clockwise of this wire
-                point = point_index + self.first_point[lay]
-                nxt_point = (point_index + 1) % n_points + self.first_point[lay]
-                # Define reciprocal neighbour relations on current layer
-                neigh[nxt_point, point] = 1  # Clockwise
-                lr_neigh[nxt_point, point] = 1
-                neigh[point, nxt_point] = 1  # Anti-Clockwise
-                lr_neigh[point, nxt_point] = 1
-                # Define neighbour relations for adjacent layers
-                # Start by finding position of point on layer (circle) as a
-                # fraction
-                rel_pos = self.point_phis[point] / (2 * math.pi)
-                # Loop over adjacent layers
-                for a_lay in adjacent_layers:
-                    # Set constants of adjacent layer
-                    a_n_points = self.n_by_layer[a_lay]
-                    a_first = self.first_point[a_lay]
-                    # Find point in adjacent layer closest in phi to
-                    # current point
-                    # Account for phi0
-                    a_point = rel_pos - (self.phi0_by_layer[a_lay] / (2 * math.pi))
-                    # Find index of adjacent layer point
-                    a_point *= a_n_points
-                    a_point = round(a_point)
-                    # Enforce periodicity for boundary points
-                    a_point %= a_n_points
-                    # Find points clockwise and counter clockwise to the layer
-                    # adjacent point
-                    nxt_a_point = (a_point + 1) % a_n_points
-                    prv_a_point = (a_point - 1) % a_n_points
-                    # Find the point_id for these three points
-                    a_point += a_first
-                    nxt_a_point += a_first
-                    prv_a_point += a_first
-                    # Define neighbour relations for points in adjacent layers
-                    neigh[point, a_point] = 1  # Above/Below
-                    neigh[point, nxt_a_point] = 1  # Above/Below Clockwise
-                    neigh[point, prv_a_point] = 1  # Above/Below Anti-Clockwise
-        return neigh.tocsr(), lr_neigh.tocsr()
+        n_layers = len(self.n_by_layer)
+        n_by_layer = np.asarray(self.n_by_layer)
+        phi0_by_layer = np.asarray(self.phi0_by_layer, dtype=float)
+        point_ids = np.arange(self.n_points)
+        layers = self.point_layer
+        index = self.point_index
+        # Define wire counter-clockwise of each wire
+        nxt_points = (index + 1) % n_by_layer[layers] + self.first_point[layers]
+        # Define reciprocal neighbour relations on current layer, both
+        # clockwise and anti-clockwise
+        lr_rows = np.concatenate([nxt_points, point_ids])
+        lr_cols = np.concatenate([point_ids, nxt_points])
+        rows = [lr_rows]
+        cols = [lr_cols]
+        # Define neighbour relations for adjacent layers
+        # Start by finding position of point on layer (circle) as a fraction
+        rel_pos = self.point_phis / (2 * math.pi)
+        # Loop over the layer below and the layer above, noting outer most
+        # layers only have one adjacent layer
+        for step in [-1, 1]:
+            has_adjacent = (layers + step >= 0) & (layers + step < n_layers)
+            points = point_ids[has_adjacent]
+            a_lay = layers[has_adjacent] + step
+            # Set constants of adjacent layer
+            a_n_points = n_by_layer[a_lay]
+            a_first = self.first_point[a_lay]
+            # Find point in adjacent layer closest in phi to current point,
+            # accounting for phi0
+            a_point = rel_pos[has_adjacent] - (phi0_by_layer[a_lay] /
+                                               (2 * math.pi))
+            a_point *= a_n_points
+            a_point = _round_half_away(a_point).astype(int)
+            # Enforce periodicity for boundary points
+            a_point %= a_n_points
+            # Define neighbour relations for the point above/below, as well
+            # as the points clockwise and counter clockwise to it
+            for shift in [0, 1, -1]:
+                rows.append(points)
+                cols.append((a_point + shift) % a_n_points + a_first)
+        neigh = _prepare_adjacency(np.concatenate(rows), np.concatenate(cols),
+                                   self.n_points)
+        lr_neigh = _prepare_adjacency(lr_rows, lr_cols, self.n_points)
+        return neigh, lr_neigh
 
     def _prepare_dphi_by_layer(self):
         """
@@ -244,19 +436,15 @@ class CylindricalArray(object):
 
         :return: Index of layer where point_id is
         """
-        rho = self.point_rhos[point_id]
-        layer = int(np.where(self.r_by_layer == rho)[0])
-        return layer
+        return self.point_layer[point_id]
 
     def get_index(self, point_id):
         """
         Returns the point index of a given point_id
 
-        :return: Index of layer where point_id is
+        :return: Index of point_id in its layer
         """
-        layer = self.get_layer(point_id)
-        index = point_id - self.first_point[layer]
-        return index
+        return self.point_index[point_id]
 
     def shift_wire(self, point_id, shift_size):
         """
@@ -266,12 +454,24 @@ class CylindricalArray(object):
 
         :return: index of point shift_size  counter clockwise of point_id
         """
-        layer = self.get_layer(point_id)
-        index = self.get_index(point_id)
-        index += shift_size
-        index %= self.n_by_layer[layer]
-        new_point = self.point_lookup[layer, index]
-        return new_point
+        return self.shift_wires(point_id, shift_size)
+
+    def shift_wires(self, point_ids, shift_size):
+        """
+        Get the indices of the wires that are displaced from point_ids by
+        shift_size points counter clockwise in the same layer,
+        respecting periodicity.
+
+        :param point_ids: numpy.array of point_ids
+        :param shift_size: number of points to shift by, either one for all
+                           points or a numpy.array of the shape of point_ids
+        :return: numpy.array of points shift_size counter clockwise of
+                 point_ids
+        """
+        layers = self.point_layer[point_ids]
+        index = self.point_index[point_ids] + shift_size
+        index %= np.take(self.n_by_layer, layers)
+        return self.point_lookup[layers, index]
 
     def rotate_wire(self, point_id, shift_frac):
         """
@@ -283,20 +483,32 @@ class CylindricalArray(object):
         :return: index of point n_points_in_layer*shft_frac points
                  counter clockwise of point_id
         """
-        layer = self.get_layer(point_id)
-        index = self.get_index(point_id)
-        n_points_in_layer = self.n_by_layer[layer]
-        shift_size = int(round(shift_frac * n_points_in_layer))
-        index += shift_size
-        index %= n_points_in_layer
-        new_point = self.point_lookup[layer, index]
-        return new_point
+        return self.rotate_wires(point_id, shift_frac)
+
+    def rotate_wires(self, point_ids, shift_frac):
+        """
+        Get the indices of the wires that are displaced from point_ids by
+        shift_frac of a revolution counter clockwise in the same layer,
+        respecting periodicity.
+
+        :param point_ids: numpy.array of point_ids
+        :param shift_frac: from [0, 1], 1 is complete rotation, either one for
+                           all points or a numpy.array of the shape of
+                           point_ids
+        :return: numpy.array of points n_points_in_layer*shft_frac points
+                 counter clockwise of point_ids
+        """
+        n_points_in_layer = np.take(self.n_by_layer, self.point_layer[point_ids])
+        shift_size = _round_half_away(shift_frac * n_points_in_layer)
+        return self.shift_wires(point_ids, shift_size.astype(int))
 
 
 class CyDet(CylindricalArray):
-    def __init__(self, use_default_phis=False):
+    def __init__(self, use_default_phis=False, cache=None):
         """
         Defines the Cylindrical Detector Geometry
+
+        :param cache: optional cache.DiskCache of the built geometry
         """
         cydet_wires = [198, 204, 210, 216, 222, 228, 234, 240, 246,
                        252, 258, 264, 270, 276, 282, 288, 294, 300]
@@ -312,11 +524,13 @@ class CyDet(CylindricalArray):
                           0.00000, 0.012177, 0.000000, 0.011636, 0.000000,
                           0.00000, 0.000000, 0.010686, 0.000000, 0.010267]
 
-        CylindricalArray.__init__(self, cydet_wires, cydet_radii, cydet_phi0)
+        CylindricalArray.__init__(self, cydet_wires, cydet_radii, cydet_phi0,
+                                  cache=cache)
 
 
 class TrackCenters(CylindricalArray):
-    def __init__(self, r_min=10., r_max=50., rho_bins=10, arc_res=0):
+    def __init__(self, r_min=10., r_max=50., rho_bins=10, arc_res=0,
+                 cache=None):
         """
         Defines the geometry of the centers of the potential tracks used in the
         Hough transform.  It is constructed from a minimum radius, maximum
@@ -330,6 +544,7 @@ class TrackCenters(CylindricalArray):
         :param arc_res: Arc length between points along the layers. Default
                         value set this to be the same as the distance between
                         layers
+        :param cache: optional cache.DiskCache of the built geometry
         """
         # Define distance between layers to that the radii fall in [r_min,
         # r_max] inclusive
@@ -342,4 +557,5 @@ class TrackCenters(CylindricalArray):
         n_track_cent = [int(round(2 * math.pi * r_track_cent[n] / arc_res))
                         for n in range(rho_bins)]
         phi0_track_cent = [0] * rho_bins
-        CylindricalArray.__init__(self, n_track_cent, r_track_cent, phi0_track_cent)
+        CylindricalArray.__init__(self, n_track_cent, r_track_cent, phi0_track_cent,
+                                  cache=cache)
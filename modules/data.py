@@ -1,6 +1,6 @@
 import numpy as np
 from scipy.stats import norm
-from root_numpy import root2array
+from columnar import open_events
 import math
 from scipy.sparse import lil_matrix
 from scipy.spatial.distance import pdist, cdist, squareform
@@ -24,13 +24,13 @@ class Dataset(object):
         Note that root data enumerates layer id's from [0-17].  These correspond
         to [1-18] in this structure
 
-        :param path: path to rootfile
+        :param path: path to rootfile, or to a columnar store of it
         :param treename: name of the tree in root dataset
         :param sig_rho_sigma: float, defines the spread of the smearing of the
             signal track from the constant value
 
         """
-        self.hits_data = root2array(path, treename=treename)
+        self.hits_data = open_events(path, tree=treename)
         # Hardcoded information about wires in the CDC
         self.wires_by_layer = [198, 204, 210, 216, 222, 228, 234, 240, 246,
                                252, 258, 264, 270, 276, 282, 288, 294, 300]
@@ -0,0 +1,256 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+"""
+Notation used below:
+ - event_id is the index of the event in the data
+ - row is the position of an event in a HitMatrix
+ - wire_id is flat enumerator of all wires
+ - hit is the position of a (row, wire_id) entry in a HitMatrix
+"""
+
+
+def _reduce_groups(values, groups, n_groups, reduction):
+    """
+    Combines the values sharing the same group
+
+    :param groups: numpy.array of the group of each value, from 0 to n_groups
+    :param reduction: one of "last", "first", "sum", "min", "max"
+    :return: numpy.array of shape [n_groups]
+    """
+    values = np.asarray(values)
+    if reduction == "sum":
+        return np.bincount(groups, weights=values,
+                           minlength=n_groups).astype(values.dtype)
+    if reduction in ["min", "max"]:
+        result = np.empty(n_groups, dtype=values.dtype)
+        # Start each group from one of its values
+        result[groups] = values
+        ufunc = np.minimum if reduction == "min" else np.maximum
+        ufunc.at(result, groups, values)
+        return result
+    if reduction == "first":
+        return values[np.unique(groups, return_index=True)[1]]
+    if reduction == "last":
+        last = np.unique(groups[::-1], return_index=True)[1]
+        return values[len(groups) - 1 - last]
+    raise ValueError("Unknown reduction {}".format(reduction))
+
+
+class HitMatrix(object):
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, n_wires, event_ids, indptr, wires, columns):
+        """
+        Hits of a batch of events, stored as Compressed Sparse Rows over events
+        and wires.  The row of each event holds its hit wires in increasing
+        order, and each named measurement is one array of values aligned with
+        the hits.  Memory scales with the number of hits, dense arrays of
+        shape [n_events, n_wires] are only made by get_dense.
+
+        :param n_wires: number of wires of the geometry
+        :param event_ids: numpy.array of the event_id of each row
+        :param indptr: numpy.array of shape [n_events + 1], the hits of row i
+                       are indptr[i]:indptr[i+1]
+        :param wires: numpy.array of the wire_id of each hit
+        :param columns: dict of measurement name to numpy.array of the value
+                        of each hit
+        """
+        self.n_wires = n_wires
+        self.event_ids = np.asarray(event_ids)
+        self.indptr = np.asarray(indptr)
+        self.wires = np.asarray(wires)
+        self.columns = dict(columns)
+        self.n_events = len(self.event_ids)
+        self.n_hits = len(self.wires)
+        self.shape = (self.n_events, self.n_wires)
+
+    @classmethod
+    def from_hits(cls, n_wires, event_ids, rows, wires, columns,
+                  reductions=None):
+        """
+        Builds a HitMatrix from unordered hits, combining the values of hits
+        on the same wire in the same event
+
+        :param n_wires: number of wires of the geometry
+        :param event_ids: numpy.array of the event_id of each row
+        :param rows: numpy.array of the row of each hit
+        :param wires: numpy.array of the wire_id of each hit
+        :param columns: dict of measurement name to numpy.array of the value
+                        of each hit
+        :param reductions: dict of measurement name to how values of the same
+                           wire are combined, see _reduce_groups.  By default,
+                           the last hit is kept.
+        :return: HitMatrix
+        """
+        reductions = reductions or {}
+        n_events = len(event_ids)
+        flat, groups = np.unique(np.asarray(rows) * n_wires + wires,
+                                 return_inverse=True)
+        new_rows, new_wires = flat // n_wires, flat % n_wires
+        indptr = np.zeros(n_events + 1, dtype=int)
+        np.cumsum(np.bincount(new_rows, minlength=n_events), out=indptr[1:])
+        new_columns = {}
+        for name, values in columns.items():
+            new_columns[name] = _reduce_groups(values, groups, len(flat),
+                                               reductions.get(name, "last"))
+        return cls(n_wires, event_ids, indptr, new_wires, new_columns)
+
+    @property
+    def names(self):
+        """
+        Names of the measurements
+        """
+        return sorted(self.columns)
+
+    def get_rows(self):
+        """
+        Returns the row of each hit
+
+        :return: numpy.array of shape [n_hits]
+        """
+        return np.repeat(np.arange(self.n_events), np.diff(self.indptr))
+
+    def get_column(self, name):
+        """
+        Returns the values of a measurement for each hit
+
+        :return: numpy.array of shape [n_hits]
+        """
+        return self.columns[name]
+
+    def add_column(self, name, values):
+        """
+        Adds the values of a measurement for each hit
+        """
+        values = np.asarray(values)
+        assert values.shape == (self.n_hits,), \
+            'Expected {} values for {}'.format(self.n_hits, name)
+        self.columns[name] = values
+
+    def get_csr(self, name):
+        """
+        Returns a measurement as a sparse matrix, sharing the arrays of the
+        HitMatrix
+
+        :return: scipy.sparse.csr_matrix of shape [n_events, n_wires]
+        """
+        return csr_matrix((self.columns[name], self.wires, self.indptr),
+                          shape=self.shape)
+
+    def get_dense(self, name):
+        """
+        Returns a measurement as a dense array, zero for wires without hits
+
+        :return: numpy.array of shape [n_events, n_wires]
+        """
+        values = self.columns[name]
+        result = np.zeros(self.shape, dtype=values.dtype)
+        result[self.get_rows(), self.wires] = values
+        return result
+
+    def get_event_wires(self, row):
+        """
+        Returns the hit wires of the event in the given row
+
+        :return: numpy.array of wire_ids, in increasing order
+        """
+        return self.wires[self.indptr[row]:self.indptr[row + 1]]
+
+    def get_event_values(self, row, name):
+        """
+        Returns the values of a measurement of the event in the given row,
+        aligned with get_event_wires
+
+        :return: numpy.array
+        """
+        return self.columns[name][self.indptr[row]:self.indptr[row + 1]]
+
+    def get_hit_lookup(self, rows, wires):
+        """
+        Returns the position of the (row, wire) pairs among the hits, or -1 for
+        pairs that are not hits
+
+        :return: numpy.array of the shape of rows and wires
+        """
+        keys = self.get_rows() * self.n_wires + self.wires
+        queries = np.asarray(rows) * self.n_wires + wires
+        if len(keys) == 0:
+            return np.full(np.shape(queries), -1, dtype=int)
+        found = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+        return np.where(keys[found] == queries, found, -1)
+
+    def get_neighbour_sum(self, name, neighbours, hits_only=True):
+        """
+        Returns the sum of a measurement over the neighbours of each wire, as
+        neighbours.dot(dense.T).T would for the dense measurement
+
+        :param neighbours: scipy.sparse matrix of shape [n_wires, n_wires],
+                           e.g. CyDet.point_neighbours
+        :param hits_only: if true, return the sums of the hit wires only
+        :return: numpy.array of shape [n_hits] if hits_only, otherwise
+                 scipy.sparse.csr_matrix of shape [n_events, n_wires]
+        """
+        sums = self.get_csr(name).dot(neighbours.T).tocsr()
+        if not hits_only:
+            return sums
+        return self.get_hit_values(sums)
+
+    def get_hit_values(self, matrix, first_wire=0):
+        """
+        Returns the values of a sparse matrix over the same events and wires
+        at the hits, zero where the matrix has no entry.  The entries of each
+        row are sorted, then the hits are looked up among them, so that
+        memory scales with the number of entries rather than with
+        n_events * n_columns.
+
+        :param matrix: scipy.sparse matrix of shape [n_events, n_columns],
+                       whose columns first_wire to first_wire + n_wires are
+                       the wires
+        :param first_wire: column of the first wire
+        :return: numpy.array of shape [n_hits]
+        """
+        matrix = matrix.tocsr()
+        matrix.sum_duplicates()
+        other = HitMatrix(matrix.shape[1], self.event_ids, matrix.indptr,
+                          matrix.indices, {})
+        found = other.get_hit_lookup(self.get_rows(), first_wire + self.wires)
+        # Missing hits take the zero appended at the end
+        return np.append(matrix.data, 0)[found]
+
+    def select(self, rows):
+        """
+        Returns the events in the given rows
+
+        :param rows: array, list or slice of rows
+        :return: HitMatrix
+        """
+        rows = np.atleast_1d(np.arange(self.n_events)[rows])
+        starts, stops = self.indptr[rows], self.indptr[rows + 1]
+        counts = stops - starts
+        indptr = np.zeros(len(rows) + 1, dtype=int)
+        np.cumsum(counts, out=indptr[1:])
+        hits = np.arange(indptr[-1]) + np.repeat(starts - indptr[:-1], counts)
+        columns = dict((name, values[hits])
+                       for name, values in self.columns.items())
+        return HitMatrix(self.n_wires, self.event_ids[rows], indptr,
+                         self.wires[hits], columns)
+
+    @classmethod
+    def concatenate(cls, matrices):
+        """
+        Stacks the events of several HitMatrix with the same measurements
+
+        :return: HitMatrix
+        """
+        indptr = [np.zeros(1, dtype=int)]
+        for matrix in matrices:
+            indptr.append(matrix.indptr[1:] + indptr[-1][-1])
+        names = matrices[0].columns
+        columns = dict((name, np.concatenate([matrix.columns[name]
+                                              for matrix in matrices]))
+                       for name in names)
+        return cls(matrices[0].n_wires,
+                   np.concatenate([matrix.event_ids for matrix in matrices]),
+                   np.concatenate(indptr),
+                   np.concatenate([matrix.wires for matrix in matrices]),
+                   columns)
@@ -0,0 +1,569 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix, vstack, hstack
+from cache import hash_key
+from events import HitMatrix
+
+"""
+Wire features of the hits, for the wire-level GBDT of the notebooks.  Only
+the hit wires of each event are kept, one row per hit, so that memory scales
+with the number of hits rather than with n_events * n_wires.
+
+Each feature is a FeatureDefinition in DEFINITIONS, computed from the
+definitions it depends on.  Features available, in the order of the
+notebooks:
+ - deposit is the energy deposit of the wire
+ - rel_time is the time of the hit, relative to the trigger if known
+ - layer_id is the layer of the wire
+ - sum_neigh_deposits is the sum of deposits of the neighbours
+ - num_neigh_deposits is the number of neighbours with deposits
+ - sum_neigh_deposits_2 is the sum of sum_neigh_deposits of the neighbours,
+   without the deposit of the wire itself
+ - sum_lr_time is the sum of rel_time of the left/right neighbours
+ - sum_lr_deposits is the sum of deposits of the left/right neighbours
+ - num_lr_deposits is the number of left/right neighbours with deposits
+ - sum_lr_deposits_2 is the sum of sum_neigh_deposits of the left/right
+   neighbours, without the deposit of the wire itself
+ - labels is 1 for signal hits, 0 for background hits
+and, given the signal probability of each hit as "wire_prob":
+ - sig_like_neigh is the sum of wire_prob of the neighbours
+ - sig_like_lr is the sum of wire_prob of the left/right neighbours
+"""
+
+
+class FeatureDefinition(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self, name, inputs=(), compute=None, neighbours=None,
+                 measurement=None, version=1):
+        """
+        Definition of a feature of the hits, made in one of the following ways
+
+        :param name: name of the feature
+        :param inputs: names of the definitions the feature is computed from
+        :param compute: function of the events.HitMatrix, the CyDet and the
+                        values of the inputs at the hits, returning the values
+                        at the hits
+        :param neighbours: "point" or "lr", for the sum of the single input
+                           over CyDet.point_neighbours or CyDet.lr_neighbours.
+                           The sum is known at all wires, so that it can be
+                           summed again.
+        :param measurement: list of measurements of the hits, the first one
+                            available is read
+        :param version: version of the definition, to be increased when the
+                        computation changes so that stored values of the
+                        feature and of those depending on it are recomputed,
+                        see FeatureStore
+        If none of compute, neighbours and measurement are given, the values
+        must be given when computing the features, see FeaturePlan.compute
+        """
+        self.name = name
+        self.inputs = list(inputs)
+        self.compute = compute
+        self.neighbours = neighbours
+        self.measurement = measurement
+        self.version = version
+        if neighbours is not None:
+            assert len(self.inputs) == 1, \
+                'Neighbour sum {} needs one input'.format(name)
+
+
+# Definitions of all features, by name
+DEFINITIONS = OrderedDict()
+
+
+def define_feature(name, inputs=(), compute=None, neighbours=None,
+                   measurement=None, version=1):
+    """
+    Adds a feature to DEFINITIONS, see FeatureDefinition
+    """
+    DEFINITIONS[name] = FeatureDefinition(name, inputs, compute, neighbours,
+                                          measurement, version)
+
+
+def get_feature_key(name, definitions=None):
+    """
+    Returns a hash of the definition of a feature and of all the definitions
+    it depends on, which changes with the version of any of them
+
+    :param definitions: dict of name to FeatureDefinition, DEFINITIONS by
+                        default
+    :return: hexadecimal string
+    """
+    definitions = definitions or DEFINITIONS
+    definition = definitions[name]
+    return hash_key(name, definition.version, definition.neighbours,
+                    definition.measurement,
+                    [get_feature_key(input_name, definitions)
+                     for input_name in definition.inputs])
+
+
+def _difference(hit_matrix, cydet, first, second):
+    """
+    Subtracts the second input from the first one
+    """
+    # pylint: disable=unused-argument
+    return first - second
+
+
+define_feature("deposit", measurement=["energy_deposits"])
+define_feature("rel_time", measurement=["relative_time", "hit_time"])
+define_feature("hit_vector", measurement=["hit_vector"])
+define_feature("hit_types", measurement=["hit_types"])
+define_feature("layer_id", compute=lambda hit_matrix, cydet:
+               cydet.point_layer[hit_matrix.wires])
+define_feature("sum_neigh_deposits", ["deposit"], neighbours="point")
+define_feature("num_neigh_deposits", ["hit_vector"], neighbours="point")
+define_feature("neigh_sum_neigh_deposits", ["sum_neigh_deposits"],
+               neighbours="point")
+define_feature("sum_neigh_deposits_2", ["neigh_sum_neigh_deposits", "deposit"],
+               _difference)
+define_feature("sum_lr_time", ["rel_time"], neighbours="lr")
+define_feature("sum_lr_deposits", ["deposit"], neighbours="lr")
+define_feature("num_lr_deposits", ["hit_vector"], neighbours="lr")
+define_feature("lr_sum_neigh_deposits", ["sum_neigh_deposits"],
+               neighbours="lr")
+define_feature("sum_lr_deposits_2", ["lr_sum_neigh_deposits", "deposit"],
+               _difference)
+# Map signal to 1, background to 0
+define_feature("labels", ["hit_types"],
+               lambda hit_matrix, cydet, hit_types: 2 - hit_types)
+define_feature("wire_prob")
+define_feature("sig_like_neigh", ["wire_prob"], neighbours="point")
+define_feature("sig_like_lr", ["wire_prob"], neighbours="lr")
+
+# Features of the notebooks computed by default
+FEATURES = ["deposit", "rel_time", "layer_id", "sum_neigh_deposits",
+            "num_neigh_deposits", "sum_neigh_deposits_2", "sum_lr_time",
+            "sum_lr_deposits", "num_lr_deposits", "sum_lr_deposits_2",
+            "labels"]
+
+
+def _split_rows(matrix, n_blocks):
+    """
+    Splits a CSR matrix into blocks of consecutive rows of equal size,
+    sharing its arrays
+
+    :return: list of scipy.sparse.csr_matrix
+    """
+    n_rows = matrix.shape[0] // n_blocks
+    blocks = []
+    for block in range(n_blocks):
+        indptr = matrix.indptr[block * n_rows:(block + 1) * n_rows + 1]
+        first, last = indptr[0], indptr[-1]
+        blocks.append(csr_matrix((matrix.data[first:last],
+                                  matrix.indices[first:last],
+                                  indptr - first),
+                                 shape=(n_rows, matrix.shape[1])))
+    return blocks
+
+
+class FeaturePlan(object):
+    def __init__(self, names=None, provided=(), definitions=None):
+        """
+        Order of computation of the requested features and of all the
+        definitions they depend on, found once and used for each batch of
+        events.  The definitions are grouped in levels, the neighbour sums of
+        one level taking their inputs from the lower levels only.  The
+        inputs of all the neighbour sums of a level are then stacked, and
+        summed over all the neighbours of the level by one sparse product,
+        e.g. wire_prob over both point and lr neighbours for sig_like_neigh
+        and sig_like_lr.
+
+        :param names: names of the features, all of FEATURES by default
+        :param provided: names of the definitions whose values are given to
+                         compute, e.g. already computed features, which are
+                         then not computed again.  Neighbour sums which are
+                         summed again are needed at all wires, and are always
+                         computed.
+        :param definitions: dict of name to FeatureDefinition, DEFINITIONS by
+                            default
+        """
+        if names is None:
+            names = FEATURES
+        self.names = list(names)
+        self.definitions = definitions or DEFINITIONS
+        self.provided = set()
+        self.order = []
+        self.levels = {}
+        for name in self.names:
+            self._add(name, ())
+        summed = set(self.definitions[name].inputs[0] for name in self.order
+                     if self.definitions[name].neighbours is not None)
+        self.provided = set(
+            name for name in provided if name not in summed or
+            self.definitions[name].neighbours is None)
+        # Find the order again, without the inputs of the provided ones
+        self.order = []
+        self.levels = {}
+        for name in self.names:
+            self._add(name, ())
+        self.n_levels = max(self.levels.values()) + 1 if self.levels else 0
+
+    def _add(self, name, path):
+        """
+        Adds a definition after its inputs in the order of computation
+
+        :param path: names of the definitions depending on this one
+        """
+        if name in self.levels:
+            return
+        if name not in self.definitions:
+            raise ValueError("Unknown feature {}".format(name))
+        if name in path:
+            raise ValueError("Feature {} depends on itself".format(name))
+        definition = self.definitions[name]
+        level = 0
+        if name not in self.provided:
+            for input_name in definition.inputs:
+                self._add(input_name, path + (name,))
+                level = max(level, self.levels[input_name])
+            if definition.neighbours is not None:
+                level += 1
+        self.levels[name] = level
+        self.order.append(name)
+
+    def get_measurements(self, available):
+        """
+        Returns the measurements of the hits read by the plan
+
+        :param available: names of the measurements available
+        :return: list of names of measurements
+        """
+        measurements = []
+        for name in self.order:
+            definition = self.definitions[name]
+            if name in self.provided or definition.measurement is None:
+                continue
+            found = [option for option in definition.measurement
+                     if option in available]
+            if not found:
+                raise ValueError("No measurement for feature {}, needs one of "
+                                 "{}".format(name, definition.measurement))
+            measurements.append(found[0])
+        return measurements
+
+    def compute(self, hit_matrix, cydet, values=None):
+        """
+        Returns the requested features of the hits of a HitMatrix
+
+        :param hit_matrix: events.HitMatrix with the measurements of
+                           get_measurements
+        :param cydet: CyDet of the hits
+        :param values: dict of name to numpy.array of the values at the hits of
+                       the provided definitions
+        :return: numpy.array of shape [hit_matrix.n_hits, len(names)]
+        """
+        values = dict((name, value) for name, value in (values or {}).items()
+                      if name in self.provided)
+        missing = self.provided - set(values)
+        assert not missing, 'Values of {} are not given'.format(missing)
+        neighbours = {"point": cydet.point_neighbours,
+                      "lr": cydet.lr_neighbours}
+        n_wires = hit_matrix.n_wires
+        # Neighbour sums over all wires, by name, as the products they are
+        # columns of with the column of their first wire
+        wire_values = {}
+
+        def get_hit_values(name):
+            if name not in values:
+                values[name] = hit_matrix.get_hit_values(*wire_values[name])
+            return values[name]
+
+        def get_wire_values(name):
+            if name not in wire_values:
+                wire_values[name] = (csr_matrix(
+                    (get_hit_values(name), hit_matrix.wires,
+                     hit_matrix.indptr), shape=hit_matrix.shape), 0)
+            matrix, first_wire = wire_values[name]
+            if matrix.shape[1] > n_wires:
+                matrix = matrix[:, first_wire:first_wire + n_wires]
+                wire_values[name] = (matrix, 0)
+            return matrix
+
+        available = hit_matrix.names
+        for level in range(self.n_levels):
+            names = [name for name in self.order
+                     if self.levels[name] == level and name not in values]
+            # Stack the inputs of all the neighbour sums of the level, and sum
+            # them over all the neighbours used by the level at once
+            sums = [name for name in names
+                    if self.definitions[name].neighbours is not None]
+            if sums:
+                input_names = list(OrderedDict.fromkeys(
+                    self.definitions[name].inputs[0] for name in sums))
+                kinds = list(OrderedDict.fromkeys(
+                    self.definitions[name].neighbours for name in sums))
+                stacked = vstack([get_wire_values(input_name)
+                                  for input_name in input_names],
+                                 format="csr")
+                product = stacked.dot(hstack([neighbours[kind].T
+                                              for kind in kinds],
+                                             format="csr")).tocsr()
+                blocks = dict(zip(input_names,
+                                  _split_rows(product, len(input_names))))
+                for name in sums:
+                    definition = self.definitions[name]
+                    wire_values[name] = (
+                        blocks[definition.inputs[0]],
+                        kinds.index(definition.neighbours) * n_wires)
+            for name in names:
+                definition = self.definitions[name]
+                if definition.neighbours is not None:
+                    continue
+                if definition.measurement is not None:
+                    found = [option for option in definition.measurement
+                             if option in available]
+                    values[name] = hit_matrix.get_column(found[0])
+                elif definition.compute is not None:
+                    values[name] = definition.compute(
+                        hit_matrix, cydet,
+                        *[get_hit_values(input_name)
+                          for input_name in definition.inputs])
+                else:
+                    raise ValueError("Values of feature {} must be "
+                                     "given".format(name))
+        result = np.empty((hit_matrix.n_hits, len(self.names)))
+        for index, name in enumerate(self.names):
+            result[:, index] = get_hit_values(name)
+        return result
+
+
+def compute_features(hit_matrix, cydet, names=None, values=None):
+    """
+    Returns the requested features of the hits of a HitMatrix, see
+    FeaturePlan.compute
+
+    :param values: dict of name to numpy.array of the values at the hits of
+                   definitions known beforehand, e.g. "wire_prob" or features
+                   already computed
+    :return: numpy.array of shape [hit_matrix.n_hits, len(names)]
+    """
+    values = values or {}
+    plan = FeaturePlan(names, provided=values.keys())
+    return plan.compute(hit_matrix, cydet, values)
+
+
+def _get_plan_features(hits, plan, event_ids):
+    """
+    Returns the HitMatrix of a batch of events and the features of its hits
+    """
+    hit_matrix = hits.get_hit_matrix(
+        event_ids, plan.get_measurements(hits.measurements))
+    return hit_matrix, plan.compute(hit_matrix, hits.cydet)
+
+
+def get_batch_features(hits, event_ids, names=None):
+    """
+    Returns the features of the hits of a batch of events.  Only the
+    measurements the features depend on are read.
+
+    :param hits: SignalHits or ResampledHits
+    :param event_ids: array, list or slice of event_ids
+    :param names: names of the features, from DEFINITIONS, all of FEATURES by
+                  default
+    :return: tuple of
+     - events.HitMatrix of the events, with one row per event
+     - numpy.array of shape [hit_matrix.n_hits, len(names)]
+    """
+    return _get_plan_features(hits, FeaturePlan(names), event_ids)
+
+
+def iter_feature_chunks(hits, event_ids, names=None, chunk_size=100000,
+                        batch_size=100):
+    """
+    Yields the features of the hits of the events in chunks of chunk_size
+    hits, see get_batch_features.  The events are read batch_size at a time,
+    so that memory is bounded by the chunk and batch sizes, whatever the
+    number of events.  Hits of one event may be split between two chunks.
+
+    :param hits: SignalHits or ResampledHits
+    :param event_ids: array or list of event_ids, in order
+    :param names: names of the features, from DEFINITIONS, all of FEATURES by
+                  default
+    :param chunk_size: number of hits of each chunk, the last chunk may be
+                       shorter
+    :param batch_size: number of events read at once
+    :return: generator of numpy.array of shape [chunk_size, len(names)]
+    """
+    plan = FeaturePlan(names)
+    event_ids = np.asarray(event_ids, dtype=int)
+    pending, n_pending = [], 0
+    for start in range(0, len(event_ids), batch_size):
+        _, features = _get_plan_features(
+            hits, plan, event_ids[start:start + batch_size])
+        pending.append(features)
+        n_pending += len(features)
+        if n_pending < chunk_size:
+            continue
+        features = np.concatenate(pending)
+        n_full = n_pending - n_pending % chunk_size
+        for stop in range(chunk_size, n_full + 1, chunk_size):
+            yield features[stop - chunk_size:stop]
+        pending, n_pending = [features[n_full:]], n_pending - n_full
+    if n_pending:
+        yield np.concatenate(pending)
+
+
+class FeatureStore(object):
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, hits, event_ids=None, path="../features",
+                 batch_size=100, definitions=None):
+        """
+        Features of the hits of a set of events saved on disk, so that they
+        are computed once across sessions.  The store of the events is a
+        directory named by the hash of the dataset (see
+        SignalHits.get_dataset_key), of the geometry and of the event_ids.  It
+        holds the hits of the events, and one .npy file per feature named
+        after the hash of its definition (see get_feature_key), which are
+        memory mapped on load.  Requested features that are not stored are
+        computed batch by batch, taking the stored ones they depend on as
+        given.
+
+        :param hits: SignalHits or ResampledHits
+        :param event_ids: event_ids of the events, all by default
+        :param path: directory of the stores
+        :param batch_size: number of events read at once when computing
+                           features
+        :param definitions: dict of name to FeatureDefinition, DEFINITIONS by
+                            default
+        """
+        if event_ids is None:
+            event_ids = hits.event_ids
+        self.hits = hits
+        self.n_wires = hits.cydet.n_points
+        self.event_ids = np.asarray(event_ids, dtype=int)
+        assert len(self.event_ids), 'No events to store'
+        self.batch_size = batch_size
+        self.definitions = definitions or DEFINITIONS
+        self.key = hash_key("FeatureStore", hits.get_dataset_key(),
+                            hits.cydet.geometry_key, self.event_ids)
+        self.path = os.path.join(path, self.key)
+
+    def _get_file(self, name):
+        """
+        Returns the path of the file of a feature, or of the hits for
+        "indptr" and "wires"
+        """
+        if name in ["indptr", "wires"]:
+            return os.path.join(self.path, name + ".npy")
+        return os.path.join(self.path, "{}-{}.npy".format(
+            name, get_feature_key(name, self.definitions)))
+
+    def _load(self, name):
+        """
+        Memory maps the array of a feature, or of the hits
+
+        :return: read only numpy.array
+        """
+        return np.load(self._get_file(name), mmap_mode='r').view(np.ndarray)
+
+    def is_stored(self, name):
+        """
+        Returns whether the current definition of a feature is stored
+
+        :return: bool
+        """
+        return os.path.isfile(self._get_file(name))
+
+    def compute(self, names):
+        """
+        Computes and stores the features that are not stored yet
+
+        :param names: names of the features, from DEFINITIONS
+        """
+        missing = [name for name in OrderedDict.fromkeys(names)
+                   if not self.is_stored(name)]
+        with_hits = self.is_stored("indptr")
+        if not missing and with_hits:
+            return
+        provided = []
+        if with_hits:
+            # Stored features the missing ones depend on are not computed again
+            order = FeaturePlan(missing, definitions=self.definitions).order
+            provided = [name for name in order if self.is_stored(name)]
+            indptr = self._load("indptr")
+        plan = FeaturePlan(missing, provided, self.definitions)
+        stored = dict((name, self._load(name)) for name in plan.provided)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Write each batch next to the store, then gather them in one file
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix='.tmp')
+        try:
+            batches = []
+            for index, start in enumerate(range(0, len(self.event_ids),
+                                                self.batch_size)):
+                hit_matrix = self.hits.get_hit_matrix(
+                    self.event_ids[start:start + self.batch_size],
+                    plan.get_measurements(self.hits.measurements))
+                values = {}
+                if with_hits:
+                    first = indptr[start]
+                    last = indptr[start + hit_matrix.n_events]
+                    assert last - first == hit_matrix.n_hits, \
+                        'Hits of {} differ from the stored ones'.format(
+                            self.path)
+                    values = dict((name, column[first:last])
+                                  for name, column in stored.items())
+                batch = dict(zip(missing, plan.compute(
+                    hit_matrix, self.hits.cydet, values).T))
+                batch["counts"] = np.diff(hit_matrix.indptr)
+                batch["wires"] = hit_matrix.wires
+                batch_path = os.path.join(tmp_dir, "{:05d}".format(index))
+                os.mkdir(batch_path)
+                for name, array in batch.items():
+                    np.save(os.path.join(batch_path, name + ".npy"), array)
+                batches.append(batch_path)
+            # The hits are written last, marking the store as complete
+            gathered = missing if with_hits else missing + ["wires"]
+            for name in gathered:
+                self._gather(name, batches, tmp_dir)
+            if not with_hits:
+                counts = np.concatenate([
+                    np.load(os.path.join(batch_path, "counts.npy"))
+                    for batch_path in batches])
+                indptr = np.zeros(len(counts) + 1, dtype=int)
+                np.cumsum(counts, out=indptr[1:])
+                tmp_file = os.path.join(tmp_dir, "indptr.npy")
+                np.save(tmp_file, indptr)
+                os.rename(tmp_file, self._get_file("indptr"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def _gather(self, name, batches, tmp_dir):
+        """
+        Concatenates the batches of an array into its file in the store,
+        copying one batch at a time
+        """
+        arrays = [np.load(os.path.join(batch_path, name + ".npy"),
+                          mmap_mode='r') for batch_path in batches]
+        tmp_file = os.path.join(tmp_dir, name + ".npy")
+        result = np.lib.format.open_memmap(
+            tmp_file, mode='w+', dtype=arrays[0].dtype,
+            shape=(sum(len(array) for array in arrays),))
+        position = 0
+        for array in arrays:
+            result[position:position + len(array)] = array
+            position += len(array)
+        result.flush()
+        del result
+        os.rename(tmp_file, self._get_file(name))
+
+    def get_hit_matrix(self, names=None):
+        """
+        Returns the requested features of the events as an events.HitMatrix,
+        with one row per event and memory mapped feature columns.  Features
+        that are not stored are computed first.
+
+        :param names: names of the features, from DEFINITIONS, all of FEATURES
+                      by default
+        :return: events.HitMatrix
+        """
+        if names is None:
+            names = FEATURES
+        self.compute(names)
+        columns = dict((name, self._load(name)) for name in names)
+        return HitMatrix(self.n_wires, self.event_ids,
+                         self._load("indptr"), self._load("wires"), columns)
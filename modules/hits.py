@@ -1,8 +1,8 @@
 import numpy as np
-from root_numpy import root2array
 from cylinder import CyDet
-from random import Random
-from scipy.sparse import lil_matrix, find
+from columnar import open_events, get_hit_ids
+from events import HitMatrix
+from cache import LRUCache, hash_key, file_version
 
 """
 Notation used below:
@@ -23,14 +23,19 @@ class SignalHits(object):
         "CdcCell_"+ variable for all leaves. It over lays its data on the uses
         the CyDet class to define its geometry.
 
-        :param path: path to rootfile
+        :param path: path to rootfile, or to a columnar store of it (see
+                     columnar.convert)
         :param tree: name of the tree in root dataset
         """
 
-        self.data = root2array(path, treename=tree)
+        self.data = open_events(path, tree=tree)
         self.cydet = cydet
         self.prefix = "CdcCell"
         self.n_events = len(self.data)
+        self.event_ids = np.arange(self.n_events)
+        # Hash of the data, found once as it reads the files of the data
+        self.dataset_key = hash_key("SignalHits", file_version(self.data.path),
+                                    self.prefix)
 
     def get_hit_wires(self, event_id):
         """
@@ -58,9 +63,7 @@ class SignalHits(object):
         :return: numpy array of shape [n_wires] whose value is 1 for a hit, 0 for
                 no hit
         """
-        hit_vector = np.zeros(self.cydet.n_points)
-        hit_vector[self.get_hit_wires(event_id)] = 1
-        return hit_vector
+        return self._get_event_measurement(event_id, "hit_vector")
 
     def get_hit_wires_even_odd(self, event_id):
         """
@@ -114,8 +117,7 @@ class SignalHits(object):
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        energy_deposit = self.get_measurement(event_id, self.prefix + "_edep")
-        return energy_deposit
+        return self._get_event_measurement(event_id, "energy_deposits")
 
     def get_hit_time(self, event_id):
         """
@@ -123,8 +125,7 @@ class SignalHits(object):
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        time_hit = self.get_measurement(event_id, self.prefix + "_tstart")
-        return time_hit
+        return self._get_event_measurement(event_id, "hit_time")
 
     def get_trigger_time(self, event_id):
         """
@@ -132,11 +133,7 @@ class SignalHits(object):
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        event = self.data[event_id]
-        this_trig_time = event[self.prefix + "_mt"]
-        trig_time = np.zeros((self.cydet.n_points))
-        trig_time[self.get_hit_wires(event_id)] = this_trig_time
-        return trig_time
+        return self._get_event_measurement(event_id, "trigger_time")
 
     def get_relative_time(self, event_id):
         """
@@ -145,10 +142,7 @@ class SignalHits(object):
 
         :return: numpy array of (t_start_hit - t_trig)%1170
         """
-        trig_time = self.get_trigger_time(event_id)
-        hit_time = self.get_hit_time(event_id)
-        # return np.remainder(hit_time - trig_time, 1170)
-        return np.remainder(hit_time - trig_time, 1170)
+        return self._get_event_measurement(event_id, "relative_time")
 
     def get_time_neighbours_metric(self, event_id):
         """
@@ -160,15 +154,7 @@ class SignalHits(object):
         :return: numpy array non-physical measure of how close in time
                  LR neighbouring hits are
         """
-        t_hits = self.get_hit_time(event_id)
-        hit_wires = self.get_hit_wires(event_id)
-        result = np.zeros(self.cydet.n_points)
-        for wire in hit_wires:
-            for shift in [1, -1]:
-                sh_wire = self.cydet.shift_wire(wire, shift)
-                t_metric = abs((t_hits[sh_wire] + 1) / (t_hits[wire] + 1))
-                result[wire] += t_metric
-        return result
+        return self._get_event_measurement(event_id, "time_neighbours_metric")
 
     def get_hit_types(self, event_id):
         """
@@ -177,20 +163,7 @@ class SignalHits(object):
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        result = np.zeros(self.cydet.n_points, dtype=int)
-        # Select the relevant event from data
-        event = self.data[event_id]
-        # Get the wire_ids of the hit data
-        wire_ids = self.get_hit_wires(event_id)
-        # Select the hit type leaf
-        measurement = event[self.prefix + "_hittype"]
-        # Define custom coding
-        coding = [1, 2, 2, 2]
-        # Maps signal to 1, background to 2, and nothing to 0
-        measurement = np.take(coding, measurement)
-        # Add the measurement to the correct cells in the result
-        result[wire_ids] += measurement
-        return result.astype(int)
+        return self._get_event_measurement(event_id, "hit_types")
 
     def get_sig_wires(self, event_id):
         """
@@ -199,11 +172,9 @@ class SignalHits(object):
 
         :return: numpy array of signal hit wires
         """
-        # Get all hit wires
-        hit_types = self.get_hit_types(event_id)
+        hit_matrix = self.get_hit_matrix(event_id, ["hit_types"])
         # Select signal hits
-        sig_wires = np.where(hit_types == 1)[0]
-        return sig_wires
+        return hit_matrix.wires[hit_matrix.get_column("hit_types") == 1]
 
     def get_bkg_wires(self, event_id):
         """
@@ -212,16 +183,197 @@ class SignalHits(object):
 
         :return: numpy array of signal hit wires
         """
-        # Get all hit wires
-        hit_types = self.get_hit_types(event_id)
-        # Select signal hits
-        bkg_wires = np.where(hit_types == 2)[0]
-        return bkg_wires
+        hit_matrix = self.get_hit_matrix(event_id, ["hit_types"])
+        # Select background hits
+        return hit_matrix.wires[hit_matrix.get_column("hit_types") == 2]
+
+    def _get_batch_hits(self, event_ids):
+        """
+        Returns the hits of a batch of events, in order of the events
+
+        :param event_ids: array, list or slice of event_ids
+        :return: tuple of
+         - numpy.array of the event_ids
+         - numpy.array of the position in event_ids of the event of each hit
+         - numpy.array of the position of each hit in the columns of the data
+        """
+        event_ids = np.atleast_1d(np.arange(self.n_events)[event_ids])
+        offsets = self.data.get_offsets(self.prefix + "_cellID")
+        starts = offsets[event_ids]
+        counts = offsets[event_ids + 1] - starts
+        rows = np.repeat(np.arange(len(event_ids)), counts)
+        return event_ids, rows, get_hit_ids(starts, counts)
+
+    def _get_batch_branch(self, name, event_ids, rows, hit_ids):
+        """
+        Returns the values of the leaf name for the hits of a batch of events,
+        see _get_batch_hits
+
+        :return: numpy.array of shape [n_hits]
+        """
+        column = self.data.get_column(name)
+        if name in self.data.event_branches:
+            return column[event_ids][rows]
+        return column[hit_ids]
+
+    def _get_batch_values(self, measurement, event_ids, rows, hit_ids):
+        """
+        Returns the requested measurement for the hits of a batch of events,
+        see _get_batch_hits and SignalHits.measurements
+
+        :return: numpy.array of shape [n_hits]
+        """
+        def branch(leaf):
+            return self._get_batch_branch(self.prefix + leaf, event_ids, rows,
+                                          hit_ids)
+        if measurement == "hit_vector":
+            return np.ones(len(hit_ids))
+        if measurement == "energy_deposits":
+            return branch("_edep").astype(float)
+        if measurement == "hit_time":
+            return branch("_tstart").astype(float)
+        if measurement == "trigger_time":
+            return branch("_mt").astype(float)
+        if measurement == "relative_time":
+            return np.remainder(branch("_tstart").astype(float) - branch("_mt"),
+                                1170)
+        if measurement == "hit_types":
+            # Maps signal to 1, background to 2
+            return np.take([1, 2, 2, 2], branch("_hittype"))
+        raise ValueError("Unknown measurement {}".format(measurement))
+
+    # Measurements available from get_measurements, each one named after the
+    # single event method returning it
+    measurements = ["hit_vector", "energy_deposits", "hit_time",
+                    "trigger_time", "relative_time", "hit_types",
+                    "time_neighbours_metric"]
+
+    def get_hit_matrix(self, event_ids, names=None):
+        """
+        Returns the requested measurements of a batch of events as a
+        events.HitMatrix, which holds the values of the hit wires only.  The
+        wire_ids of the hits are found once for all the events.  Each
+        measurement has the values of the corresponding single event method,
+        e.g. "energy_deposits" those of get_energy_deposits, for each event.
+
+        :param event_ids: array, list or slice of event_ids, or one event_id
+        :param names: names of the measurements, from SignalHits.measurements,
+                      all by default
+        :return: events.HitMatrix with one row per event
+        """
+        if names is None:
+            names = self.measurements
+        event_ids, rows, hit_ids = self._get_batch_hits(event_ids)
+        # Flatten the hits into the point_ids from the cydet
+        wire_index = self.data.get_column(self.prefix + "_cellID")[hit_ids]
+        layer_ids = self.data.get_column(self.prefix + "_layerID")[hit_ids]
+        wire_ids = self.cydet.point_lookup[layer_ids, wire_index]
+        assert np.all(wire_ids >= 0), \
+            'Wrong id of wire here {} {}'.format(layer_ids[wire_ids < 0],
+                                                 wire_index[wire_ids < 0])
+        # The time neighbours metric is built from the hit times of the event
+        with_metric = "time_neighbours_metric" in names
+        batch_names = [name for name in names
+                       if name != "time_neighbours_metric"]
+        if with_metric and "hit_time" not in batch_names:
+            batch_names.append("hit_time")
+        columns = dict((name, self._get_batch_values(name, event_ids, rows,
+                                                     hit_ids))
+                       for name in batch_names)
+        # Keep the last hit on each wire, as the single event methods do
+        hit_matrix = HitMatrix.from_hits(self.cydet.n_points, event_ids, rows,
+                                         wire_ids, columns)
+        if with_metric:
+            hit_matrix.add_column("time_neighbours_metric",
+                                  self._get_time_neighbours_values(
+                                      hit_matrix, rows, wire_ids))
+            if "hit_time" not in names:
+                del hit_matrix.columns["hit_time"]
+        return hit_matrix
+
+    def _get_time_neighbours_values(self, hit_matrix, rows, wire_ids):
+        """
+        Returns the time neighbours metric of the hits of a HitMatrix, see
+        get_time_neighbours_metric.  Each hit of the data adds the ratio of
+        times with its left then its right neighbour, taken from
+        CyDet.lr_neighbours, so that wires hit several times add them several
+        times.  The terms are summed in that order, which gives the exact
+        values of summing them one at a time.
+
+        :param hit_matrix: events.HitMatrix with the "hit_time" measurement
+        :param rows: numpy.array of the row of each hit of the data
+        :param wire_ids: numpy.array of the wire_id of each hit of the data
+        :return: numpy.array of shape [hit_matrix.n_hits]
+        """
+        neighbours = self.cydet.lr_neighbours
+        starts = neighbours.indptr[wire_ids]
+        counts = neighbours.indptr[wire_ids + 1] - starts
+        pair_hits = np.repeat(np.arange(len(wire_ids)), counts)
+        pair_starts = np.cumsum(counts) - counts
+        pair_wires = neighbours.indices[np.arange(counts.sum()) +
+                                        np.repeat(starts - pair_starts, counts)]
+        # Take the neighbour one step counter-clockwise first, then the one
+        # clockwise, as cydet.shift_wires(wire_ids, 1) and -1 would give
+        hit_wires = wire_ids[pair_hits]
+        n_in_layer = np.asarray(self.cydet.n_by_layer)[
+            self.cydet.point_layer[hit_wires]]
+        steps = (self.cydet.point_index[pair_wires] -
+                 self.cydet.point_index[hit_wires]) % n_in_layer
+        order = np.lexsort((steps, pair_hits))
+        pair_hits, pair_wires = pair_hits[order], pair_wires[order]
+        pair_rows = rows[pair_hits]
+        # Find the times of the hit and of its neighbour, zero if not hit
+        times = hit_matrix.get_column("hit_time")
+        hit_place = hit_matrix.get_hit_lookup(pair_rows, wire_ids[pair_hits])
+        neigh_place = hit_matrix.get_hit_lookup(pair_rows, pair_wires)
+        neigh_times = np.where(neigh_place >= 0, times[neigh_place], 0.)
+        t_metric = abs((neigh_times + 1) / (times[hit_place] + 1))
+        return np.bincount(hit_place, weights=t_metric,
+                           minlength=hit_matrix.n_hits)
+
+    def _get_event_measurement(self, event_id, name):
+        """
+        Returns the requested measurement in all wires in requested event, see
+        SignalHits.measurements
+
+        :return: numpy.array of shape [CyDet.n_points]
+        """
+        return self.get_hit_matrix(event_id, [name]).get_dense(name)[0]
+
+    def get_measurements(self, event_ids, names=None, sparse=False):
+        """
+        Returns the requested measurements of a batch of events at once, see
+        get_hit_matrix
+
+        :param event_ids: array, list or slice of event_ids
+        :param names: names of the measurements, from SignalHits.measurements,
+                      all by default
+        :param sparse: if true, return scipy.sparse.csr_matrix with values
+                       stored for hit wires only, instead of numpy.array
+        :return: dict of measurement name to array of shape
+                 [n_events, CyDet.n_points]
+        """
+        hit_matrix = self.get_hit_matrix(event_ids, names)
+        if sparse:
+            return dict((name, hit_matrix.get_csr(name))
+                        for name in hit_matrix.names)
+        return dict((name, hit_matrix.get_dense(name))
+                    for name in hit_matrix.names)
+
+    def get_dataset_key(self):
+        """
+        Returns a hash identifying the events, which changes when the data is
+        rewritten, see cache.file_version.  It is found when the data is
+        opened, and a rewritten data needs new SignalHits.
+
+        :return: hexadecimal string
+        """
+        return self.dataset_key
 
 
 class AllHits(SignalHits):
-    def __init__(self, path="../data/signal_TDR.root", tree='tree'):
-        cydet = CyDet()
+    def __init__(self, path="../data/signal_TDR.root", tree='tree', cache=None):
+        cydet = CyDet(cache=cache)
         SignalHits.__init__(self, cydet, path, tree)
 
 
@@ -230,7 +382,8 @@ class BackgroundHits(object):
     # pylint: disable=bad-continuation
     # pylint: disable=relative-import
     def __init__(self, cydet, path="../data/proton_from_muon_capture",
-                 tree='tree', hits=1000):
+                 tree='tree', hits=1000, draw_size=32, sample_cache=None,
+                 max_hits=None):
         """
         This generates hit data from a file in which both only background hits
         exist. It resamples the input file until to generate events with the
@@ -239,63 +392,139 @@ class BackgroundHits(object):
         define its geometry. Note that n_events here refers to the number of
         events used in resampling process.
 
-        :param path: path to rootfile
+        :param path: path to rootfile, or to a columnar store of it (see
+                     columnar.convert)
         :param tree: name of the tree in root dataset
-        """
-
-        self.data = root2array(path, treename=tree)
+        :param hits: number of hits to resample in each generated event
+        :param draw_size: number of source events drawn at once from the random
+                          stream of a generated event
+        :param sample_cache: cache.LRUCache of the generated events, keyed by
+                             the source data and draw_size, see
+                             get_source_key, the event_id and the number of
+                             hits drawn, so that it can be shared between
+                             instances.  By default, the last 64 generated
+                             events are kept.
+        :param max_hits: if set, events are generated once with max_hits hits
+                         and those of fewer hits are taken from them, which
+                         gives the same events for any n_hits up to max_hits
+        """
+
+        self.data = open_events(path, tree=tree)
         self.cydet = cydet
         self.prefix = "O"
         self.n_events = len(self.data)
-        self.evt_random = Random()
         self.n_hits = hits
-        initial_event = 0
-        self.this_sample = 0
-        self.event_index = 10
-        self._get_sample(initial_event)
+        self.max_hits = max_hits
+        self.draw_size = draw_size
+        # Hash of the source data, found once as it reads the files of the
+        # data, see get_source_key
+        self.source_key = hash_key("BackgroundHits",
+                                   file_version(self.data.path), self.prefix,
+                                   self.draw_size)
+        # Find the wire_ids of all the hits of the data once
+        self.hit_offsets = self.data.get_offsets(self.prefix + "_cellID")
+        self.hit_counts = np.diff(self.hit_offsets)
+        self.all_wires = self._get_all_wires()
+        assert self.hit_counts.sum() > 0, \
+            'No hits to resample in {}'.format(path)
+        if sample_cache is None:
+            sample_cache = LRUCache(max_entries=64)
+        self.sample_cache = sample_cache
+        # Hits of the last requested event
+        self.sample_events = np.zeros(0, dtype=int)
+        self.sample_hits = np.zeros(0, dtype=int)
+        self.sample_wires = np.zeros(0, dtype=int)
+
+    def _get_all_wires(self):
+        """
+        Returns the wire_id of each hit in the data
+
+        :return: numpy.array of shape [n_hits in data]
+        """
+        wire_index = np.asarray(self.data.get_hits(self.prefix + "_cellID"))
+        layer_ids = np.asarray(self.data.get_hits(self.prefix + "_layerID"))
+        wire_ids = self.cydet.point_lookup[layer_ids, wire_index]
+        assert np.all(wire_ids >= 0), \
+            'Wrong id of wire here {} {}'.format(layer_ids[wire_ids < 0],
+                                                 wire_index[wire_ids < 0])
+        return wire_ids
+
+    def _draw_sample(self, event_id, n_hits):
+        """
+        Resamples the data into a full event.  The event_id is used as a
+        random number seed for reproducibility.  Source events and their
+        rotations are drawn draw_size at a time, until the drawn events hold at
+        least n_hits hits.  All their hits are then rotated at once.
+
+        Events are drawn in the same order whatever n_hits, so that the
+        sample of fewer hits is the beginning of the sample of more hits.
+
+        :return: tuple of numpy.arrays
+         - the index of its source event in the data, for each resampled hit
+         - its hit_id in the concatenated hits of the data, for each hit
+         - its new wire_id in the generated event, which is the original wire
+           rotated by the random value of its source event, for each hit
+         - the number of resampled hits up to each drawn event included
+        """
+        random = np.random.RandomState(event_id)
+        events = np.zeros(0, dtype=int)
+        rotations = np.zeros(0)
+        total = np.zeros(0, dtype=int)
+        while n_hits > 0 and (not len(total) or total[-1] < n_hits):
+            events = np.append(events, random.randint(0, self.n_events,
+                                                      size=self.draw_size))
+            rotations = np.append(rotations,
+                                  random.random_sample(self.draw_size))
+            total = np.cumsum(self.hit_counts[events])
+        # Keep the events up to the first one reaching n_hits
+        n_used = np.searchsorted(total, n_hits) + 1 if n_hits > 0 else 0
+        events, rotations = events[:n_used], rotations[:n_used]
+        counts = self.hit_counts[events]
+        hit_ids = get_hit_ids(self.hit_offsets[events], counts)
+        # Rotate the wires a random amount around the layer
+        new_wires = self.cydet.rotate_wires(self.all_wires[hit_ids],
+                                            np.repeat(rotations, counts))
+        return np.repeat(events, counts), hit_ids, new_wires, np.cumsum(counts)
+
+    def _fetch_sample(self, event_id, n_hits):
+        """
+        Returns the generated event of at least n_hits hits, see _draw_sample,
+        unless it is in the sample_cache.  If max_hits is set, the event is
+        generated with max_hits hits, so that the events of all n_hits up to
+        max_hits are found from it.
+
+        :return: dict of read only numpy.arrays
+        """
+        n_drawn = max(n_hits, self.max_hits or 0)
+
+        def draw():
+            names = ["events", "hits", "wires", "ends"]
+            return dict(zip(names, self._draw_sample(event_id, n_drawn)))
+        return self.sample_cache.fetch(
+            (self.source_key, event_id, n_drawn), draw)
+
+    def _use_sample(self, sample, n_hits):
+        """
+        Selects the hits of a generated event of n_hits hits, which are the
+        first hits of a sample of at least n_hits hits from _fetch_sample
+
+        Generates to internal fields sample_events, sample_hits and
+        sample_wires, which are read only
+        """
+        ends = sample["ends"]
+        n_used = ends[np.searchsorted(ends, n_hits)] if n_hits > 0 else 0
+        self.sample_events = sample["events"][:n_used]
+        self.sample_hits = sample["hits"][:n_used]
+        self.sample_wires = sample["wires"][:n_used]
 
     def _get_sample(self, event_id):
         """
-        Generates a scipy sparce matrix respresenting a full event, constructed
-        from resampled events.The event_id is used as a random number seed for
-        reproducibility.  The generated matrix maps from resampled event index
-        and hit wire, to hit wire location in fully construced event
-
-        Generates to internal field
-
-         scipy.sparse.csr of shape [n_events, CyDet.n_points] which
-         defines the events used and corresponding hit wires in them.
-         The value of the matrix is the new hit wire in the
-         reconstructed event, which is the original hit rotated by a
-         random value
-        """
-        if self.event_index != event_id:
-            # otherwise everything was done previously and cached
-            print "Getting sample {}".format(event_id)
-            self.this_sample = lil_matrix((self.n_events, self.cydet.n_points),
-                                          dtype=np.int16)
-            # Seed the random number
-            self.evt_random.seed(event_id)
-            # Keep track of how many wires have been added from the samples
-            n_wires = 0
-            while n_wires < self.n_hits:
-                # Select an event randomly
-                this_event = self.evt_random.randint(0, self.n_events - 1)
-                # Find the hit wires in the event
-                wires = self.get_wires(this_event)
-                # Add these to the total count
-                n_wires += len(wires)
-                # Rotate the wires a random amount around the layer
-                rot = self.evt_random.random()
-                new_wires = [self.cydet.rotate_wire(w, rot) for w in wires]
-                # Add one to all new wire indecies to avoid problem with
-                # explicit zeros in numpy.sparse matrix
-                new_wires = [n_w + 1 for n_w in new_wires]
-                # Mark event for use in sample
-                self.this_sample[this_event, wires] = new_wires
-            # Return a row sliceable array
-            self.this_sample = self.this_sample.tocsr()
-            self.event_index = event_id
+        Generates the hits of a full event of n_hits hits, see _fetch_sample
+
+        Generates to internal fields sample_events, sample_hits and
+        sample_wires, which are read only
+        """
+        self._use_sample(self._fetch_sample(event_id, self.n_hits), self.n_hits)
 
     def get_hit_wires(self, event_id):
         """
@@ -304,8 +533,7 @@ class BackgroundHits(object):
         :return: numpy array of hit wires
         """
         self._get_sample(event_id)
-        hit_wires = find(self.this_sample)[2]
-        return np.unique(hit_wires)
+        return np.unique(self.sample_wires)
 
     def _get_true_wires(self, event_id):
         """
@@ -314,8 +542,7 @@ class BackgroundHits(object):
         :return: numpy array of hit wires
         """
         self._get_sample(event_id)
-        true_wires = find(self.this_sample)[1]
-        return np.unique(true_wires)
+        return np.unique(self.all_wires[self.sample_hits])
 
     def _get_sample_events(self, event_id):
         """
@@ -325,13 +552,12 @@ class BackgroundHits(object):
         :return: numpy array of event_ids
         """
         self._get_sample(event_id)
-        sample_events = find(self.this_sample)[0]
-        return np.unique(sample_events)
+        return np.unique(self.sample_events)
 
     def _get_new_wire_ids(self, event_id, event_index):
         """
-        Function to mask the use of shifting the new wire_ids when stored in the
-        sparse matrix to avoid problem with explicit zero
+        Returns the new wire_ids of the hits of a resampled event
+
         :param event_id: id of generated event
         :param event_index: index of sampled event in data file
 
@@ -339,8 +565,7 @@ class BackgroundHits(object):
                  data corresponds to the hit wires in event_index
         """
         self._get_sample(event_id)
-        new_wires = find(self.this_sample[event_index, :])[2] - 1
-        return new_wires
+        return self.sample_wires[self.sample_events == event_index]
 
     def get_wires(self, event_index):
         """
@@ -349,17 +574,8 @@ class BackgroundHits(object):
 
         :return: numpy array of hit wires
         """
-        # Select the relevant sampled event
-        event = self.data[event_index]
-        # Select the relevant sampled event
-        wire_index = event[self.prefix + "_cellID"]
-        layer_ids = event[self.prefix + "_layerID"]
-        # Get the relevant wire_ids
-        wire_ids = self.cydet.point_lookup[layer_ids, wire_index]
-        assert np.all(wire_ids >= 0), \
-            'Wrong id of wire here {} {}'.format(layer_ids[wire_ids < 0],
-                                                 wire_index[wire_ids < 0])
-        return wire_ids
+        first, last = self.hit_offsets[event_index:event_index + 2]
+        return self.all_wires[first:last]
 
     def get_energy_deposits(self, event_id):
         """
@@ -368,44 +584,125 @@ class BackgroundHits(object):
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        energy_deposit = np.zeros(self.cydet.n_points)
-        # Loop over the resampled events
-        for event_index in self._get_sample_events(event_id):
-            # Get the reampled event data
-            event = self.data[event_index]
-            # Get the wire_id's of the rotated wires using the sample map
-            wire_ids = self._get_new_wire_ids(event_id, event_index)
-            # Get the energy deposition of the true hit wires
-            measurement = event[self.prefix + "_edep"]
-            energy_deposit[wire_ids] += measurement
-        return energy_deposit
+        hit_matrix = self.get_hit_matrix(event_id, ["energy_deposits"])
+        return hit_matrix.get_dense("energy_deposits")[0]
 
     def get_hit_time(self, event_id):
         """
-        Returns the energy deposition in each wire by taking the timing of the
+        Returns the hit time in each wire by taking the timing of the
         earliest hit from the resampled event that contibuted to the
         corresponding hit in the generated event
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        time_hit = np.zeros(self.cydet.n_points)
-        # Loop over the resampled events
-        for event_index in self._get_sample_events(event_id):
-            # Get the reampled event data
-            event = self.data[event_index]
-            # Get the wire_id's of the rotated wires using the sample map
-            wire_ids = self._get_new_wire_ids(event_id, event_index)
-            # Get the timing of the true hit wires
-            timing = event[self.prefix + "_t"] % 1170
-            # Noting that (timing) and (wire_ids) have corresponding order, open
-            # a loop over the wires, noting the index in the wire_ids list
-            # itself
-            for place, wire in enumerate(wire_ids):
-                # If this wire's entry has not been assigned, or if it is
-                # greater that the new value, assign the new value
-                if (time_hit[wire] == 0) | (time_hit[wire] > timing[place]):
-                    time_hit[wire] = timing[place]
-        return time_hit
+        hit_matrix = self.get_hit_matrix(event_id, ["hit_time"])
+        return hit_matrix.get_dense("hit_time")[0]
+
+    # Measurements available from get_hit_matrix, each one named after the
+    # single event method returning it
+    measurements = ["hit_vector", "energy_deposits", "hit_time"]
+
+    def _get_sample_values(self, measurement):
+        """
+        Returns the requested measurement for each hit of the last requested
+        event, see _get_sample
+
+        :return: numpy.array of shape [n_hits in sample]
+        """
+        if measurement == "hit_vector":
+            return np.ones(len(self.sample_hits))
+        if measurement == "energy_deposits":
+            deposits = self.data.get_hits(self.prefix + "_edep")
+            return deposits[self.sample_hits].astype(float)
+        if measurement == "hit_time":
+            times = self.data.get_hits(self.prefix + "_t")
+            return times[self.sample_hits].astype(float) % 1170
+        raise ValueError("Unknown measurement {}".format(measurement))
+
+    def get_hit_matrix(self, event_ids, names=None):
+        """
+        Returns the requested measurements of a batch of generated events as a
+        events.HitMatrix, which holds the values of the hit wires only.  The
+        resampled hits of all the events are reduced at once on their new
+        wires, summing the energy deposits and keeping the earliest time.
+
+        :param event_ids: array or list of event_ids, or one event_id
+        :param names: names of the measurements, from
+                      BackgroundHits.measurements, all by default
+        :return: events.HitMatrix with one row per event
+        """
+        return self.get_sweep_hit_matrices(event_ids, [self.n_hits],
+                                           names)[0]
+
+    def get_sweep_hit_matrices(self, event_ids, hit_counts, names=None):
+        """
+        Returns the requested measurements of a batch of generated events for
+        several numbers of hits, see get_hit_matrix.  Each event is generated
+        once with the largest number of hits, and those with fewer hits are
+        its first hits.
+
+        :param event_ids: array or list of event_ids, or one event_id
+        :param hit_counts: list of numbers of hits of the generated events
+        :param names: names of the measurements, from
+                      BackgroundHits.measurements, all by default
+        :return: list of events.HitMatrix with one row per event, one for
+                 each number of hits
+        """
+        if names is None:
+            names = self.measurements
+        event_ids = np.atleast_1d(event_ids)
+        max_hits = max(hit_counts)
+        pieces = [{"rows": [], "wires": [],
+                   "columns": dict((name, []) for name in names)}
+                  for _ in hit_counts]
+        for row, event_id in enumerate(event_ids.tolist()):
+            sample = self._fetch_sample(event_id, max_hits)
+            for n_hits, piece in zip(hit_counts, pieces):
+                self._use_sample(sample, n_hits)
+                piece["rows"].append(np.full(len(self.sample_wires), row,
+                                             dtype=int))
+                piece["wires"].append(self.sample_wires)
+                for name in names:
+                    piece["columns"][name].append(
+                        self._get_sample_values(name))
+        return [self._reduce_hits(event_ids, **piece) for piece in pieces]
+
+    def get_source_key(self):
+        """
+        Returns a hash identifying how the events are generated, from the
+        source data and the draw size, which changes when the data is
+        rewritten but not with the number of hits, see _fetch_sample.  It is
+        found when the data is opened, so that fetching an event reads no
+        file.
+
+        :return: hexadecimal string
+        """
+        return self.source_key
+
+    def get_dataset_key(self):
+        """
+        Returns a hash identifying the generated events, which changes when the
+        data is rewritten or the number of hits changes
+
+        :return: hexadecimal string
+        """
+        return hash_key(self.source_key, self.n_hits)
+
+    def _reduce_hits(self, event_ids, rows, wires, columns):
+        """
+        Returns the HitMatrix of lists of resampled hits, summing the energy
+        deposits and keeping the earliest time on each wire
+
+        :return: events.HitMatrix
+        """
+        columns = dict((name, np.concatenate(values) if values else
+                        np.zeros(0)) for name, values in columns.items())
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+        wires = np.concatenate(wires) if wires else np.zeros(0, dtype=int)
+        return HitMatrix.from_hits(self.cydet.n_points, event_ids, rows, wires,
+                                   columns,
+                                   reductions={"energy_deposits": "sum",
+                                               "hit_time": "min"})
 
 
 class ResampledHits(object):
@@ -414,7 +711,8 @@ class ResampledHits(object):
     # pylint: disable=relative-import
     def __init__(self, sig_path="../data/signal.root", sig_tree='tree',
                  bkg_path="../data/proton_from_muon_capture_bg.root",
-                 bkg_tree='tree', occupancy=0.10):
+                 bkg_tree='tree', occupancy=0.10, cache=None,
+                 sample_cache=None, store_path=None, max_occupancy=None):
         """
         This generates hit data from a file in which both background and signal
         are included and coded. It assumes the naming convention
@@ -423,15 +721,197 @@ class ResampledHits(object):
 
         :param path: path to rootfile
         :param tree: name of the tree in root dataset
-        """
-
-        self.cydet = CyDet()
+        :param cache: optional cache.DiskCache of the CyDet geometry
+        :param sample_cache: optional cache.LRUCache of the generated
+                             background events, see BackgroundHits
+        :param store_path: optional (chunked) columnar store of events
+                           generated beforehand by resample.py, which are then
+                           read instead of generated.  The signal and
+                           background paths and the occupancy are not used.
+                           Events are still selected by the event_ids of
+                           their signal events, and event_ids lists those of
+                           the store, which need not start from 0.
+        :param max_occupancy: if set, the background of each event is
+                              generated once at max_occupancy, and that of any
+                              lower occupancy is taken from it, see
+                              set_occupancy and get_occupancy_sweep
+        """
+
+        self.cydet = CyDet(cache=cache)
+        if store_path is not None:
+            self.store = open_events(store_path)
+            self.store_key = hash_key("ResampledHits",
+                                      file_version(self.store.path))
+            self.sig_hits = None
+            self.bkg_hits = None
+            self.n_events = len(self.store)
+            self.event_ids = np.array(self.store.get_column("event_id"),
+                                      dtype=int)
+            self._store_order = np.argsort(self.event_ids, kind='mergesort')
+            return
+        self.store = None
+        self.store_key = None
         self.sig_hits = SignalHits(self.cydet, path=sig_path, tree=sig_tree)
-        self.bkg_hits = BackgroundHits(self.cydet, path=bkg_path, tree=bkg_tree)
+        self.bkg_hits = BackgroundHits(self.cydet, path=bkg_path, tree=bkg_tree,
+                                       sample_cache=sample_cache)
         self.n_events = self.sig_hits.n_events
+        self.event_ids = self.sig_hits.event_ids
         self.event_index = 0
-        total_bkg_hits = round(occupancy * self.cydet.n_points)
-        self.bkg_hits.n_hits = total_bkg_hits
+        if max_occupancy is not None:
+            self.bkg_hits.max_hits = self._get_n_hits(max_occupancy)
+        self.set_occupancy(occupancy)
+
+    def _get_n_hits(self, occupancy):
+        """
+        Returns the number of background hits of the given occupancy
+        """
+        return int(round(occupancy * self.cydet.n_points))
+
+    def set_occupancy(self, occupancy):
+        """
+        Sets the occupancy of the background of the following events.  Events
+        are reproducible for each occupancy, and the background of a lower
+        occupancy is always the beginning of that of a higher one.
+        """
+        assert self.store is None, 'Occupancy of a store cannot be changed'
+        self.occupancy = occupancy
+        self.bkg_hits.n_hits = self._get_n_hits(occupancy)
+
+    # Measurements available from get_hit_matrix, each one named after the
+    # single event method returning it
+    measurements = ["hit_vector", "energy_deposits", "hit_time", "hit_types"]
+
+    def get_hit_matrix(self, event_ids, names=None):
+        """
+        Returns the requested measurements of a batch of events as a
+        events.HitMatrix, which holds the values of the hit wires only.  The
+        hits of the signal events and of the generated background events are
+        merged, summing their energy deposits and keeping their earliest hit
+        time.  In the case of hit overlap between background and signal,
+        signal is given priority in the hit types.
+
+        :param event_ids: array, list or slice of event_ids, or one event_id
+        :param names: names of the measurements, from
+                      ResampledHits.measurements, all by default
+        :return: events.HitMatrix with one row per event
+        """
+        if names is None:
+            names = self.measurements
+        for name in names:
+            if name not in self.measurements:
+                raise ValueError("Unknown measurement {}".format(name))
+        if self.store is not None:
+            return self._read_hit_matrix(event_ids, names)
+        return self.get_occupancy_sweep(event_ids, [self.occupancy], names)[0]
+
+    def get_occupancy_sweep(self, event_ids, occupancies, names=None):
+        """
+        Returns the requested measurements of a batch of events for several
+        occupancies of the background, see get_hit_matrix.  The signal is read
+        once, and the background of each event is generated once at the
+        highest occupancy, the lower ones being the beginning of it.  The
+        events are the same as those of get_hit_matrix after set_occupancy.
+
+        :param event_ids: array, list or slice of event_ids, or one event_id
+        :param occupancies: list of occupancies of the background
+        :param names: names of the measurements, from
+                      ResampledHits.measurements, all by default
+        :return: list of events.HitMatrix with one row per event, one for
+                 each occupancy
+        """
+        if names is None:
+            names = self.measurements
+        for name in names:
+            if name not in self.measurements:
+                raise ValueError("Unknown measurement {}".format(name))
+        assert self.store is None, 'Occupancy of a store cannot be changed'
+        sig_matrix = self.sig_hits.get_hit_matrix(
+            event_ids, ["energy_deposits", "hit_time", "hit_types"])
+        bkg_names = [name for name in ["energy_deposits", "hit_time"]
+                     if name in names]
+        bkg_matrices = self.bkg_hits.get_sweep_hit_matrices(
+            sig_matrix.event_ids,
+            [self._get_n_hits(occupancy) for occupancy in occupancies],
+            bkg_names)
+        return [self._merge_hit_matrices(sig_matrix, bkg_matrix, bkg_names,
+                                         names)
+                for bkg_matrix in bkg_matrices]
+
+    def _merge_hit_matrices(self, sig_matrix, bkg_matrix, bkg_names, names):
+        """
+        Returns the requested measurements of the signal and background hits
+        merged, see get_hit_matrix
+
+        :param bkg_names: measurements of the background HitMatrix
+        :return: events.HitMatrix
+        """
+        wires = np.append(sig_matrix.wires, bkg_matrix.wires)
+        rows = np.append(sig_matrix.get_rows(), bkg_matrix.get_rows())
+        columns = {"hit_vector": np.ones(len(wires))}
+        for name in bkg_names:
+            columns[name] = np.append(sig_matrix.get_column(name),
+                                      bkg_matrix.get_column(name))
+        columns["hit_types"] = np.append(sig_matrix.get_column("hit_types"),
+                                         np.full(bkg_matrix.n_hits, 2,
+                                                 dtype=int))
+        return HitMatrix.from_hits(
+            self.cydet.n_points, sig_matrix.event_ids, rows, wires,
+            dict((name, columns[name]) for name in names),
+            reductions={"energy_deposits": "sum", "hit_time": "min",
+                        "hit_types": "min"})
+
+    def _get_store_rows(self, event_ids):
+        """
+        Returns the rows of the store holding the events of the given signal
+        event_ids
+
+        :param event_ids: array, list or slice of event_ids, or one event_id.
+                          A slice selects among the event_ids of the store.
+        :return: numpy.array of rows
+        """
+        if isinstance(event_ids, slice):
+            event_ids = self.event_ids[event_ids]
+        event_ids = np.atleast_1d(np.asarray(event_ids, dtype=int))
+        sorted_ids = self.event_ids[self._store_order]
+        places = np.searchsorted(sorted_ids, event_ids)
+        places = np.minimum(places, len(sorted_ids) - 1)
+        found = sorted_ids[places] == event_ids
+        if not np.all(found):
+            raise KeyError("Events {} are not in {}".format(
+                event_ids[~found], self.store.path))
+        return self._store_order[places]
+
+    def _read_hit_matrix(self, event_ids, names):
+        """
+        Returns the requested measurements of a batch of events read from the
+        store of events generated beforehand, see get_hit_matrix
+
+        :return: events.HitMatrix with one row per event
+        """
+        rows = self._get_store_rows(event_ids)
+        stored = [name for name in names if name != "hit_vector"]
+        counts, columns = self.store.get_batch(
+            rows, ["wires", "event_id"] + stored)
+        wires = columns.pop("wires")
+        signal_ids = columns.pop("event_id")
+        if "hit_vector" in names:
+            columns["hit_vector"] = np.ones(len(wires))
+        indptr = np.zeros(len(rows) + 1, dtype=int)
+        np.cumsum(counts, out=indptr[1:])
+        return HitMatrix(self.cydet.n_points, signal_ids, indptr, wires,
+                         columns)
+
+    def get_dataset_key(self):
+        """
+        Returns a hash identifying the events, from the signal and background
+        data and the occupancy, or from the store they are read from
+
+        :return: hexadecimal string
+        """
+        if self.store is not None:
+            return self.store_key
+        return hash_key("ResampledHits", self.sig_hits.get_dataset_key(),
+                        self.bkg_hits.get_dataset_key())
 
     def get_hit_wires(self, event_id):
         """
@@ -439,10 +919,7 @@ class ResampledHits(object):
 
         :return: numpy array of hit wires
         """
-        sig_wires = self.sig_hits.get_hit_wires(event_id)
-        bkg_wires = self.bkg_hits.get_hit_wires(event_id)
-        wire_ids = np.append(sig_wires, bkg_wires)
-        return np.unique(wire_ids)
+        return self.get_hit_matrix(event_id, ["hit_vector"]).wires
 
     def get_energy_deposits(self, event_id):
         """
@@ -450,10 +927,18 @@ class ResampledHits(object):
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        sig_energy = self.sig_hits.get_energy_deposits(event_id)
-        bkg_energy = self.bkg_hits.get_energy_deposits(event_id)
-        energy = sig_energy + bkg_energy
-        return energy
+        hit_matrix = self.get_hit_matrix(event_id, ["energy_deposits"])
+        return hit_matrix.get_dense("energy_deposits")[0]
+
+    def get_hit_time(self, event_id):
+        """
+        Returns the earliest hit time in all wires, from either the signal or
+        the background hits
+
+        :return: numpy.array of shape [CyDet.n_points]
+        """
+        hit_matrix = self.get_hit_matrix(event_id, ["hit_time"])
+        return hit_matrix.get_dense("hit_time")[0]
 
     def get_sig_wires(self, event_id):
         """
@@ -462,8 +947,8 @@ class ResampledHits(object):
 
         :return: numpy array of signal hit wires
         """
-        sig_wires = self.sig_hits.get_sig_wires(event_id)
-        return sig_wires
+        hit_matrix = self.get_hit_matrix(event_id, ["hit_types"])
+        return hit_matrix.wires[hit_matrix.get_column("hit_types") == 1]
 
     def get_bkg_wires(self, event_id):
         """
@@ -473,10 +958,8 @@ class ResampledHits(object):
         :return: numpy array of signal hit wires
         """
         # Signal sample actually also has BG hits in it already
-        bkg_wires = np.append(self.bkg_hits.get_hit_wires(event_id),
-                              self.sig_hits.get_bkg_wires(event_id))
-        bkg_wires = set(bkg_wires) - set(self.get_sig_wires(event_id))
-        return np.array(list(bkg_wires))
+        hit_matrix = self.get_hit_matrix(event_id, ["hit_types"])
+        return hit_matrix.wires[hit_matrix.get_column("hit_types") == 2]
 
     def get_hit_types(self, event_id):
         """
@@ -487,7 +970,5 @@ class ResampledHits(object):
 
         :return: numpy.array of shape [CyDet.n_points]
         """
-        result = np.zeros(self.cydet.n_points, dtype=int)
-        result[self.get_bkg_wires(event_id)] = 2
-        result[self.get_sig_wires(event_id)] = 1
-        return result.astype(int)
+        hit_matrix = self.get_hit_matrix(event_id, ["hit_types"])
+        return hit_matrix.get_dense("hit_types")[0]
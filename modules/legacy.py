@@ -0,0 +1,120 @@
+import math
+import numpy as np
+from scipy.sparse import lil_matrix, diags
+from scipy.spatial.distance import cdist
+from cylinder import _round_half_away
+
+"""
+Reference implementations of the builders replaced by faster ones, evaluated
+one element at a time as they first were.  The tests compare the outputs of
+the new builders against them, and benchmarks.py measures the speed-up.
+"""
+
+
+def legacy_point_neighbours(geom):
+    """
+    Reference implementation of CylindricalArray._prepare_point_neighbours,
+    inserting the neighbour relations of each point one at a time.  Halves
+    are rounded away from zero as by the round of python 2, on any python.
+
+    :return: pair of scipy.sparse Compressed Sparse Row of shape
+             [n_points,n_points], all neighbours and left/right neighbours
+    """
+    neigh = lil_matrix((geom.n_points, geom.n_points))
+    lr_neigh = lil_matrix((geom.n_points, geom.n_points))
+    for lay, n_points in enumerate(geom.n_by_layer):
+        if lay == 0:
+            adjacent_layers = [lay + 1]
+        elif lay == len(geom.n_by_layer) - 1:
+            adjacent_layers = [lay - 1]
+        else:
+            adjacent_layers = [lay - 1, lay + 1]
+        for point_index in range(n_points):
+            point = point_index + geom.first_point[lay]
+            nxt_point = (point_index + 1) % n_points + geom.first_point[lay]
+            neigh[nxt_point, point] = 1
+            lr_neigh[nxt_point, point] = 1
+            neigh[point, nxt_point] = 1
+            lr_neigh[point, nxt_point] = 1
+            rel_pos = geom.point_phis[point] / (2 * math.pi)
+            for a_lay in adjacent_layers:
+                a_n_points = geom.n_by_layer[a_lay]
+                a_first = geom.first_point[a_lay]
+                a_point = rel_pos - (geom.phi0_by_layer[a_lay] / (2 * math.pi))
+                a_point *= a_n_points
+                a_point = int(_round_half_away(a_point))
+                a_point %= a_n_points
+                nxt_a_point = (a_point + 1) % a_n_points
+                prv_a_point = (a_point - 1) % a_n_points
+                neigh[point, a_point + a_first] = 1
+                neigh[point, nxt_a_point + a_first] = 1
+                neigh[point, prv_a_point + a_first] = 1
+    return neigh.tocsr(), lr_neigh.tocsr()
+
+
+def legacy_dist_prob(hough, distance):
+    """
+    Reference implementation of Hough.dist_prob, for one distance at a time
+
+    :return: Gaussian of distance
+    """
+    distance -= hough.sig_rho
+    # Lower radii return a fitted gaussian function
+    if distance < 0:
+        return math.exp(-(distance**2)/(2.*(hough.sig_rho_sgma**2))) + 0.05
+    # Higher radii retun a linear decrease to just over the max value
+    return 1.05 - distance/(hough.sig_rho_max - hough.sig_rho + 0.1)
+
+
+def legacy_wire_track_correspondence(hough):
+    """
+    Reference implementation of Hough._prepare_wire_track_correspondence,
+    evaluating each pair of track center and wire one at a time from the
+    dense matrix of their distances
+
+    :return: scipy.sparse Compressed Sparse Row of shape [n_wires,n_tracks]
+    """
+    cydet = hough.hit_data.cydet
+    wire_xy = np.column_stack((cydet.point_x, cydet.point_y))
+    trck_xy = np.column_stack((hough.track.point_x, hough.track.point_y))
+    distances = cdist(wire_xy, trck_xy)
+    corsp = lil_matrix(distances.shape)
+    for trck in range(distances.shape[1]):
+        for wire in range(distances.shape[0]):
+            this_dist = distances[wire, trck]
+            if (this_dist <= hough.sig_rho_max) and \
+               (this_dist >= hough.sig_rho_min):
+                corsp[wire, trck] = legacy_dist_prob(hough, this_dist)
+    return corsp.tocsr()
+
+
+def legacy_prepare_hough(hough, wire_probabilities, alpha=2.):
+    """
+    Reference implementation of Hough.get_even_odd_predictions, the
+    prepare_hough of LocalBasedFiltering.ipynb with separate matrices for
+    the even and odd layers
+
+    :return: tuple of the inverse transforms of the even and odd layers, and
+             of the reweighted scores of the odd and even layers
+    """
+    odd = (hough.hit_data.cydet.point_pol == 1).astype(float)
+    results = []
+    for mask in [1. - odd, odd]:
+        forward = hough.correspondence.T.dot(diags(mask)).tocsr()
+        inverse = forward.T.copy()
+        norms = np.asarray(abs(forward).sum(axis=1)).ravel()
+        norms[norms == 0] = 1.
+        forward = diags(1. / norms).dot(forward)
+        reweighted = np.exp(alpha * forward.dot(wire_probabilities.T))
+        results.append((inverse.dot(reweighted).T, reweighted.T))
+    return results[0][0], results[1][0], results[1][1], results[0][1]
+
+
+class GeometryOnly(object):
+    # pylint: disable=too-few-public-methods
+    """
+    Stands in for the hit data of a Hough transform, which only needs the
+    geometry of the detector
+    """
+    def __init__(self, cydet):
+        self.cydet = cydet
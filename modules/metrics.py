@@ -0,0 +1,38 @@
+import numpy as np
+
+"""
+Metrics of the classification of hits, in numpy so that they can be
+evaluated many times in parameter scans without going through scikit-learn
+"""
+
+
+def roc_auc(labels, scores, sample_weight=None):
+    """
+    Returns the area under the ROC curve, as roc_auc_score of sklearn.metrics
+    would, i.e. the weighted probability that a signal hit scores higher than
+    a background hit, ties counting one half
+
+    :param labels: numpy.array of shape [n_hits], 1 for signal, 0 for
+                   background
+    :param scores: numpy.array of shape [n_hits]
+    :param sample_weight: optional numpy.array of shape [n_hits]
+    :return: float
+    """
+    labels = np.asarray(labels) == 1
+    scores = np.asarray(scores, dtype=float)
+    if sample_weight is None:
+        sample_weight = np.ones(len(scores))
+    sample_weight = np.asarray(sample_weight, dtype=float)
+    # Group the hits by distinct scores, in increasing order
+    values, groups = np.unique(scores, return_inverse=True)
+    signal = np.bincount(groups, weights=sample_weight * labels,
+                         minlength=len(values))
+    background = np.bincount(groups, weights=sample_weight * ~labels,
+                             minlength=len(values))
+    total_signal, total_background = signal.sum(), background.sum()
+    if total_signal == 0 or total_background == 0:
+        raise ValueError("Only one class present in labels, the ROC AUC is "
+                         "not defined")
+    below = np.cumsum(background) - background
+    return np.sum(signal * (below + 0.5 * background)) / \
+        (total_signal * total_background)
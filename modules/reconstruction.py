@@ -0,0 +1,186 @@
+import timeit
+from collections import OrderedDict
+import numpy as np
+from events import HitMatrix
+
+"""
+Reconstruction chain of LocalBasedFiltering.ipynb as explicit stages, run on
+batches of events:
+
+ - hits: read the hit wires of the batch and their measurements
+ - classify: score the hit wires with a trained classifier.WireClassifier
+ - hough: Hough transforms of the scores of the hits of the even and of the
+   odd layers into track center scores
+ - inverse: reweight the track center scores by exp(alpha * score) and
+   transform them back onto the wires of their layers, as the prepare_hough
+   of the notebook, keeping the hit wires
+
+Only one batch is held in memory at a time, so that a whole dataset is run in
+memory bounded by batch_size, plus the hit level outputs that are kept.
+"""
+
+# Stages of the reconstruction, in order
+STAGES = ["hits", "classify", "hough", "inverse"]
+
+
+class Reconstruction(object):
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+    def __init__(self, hits, classifier, hough, alpha, norm="l1",
+                 batch_size=100, chunk_size=None):
+        """
+        Reconstruction of the hit wires of events, see the module docstring
+
+        :param hits: SignalHits or ResampledHits, whose events are read as
+                     events.HitMatrix batches with get_hit_matrix
+        :param classifier: trained classifier.WireClassifier
+        :param hough: tracking.Hough over the geometry of the hits
+        :param alpha: scaling of the exponent of the reweighting of the track
+                      center scores, which has no default as the best value
+                      depends on the classifier and on the Hough transform,
+                      the notebook scans 9 to 13, see Hough.scan_alphas
+        :param norm: normalization of the track centers of the forward Hough
+                     transform, see Hough.get_even_odd_correspondence
+        :param batch_size: number of events per batch
+        :param chunk_size: number of events per sparse product of the Hough
+                           transforms, the whole batch by default
+        """
+        self.hits = hits
+        self.classifier = classifier
+        self.hough = hough
+        self.alpha = alpha
+        self.norm = norm
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.measurements = classifier.get_measurements(hits.measurements)
+        # Wall time in seconds spent in each stage, see reset_timings
+        self.timings = OrderedDict()
+        self.n_events = 0
+        self.reset_timings()
+
+    def reset_timings(self):
+        """
+        Sets the time spent in each stage and the number of events processed
+        back to zero
+        """
+        self.timings = OrderedDict((stage, 0.) for stage in STAGES)
+        self.n_events = 0
+
+    def _timed(self, stage, function, *args):
+        """
+        Returns function(*args), adding its wall time to the stage
+        """
+        start = timeit.default_timer()
+        result = function(*args)
+        self.timings[stage] += timeit.default_timer() - start
+        return result
+
+    def get_timings(self, per_event=False):
+        """
+        Returns the time spent in each stage since the last reset_timings
+
+        :param per_event: if true, divide by the number of events processed
+        :return: OrderedDict of the seconds of each stage, and their "total"
+        """
+        timings = OrderedDict(self.timings)
+        timings["total"] = sum(self.timings.values())
+        if per_event:
+            for stage in timings:
+                timings[stage] /= max(self.n_events, 1)
+        return timings
+
+    def load(self, event_ids):
+        """
+        Returns the hits of a batch of events
+
+        :return: events.HitMatrix
+        """
+        return self.hits.get_hit_matrix(event_ids, self.measurements)
+
+    def classify(self, hit_matrix):
+        """
+        Adds the first and second stage scores of the classifier to the hits,
+        as the "wire_prob" and "signal_prob" columns
+        """
+        wire_probs, probs = self.classifier.predict_hit_matrix(
+            hit_matrix, self.hits.cydet)
+        hit_matrix.add_column("wire_prob", wire_probs)
+        hit_matrix.add_column("signal_prob", probs)
+
+    def transform(self, hit_matrix):
+        """
+        Returns the track center scores of the signal probabilities of the hits
+        of the even and of the odd layers
+
+        :return: numpy.array of shape [n_events, 2 * n_track_bin], see
+                 Hough.get_even_odd_scores
+        """
+        return self.hough.get_even_odd_scores(
+            hit_matrix.get_csr("signal_prob"), norm=self.norm,
+            chunk_size=self.chunk_size)
+
+    def invert(self, hit_matrix, scores):
+        """
+        Reweights the track center scores in place, and adds their inverse
+        Hough transforms onto the hits, as the "hough_even" and "hough_odd"
+        columns, and their sum, the Hough feature of the notebook, as the
+        "hough" column.  Each hit is only seen by the transform of its own
+        layer, so the other column is zero.
+        """
+        even_preds, odd_preds, _, _ = self.hough.get_even_odd_predictions(
+            hit_matrix.get_csr("signal_prob"), self.alpha, norm=self.norm,
+            chunk_size=self.chunk_size, scores=scores)
+        rows = hit_matrix.get_rows()
+        even = even_preds[rows, hit_matrix.wires]
+        odd = odd_preds[rows, hit_matrix.wires]
+        hit_matrix.add_column("hough_even", even)
+        hit_matrix.add_column("hough_odd", odd)
+        hit_matrix.add_column("hough", even + odd)
+
+    def process(self, event_ids):
+        """
+        Runs all stages on one batch of events
+
+        :return: tuple of the events.HitMatrix of the batch, with the
+                 "wire_prob", "signal_prob", "hough_even", "hough_odd" and
+                 "hough" columns, and the numpy.array of shape
+                 [n_events, 2 * n_track_bin] of the reweighted track center
+                 scores of the even and of the odd layers
+        """
+        hit_matrix = self._timed("hits", self.load, event_ids)
+        self._timed("classify", self.classify, hit_matrix)
+        scores = self._timed("hough", self.transform, hit_matrix)
+        self._timed("inverse", self.invert, hit_matrix, scores)
+        self.n_events += hit_matrix.n_events
+        return hit_matrix, scores
+
+    def iter_batches(self, event_ids=None):
+        """
+        Runs all stages on the events, batch by batch, see process
+
+        :param event_ids: event_ids of the events, all events by default
+        :return: generator of the results of process
+        """
+        if event_ids is None:
+            event_ids = self.hits.event_ids
+        event_ids = np.asarray(event_ids, dtype=int)
+        for start in range(0, len(event_ids), self.batch_size):
+            yield self.process(event_ids[start:start + self.batch_size])
+
+    def run(self, event_ids=None, names=("signal_prob", "hough")):
+        """
+        Runs all stages on the events and keeps the hit level outputs only, so
+        that memory scales with the number of hits rather than with the
+        number of track centers
+
+        :param event_ids: event_ids of the events, all events by default
+        :param names: columns of the hits to keep
+        :return: events.HitMatrix of the events with the named columns
+        """
+        batches = []
+        for hit_matrix, _ in self.iter_batches(event_ids):
+            batches.append(HitMatrix(
+                hit_matrix.n_wires, hit_matrix.event_ids, hit_matrix.indptr,
+                hit_matrix.wires,
+                dict((name, hit_matrix.get_column(name)) for name in names)))
+        return HitMatrix.concatenate(batches)
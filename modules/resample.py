@@ -0,0 +1,132 @@
+import os
+import sys
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from columnar import write_store, write_chunks_index, ChunkedEvents, \
+    open_events
+from hits import ResampledHits
+
+"""
+Generation of resampled events to disk, so that the mixing of signal and
+background is paid once rather than in every analysis loop.  Run as
+
+    python resample.py sig_path bkg_path store_path --occupancy 0.1
+
+to write a chunked columnar store of the mixed events, which is read back
+with ResampledHits(store_path=store_path).  The background of each event is
+seeded by the event_id of its signal event, as in ResampledHits, so the
+stored events do not depend on the number of processes or chunks.
+
+Each chunk is a columnar store with one row per event, holding the hit
+wires of the events in increasing order and their measurements.
+"""
+
+# Measurements of ResampledHits written for each hit
+STORED_MEASUREMENTS = ["energy_deposits", "hit_time", "hit_types"]
+# Arguments of ResampledHits recorded in the metadata of the store
+RECORDED_ARGUMENTS = ["sig_path", "sig_tree", "bkg_path", "bkg_tree",
+                      "occupancy"]
+
+# ResampledHits of the worker process, see _init_worker
+_worker_hits = None
+
+
+def _init_worker(hits_kwargs):
+    """
+    Opens the signal and background data once per worker process
+    """
+    global _worker_hits  # pylint: disable=global-statement
+    _worker_hits = ResampledHits(**hits_kwargs)
+
+
+def _write_chunk(chunk):
+    """
+    Generates the events of one chunk and writes them as a columnar store
+
+    :param chunk: tuple of the path of the chunk, and of the numpy.array of
+                  its event_ids
+    :return: path of the chunk
+    """
+    path, event_ids = chunk
+    hit_matrix = _worker_hits.get_hit_matrix(event_ids, STORED_MEASUREMENTS)
+    hit_columns = dict((name, hit_matrix.get_column(name))
+                       for name in STORED_MEASUREMENTS)
+    hit_columns["wires"] = hit_matrix.wires
+    write_store(path, hit_matrix.indptr, hit_columns,
+                {"event_id": hit_matrix.event_ids})
+    return path
+
+
+def generate(store_path, event_ids, chunk_size=100, processes=None,
+             **hits_kwargs):
+    """
+    Generates the resampled events and writes them as a chunked columnar
+    store
+
+    :param store_path: directory of the new store
+    :param event_ids: event_ids of the signal events to resample, in order
+    :param chunk_size: number of events per chunk
+    :param processes: number of worker processes, all cores by default
+    :param hits_kwargs: arguments of ResampledHits, e.g. sig_path, bkg_path
+                        and occupancy
+    :return: ChunkedEvents of the new store
+    """
+    event_ids = np.asarray(event_ids, dtype=int)
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+    starts = range(0, len(event_ids), chunk_size)
+    names = ["chunk_{:05d}".format(index) for index in range(len(starts))]
+    chunks = [(os.path.join(store_path, name),
+               event_ids[start:start + chunk_size])
+              for name, start in zip(names, starts)]
+    pool = Pool(processes, initializer=_init_worker, initargs=(hits_kwargs,))
+    try:
+        for _ in pool.imap_unordered(_write_chunk, chunks):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+    metadata = dict((name, value) for name, value in hits_kwargs.items()
+                    if name in RECORDED_ARGUMENTS)
+    write_chunks_index(store_path, names, metadata)
+    return ChunkedEvents(store_path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Generate resampled signal and background events as a "
+                    "chunked columnar store")
+    parser.add_argument("sig_path", help="path to signal rootfile or store")
+    parser.add_argument("bkg_path", help="path to background rootfile or store")
+    parser.add_argument("store_path", help="directory of the new store")
+    parser.add_argument("--occupancy", type=float, default=0.10,
+                        help="fraction of wires hit by the background")
+    parser.add_argument("--first", type=int, default=0,
+                        help="first signal event to resample")
+    parser.add_argument("--last", type=int, default=None,
+                        help="signal event after the last one to resample, "
+                             "all events by default")
+    parser.add_argument("--chunk-size", type=int, default=100,
+                        help="number of events per chunk")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of worker processes, all cores by "
+                             "default")
+    parser.add_argument("--sig-tree", default="tree",
+                        help="name of the tree in signal dataset")
+    parser.add_argument("--bkg-tree", default="tree",
+                        help="name of the tree in background dataset")
+    args = parser.parse_args(argv)
+    last = args.last
+    if last is None:
+        last = len(open_events(args.sig_path, tree=args.sig_tree))
+    events = generate(args.store_path, np.arange(args.first, last),
+                      chunk_size=args.chunk_size, processes=args.processes,
+                      sig_path=args.sig_path, sig_tree=args.sig_tree,
+                      bkg_path=args.bkg_path, bkg_tree=args.bkg_tree,
+                      occupancy=args.occupancy)
+    print("Wrote {} events to {}".format(events.n_events, args.store_path))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
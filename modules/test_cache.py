@@ -0,0 +1,86 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import shutil
+import tempfile
+from cache import DiskCache, LRUCache
+from cylinder import CyDet
+from tracking import Hough
+from legacy import GeometryOnly
+import numpy as np
+
+
+def test_cached_geometry_and_hough():
+    path = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(path)
+        cold = CyDet(cache=cache)
+        warm = CyDet(cache=cache)
+        plain = CyDet()
+        assert len(os.listdir(path)) == 1
+        for geom in [cold, warm]:
+            for name in CyDet.cached_arrays:
+                assert np.array_equal(getattr(geom, name), getattr(plain, name))
+            for name in CyDet.cached_matrices:
+                assert (getattr(geom, name) != getattr(plain, name)).nnz == 0
+        assert isinstance(warm.point_x, np.memmap)
+
+        hits = GeometryOnly(warm)
+        hough = Hough(hits, rho_bins=5, cache=cache)
+        warm_hough = Hough(hits, rho_bins=5, cache=cache)
+        other_hough = Hough(hits, rho_bins=5, sig_rho=33., cache=cache)
+        assert len(os.listdir(path)) == 4
+        assert (warm_hough.correspondence != hough.correspondence).nnz == 0
+        assert (other_hough.correspondence != hough.correspondence).nnz > 0
+        # Loaded arrays may be changed without changing the cache
+        warm_hough.correspondence.data[:] = 0
+        assert Hough(hits, rho_bins=5, cache=cache).correspondence.data.min() > 0
+    finally:
+        shutil.rmtree(path)
+
+
+def test_cache_eviction():
+    path = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(path, max_bytes=2500)
+        for key in ['a', 'b', 'c']:
+            cache.save(key, {'values': np.zeros(100)})
+            # Order the entries by use explicitly, file times may be coarse
+            os.utime(os.path.join(path, key), (0, len(cache._entry_sizes())))
+        assert cache.size <= 2500
+        assert cache.load('a') is None
+        assert np.array_equal(cache.load('c')['values'], np.zeros(100))
+        cache.clear()
+        assert cache.size == 0
+    finally:
+        shutil.rmtree(path)
+
+
+def test_lru_cache():
+    cache = LRUCache(max_entries=3)
+    built = []
+
+    def builder(key):
+        def build():
+            built.append(key)
+            return {"values": np.arange(100) * key}
+        return build
+    for key in [1, 2, 3, 1, 4, 1, 2]:
+        arrays = cache.fetch(key, builder(key))
+        assert np.array_equal(arrays["values"], np.arange(100) * key)
+        assert not arrays["values"].flags.writeable
+    # 2 was the least recently used entry when 4 came in
+    assert built == [1, 2, 3, 4, 2]
+    assert cache.stats == {"hits": 2, "misses": 5, "entries": 3,
+                           "bytes": 3 * np.arange(100).nbytes}
+    assert 3 not in cache and 1 in cache
+    cache = LRUCache(max_bytes=2 * np.arange(100).nbytes)
+    mine = np.arange(100)
+    for key in range(5):
+        cache.save(key, {"values": mine})
+    assert len(cache) == 2 and mine.flags.writeable
+    # Stored arrays do not change with the caller's arrays
+    mine[0] = 7
+    assert cache.load(4)["values"][0] == 0
+    cache.clear()
+    assert cache.stats["entries"] == cache.stats["bytes"] == 0
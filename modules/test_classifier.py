@@ -0,0 +1,41 @@
+from __future__ import division, print_function, absolute_import
+
+from classifier import WireClassifier, WIRE_FEATURES, SIG_LIKE_FEATURES
+from features import get_batch_features
+from hits import ResampledHits
+from sklearn.ensemble import GradientBoostingClassifier
+from test_hits import cydet, signal_path, background_path
+import numpy as np
+
+
+def test_wire_classifier():
+    hits = ResampledHits(sig_path=signal_path, bkg_path=background_path,
+                         occupancy=0.05)
+    classifier = WireClassifier(
+        wire_estimator=GradientBoostingClassifier(n_estimators=3),
+        estimator=GradientBoostingClassifier(n_estimators=3))
+    classifier.fit(hits, np.arange(0, 10), np.arange(10, 20), batch_size=4)
+    event_ids = np.arange(20, 31)
+    result = classifier.predict(hits, event_ids, batch_size=4)
+    hit_matrix, features = get_batch_features(hits, event_ids,
+                                              WIRE_FEATURES)
+    assert np.array_equal(result.event_ids, event_ids)
+    assert np.array_equal(result.indptr, hit_matrix.indptr)
+    assert np.array_equal(result.wires, hit_matrix.wires)
+    wire_probs = result.get_column("wire_prob")
+    assert np.allclose(
+        wire_probs, classifier.wire_estimator.predict_proba(features)[:, 1])
+    probs = result.get_column("signal_prob")
+    assert np.all((probs >= 0) & (probs <= 1))
+    # The second stage sees the sums of the first stage over the neighbours
+    _, stage_features = get_batch_features(
+        hits, event_ids, classifier.features)
+    dense = result.get_dense("wire_prob")
+    rows, wires = hit_matrix.get_rows(), hit_matrix.wires
+    sig_like = {"sig_like_neigh": cydet.point_neighbours,
+                "sig_like_lr": cydet.lr_neighbours}
+    stage_features = np.column_stack(
+        [stage_features] + [sig_like[name].dot(dense.T).T[rows, wires]
+                            for name in SIG_LIKE_FEATURES])
+    assert np.allclose(
+        probs, classifier.estimator.predict_proba(stage_features)[:, 1])
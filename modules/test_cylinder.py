@@ -0,0 +1,79 @@
+from __future__ import division, print_function, absolute_import
+
+from cylinder import CyDet, TrackCenters
+from legacy import legacy_point_neighbours
+import numpy as np
+
+cydet = CyDet()
+track = TrackCenters(rho_bins=12)
+
+
+def _assert_same_matrix(new, old):
+    assert new.shape == old.shape
+    assert new.dtype == old.dtype
+    assert np.array_equal(new.indptr, old.indptr)
+    assert np.array_equal(new.indices, old.indices)
+    assert np.array_equal(new.data, old.data)
+
+
+def test_neighbours_match_legacy():
+    for geom in [cydet, CyDet(use_default_phis=True), track]:
+        neigh, lr_neigh = legacy_point_neighbours(geom)
+        _assert_same_matrix(geom.point_neighbours, neigh)
+        _assert_same_matrix(geom.lr_neighbours, lr_neigh)
+
+
+def test_neighbours_counts():
+    n_neigh = np.diff(cydet.point_neighbours.indptr)
+    outer = (np.arange(cydet.n_points) < cydet.first_point[1]) | \
+            (np.arange(cydet.n_points) >= cydet.first_point[-1])
+    assert np.all(n_neigh[outer] == 5)
+    assert np.all(n_neigh[~outer] == 8)
+    assert np.all(np.diff(cydet.lr_neighbours.indptr) == 2)
+
+
+def test_lazy_distances_match_dense():
+    dists = cydet.point_dists
+    full = dists.get_full()
+    assert full.shape == (cydet.n_points, cydet.n_points)
+    neighs = cydet.get_neighbours(100)
+    assert np.array_equal(dists[100, neighs], full[100, neighs])
+    assert np.array_equal(dists[:10, 20:40], full[:10, 20:40])
+    assert np.array_equal(dists[[1, 2, 3], [4, 5, 6]], full[[1, 2, 3], [4, 5, 6]])
+    assert np.array_equal(dists.get_row(7), full[7])
+    assert np.array_equal(dists.get_block([3, 4], neighs), full[np.ix_([3, 4], neighs)])
+    assert dists.get_distance(5, 3000) == full[5, 3000]
+
+
+def test_distances_within_radius():
+    dists = track.point_dists
+    near = dists.get_within(10, 8.)
+    assert np.array_equal(near, np.where(dists.get_row(10) <= 8.)[0])
+
+
+def test_layer_and_index_lookups():
+    point_ids = np.arange(cydet.n_points)
+    layers = cydet.point_layer
+    assert np.array_equal(np.take(cydet.r_by_layer, layers), cydet.point_rhos)
+    assert np.array_equal(cydet.point_lookup[layers, cydet.point_index], point_ids)
+    assert cydet.get_layer(cydet.first_point[5]) == 5
+    assert cydet.get_index(cydet.first_point[5] + 3) == 3
+
+
+def test_batch_shift_and_rotate():
+    point_ids = np.arange(cydet.n_points)
+    for shift in [1, -1, 7, -300]:
+        shifted = cydet.shift_wires(point_ids, shift)
+        assert np.array_equal(cydet.point_layer[shifted], cydet.point_layer)
+        expected = (cydet.point_index + shift) % \
+            np.take(cydet.n_by_layer, cydet.point_layer)
+        assert np.array_equal(cydet.point_index[shifted], expected)
+        assert cydet.shift_wire(123, shift) == shifted[123]
+    # A rotation by half a turn of an even layer moves every wire
+    # half of the layer along
+    first, size = cydet.first_point[2], cydet.n_by_layer[2]
+    rotated = cydet.rotate_wires(np.arange(first, first + size), 0.5)
+    assert np.array_equal(rotated - first, (np.arange(size) + size // 2) % size)
+    fracs = np.linspace(0, 1, cydet.n_points)
+    rotated = cydet.rotate_wires(point_ids, fracs)
+    assert rotated[1000] == cydet.rotate_wire(1000, fracs[1000])
@@ -0,0 +1,86 @@
+from __future__ import division, print_function, absolute_import
+
+from cylinder import CyDet
+from events import HitMatrix
+from scipy.sparse import hstack
+import numpy as np
+
+cydet = CyDet()
+
+
+def random_hits(n_events=6, n_hits=500, seed=0):
+    """
+    Returns random hits of a batch of events, with repeated wires
+    """
+    random = np.random.RandomState(seed)
+    rows = random.randint(0, n_events, size=n_hits)
+    wires = random.randint(0, 50, size=n_hits) * 80
+    values = random.uniform(0, 10, size=n_hits)
+    return rows, wires, values
+
+
+def test_hit_matrix_reductions():
+    rows, wires, values = random_hits()
+    event_ids = np.arange(6) + 100
+    columns = dict((name, values) for name in ["last", "first", "sum", "min"])
+    hit_matrix = HitMatrix.from_hits(cydet.n_points, event_ids, rows, wires,
+                                     columns, reductions=dict(
+                                         (name, name) for name in columns))
+    assert hit_matrix.shape == (6, cydet.n_points)
+    assert np.array_equal(hit_matrix.event_ids, event_ids)
+    last = np.zeros(hit_matrix.shape)
+    last[rows, wires] = values
+    first = np.zeros(hit_matrix.shape)
+    for row, wire, value in reversed(list(zip(rows, wires, values))):
+        first[row, wire] = value
+    total = np.zeros(hit_matrix.shape)
+    np.add.at(total, (rows, wires), values)
+    lowest = np.full(hit_matrix.shape, np.inf)
+    np.minimum.at(lowest, (rows, wires), values)
+    lowest[np.isinf(lowest)] = 0
+    assert np.array_equal(hit_matrix.get_dense("last"), last)
+    assert np.array_equal(hit_matrix.get_dense("first"), first)
+    assert np.allclose(hit_matrix.get_dense("sum"), total, rtol=1e-14)
+    assert np.array_equal(hit_matrix.get_dense("min"), lowest)
+    assert np.array_equal(hit_matrix.get_csr("last").toarray(), last)
+    for row in range(6):
+        assert np.array_equal(hit_matrix.get_event_wires(row),
+                              np.unique(wires[rows == row]))
+        assert np.array_equal(hit_matrix.get_event_values(row, "last"),
+                              last[row, hit_matrix.get_event_wires(row)])
+
+
+def test_hit_matrix_select_concatenate():
+    rows, wires, values = random_hits()
+    hit_matrix = HitMatrix.from_hits(cydet.n_points, np.arange(6), rows, wires,
+                                     {"values": values})
+    dense = hit_matrix.get_dense("values")
+    selected = hit_matrix.select([4, 1, 1])
+    assert np.array_equal(selected.event_ids, [4, 1, 1])
+    assert np.array_equal(selected.get_dense("values"), dense[[4, 1, 1]])
+    stacked = HitMatrix.concatenate([selected, hit_matrix.select(slice(2, 4))])
+    assert np.array_equal(stacked.get_dense("values"), dense[[4, 1, 1, 2, 3]])
+    found = hit_matrix.get_hit_lookup([0, 0, 5], [wires[rows == 0][0], 1, 1])
+    assert found[0] >= 0 and np.all(found[1:] == -1)
+
+
+def test_hit_matrix_neighbour_sum():
+    rows, wires, values = random_hits()
+    hit_matrix = HitMatrix.from_hits(cydet.n_points, np.arange(6), rows, wires,
+                                     {"values": values})
+    dense = hit_matrix.get_dense("values")
+    for neighbours in [cydet.point_neighbours, cydet.lr_neighbours]:
+        expected = neighbours.dot(dense.T).T
+        sums = hit_matrix.get_neighbour_sum("values", neighbours)
+        assert np.allclose(sums, expected[hit_matrix.get_rows(),
+                                          hit_matrix.wires], rtol=1e-14)
+        full = hit_matrix.get_neighbour_sum("values", neighbours,
+                                            hits_only=False)
+        assert np.allclose(full.toarray(), expected, rtol=1e-14)
+    # Sums over both neighbours stacked side by side
+    stacked = hit_matrix.get_csr("values").dot(hstack(
+        [cydet.point_neighbours.T, cydet.lr_neighbours.T])).tocsr()
+    lr_sums = hit_matrix.get_hit_values(stacked, cydet.n_points)
+    expected = cydet.lr_neighbours.dot(dense.T).T
+    assert np.allclose(lr_sums, expected[hit_matrix.get_rows(),
+                                         hit_matrix.wires], rtol=1e-14)
@@ -0,0 +1,146 @@
+from __future__ import division, print_function, absolute_import
+
+import shutil
+import tempfile
+from collections import OrderedDict
+from features import FEATURES, DEFINITIONS, FeatureDefinition, FeaturePlan, \
+    FeatureStore, get_batch_features, iter_feature_chunks, compute_features
+from hits import ResampledHits
+from test_hits import cydet, signal, signal_path, background_path
+import numpy as np
+
+
+def test_batch_features():
+    event_ids = [3, 0, 17, 39]
+    hit_matrix, features = get_batch_features(signal, event_ids)
+    assert features.shape == (hit_matrix.n_hits, len(FEATURES))
+    # Dense features of the notebooks
+    dense = signal.get_measurements(event_ids)
+    deposits = dense["energy_deposits"]
+    rel_time = dense["relative_time"]
+    neighbours, lr_neighbours = cydet.point_neighbours, cydet.lr_neighbours
+    sum_neigh_deposits = neighbours.dot(deposits.T).T
+    sum_lr_deposits = lr_neighbours.dot(deposits.T).T
+    expected = {
+        "deposit": deposits,
+        "rel_time": rel_time,
+        "layer_id": np.tile(cydet.point_layer, (len(event_ids), 1)),
+        "sum_neigh_deposits": sum_neigh_deposits,
+        "num_neigh_deposits": neighbours.dot(deposits.T > 0).T,
+        "sum_neigh_deposits_2":
+            neighbours.dot(sum_neigh_deposits.T).T - deposits,
+        "sum_lr_time": lr_neighbours.dot(rel_time.T).T,
+        "sum_lr_deposits": sum_lr_deposits,
+        "num_lr_deposits": lr_neighbours.dot(deposits.T > 0).T,
+        "sum_lr_deposits_2":
+            lr_neighbours.dot(sum_neigh_deposits.T).T - deposits,
+        "labels": 2 - dense["hit_types"]}
+    rows, wires = hit_matrix.get_rows(), hit_matrix.wires
+    for index, name in enumerate(FEATURES):
+        assert np.allclose(features[:, index], expected[name][rows, wires],
+                           rtol=1e-12, atol=1e-20), name
+    _, some = get_batch_features(signal, event_ids, ["labels", "deposit"])
+    assert np.array_equal(some, features[:, [10, 0]])
+
+
+def test_feature_plan():
+    plan = FeaturePlan()
+    # Only the measurements the features depend on are read
+    assert sorted(plan.get_measurements(signal.measurements)) == \
+        ["energy_deposits", "hit_types", "hit_vector", "relative_time"]
+    assert plan.levels["sum_neigh_deposits_2"] == 2
+    assert plan.order.index("sum_neigh_deposits") < \
+        plan.order.index("neigh_sum_neigh_deposits")
+    plan = FeaturePlan(["sum_neigh_deposits", "labels"],
+                       provided=["sum_neigh_deposits"])
+    assert plan.order == ["sum_neigh_deposits", "hit_types", "labels"]
+    # Neighbour sums are summed again over all wires, not only the hits
+    plan = FeaturePlan(["sum_lr_deposits_2"],
+                       provided=["sum_neigh_deposits"])
+    assert "sum_neigh_deposits" not in plan.provided
+    assert plan.levels["sum_neigh_deposits"] == 1
+    assert plan.levels["lr_sum_neigh_deposits"] == 2
+    assert plan.levels["sum_lr_deposits_2"] == 2
+    assert "sum_lr_deposits" not in plan.levels
+    try:
+        FeaturePlan(["sig_like_neighs"])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_compute_features():
+    hit_matrix, features = get_batch_features(signal, [5, 8, 9])
+    probs = np.random.RandomState(0).uniform(size=hit_matrix.n_hits)
+    deposit_index = FEATURES.index("deposit")
+    # Features computed before are given, and not computed again
+    values = {"wire_prob": probs, "deposit": features[:, deposit_index]}
+    result = compute_features(hit_matrix, cydet, ["sig_like_neigh",
+                                                  "sig_like_lr",
+                                                  "sum_lr_deposits_2"],
+                              values)
+    dense = hit_matrix.get_csr("hit_vector").copy()
+    dense.data = probs
+    dense = dense.toarray()
+    rows, wires = hit_matrix.get_rows(), hit_matrix.wires
+    for index, neighbours in enumerate([cydet.point_neighbours,
+                                        cydet.lr_neighbours]):
+        expected = neighbours.dot(dense.T).T[rows, wires]
+        assert np.allclose(result[:, index], expected, rtol=1e-12)
+    assert np.allclose(result[:, 2],
+                       features[:, FEATURES.index("sum_lr_deposits_2")],
+                       rtol=1e-12, atol=1e-20)
+
+
+def test_feature_chunks():
+    hits = ResampledHits(sig_path=signal_path, bkg_path=background_path,
+                         occupancy=0.05)
+    event_ids = np.arange(2, 31)
+    _, features = get_batch_features(hits, event_ids)
+    chunks = list(iter_feature_chunks(hits, event_ids, chunk_size=1000,
+                                      batch_size=4))
+    assert all(len(chunk) == 1000 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 1000
+    assert np.array_equal(np.concatenate(chunks), features)
+    assert set(features[:, -1]) == set([0, 1])
+
+
+def test_feature_store():
+    path = tempfile.mkdtemp()
+    try:
+        event_ids = np.arange(3, 13)
+        _, expected = get_batch_features(signal, event_ids)
+        store = FeatureStore(signal, event_ids, path=path, batch_size=3)
+        names = ["deposit", "sum_lr_deposits"]
+        hit_matrix = store.get_hit_matrix(names)
+        assert hit_matrix.n_hits == len(expected)
+        for name in names:
+            column = hit_matrix.get_column(name)
+            assert not column.flags.writeable
+            assert np.allclose(column, expected[:, FEATURES.index(name)],
+                               rtol=1e-12, atol=1e-20)
+        # A new session loads the stored features without reading the events
+        store = FeatureStore(signal, event_ids, path=path, batch_size=4)
+        store.hits = None
+        assert np.array_equal(store.get_hit_matrix(names).wires,
+                              hit_matrix.wires)
+        # Only the missing features are computed
+        store.hits = signal
+        hit_matrix = store.get_hit_matrix()
+        assert np.allclose(np.column_stack([hit_matrix.get_column(name)
+                                            for name in FEATURES]),
+                           expected, rtol=1e-12, atol=1e-20)
+        # A new version of a definition invalidates the features depending
+        # on it
+        definitions = OrderedDict(DEFINITIONS)
+        definitions["deposit"] = FeatureDefinition(
+            "deposit", measurement=["energy_deposits"], version=2)
+        store = FeatureStore(signal, event_ids, path=path,
+                             definitions=definitions)
+        assert store.is_stored("labels")
+        assert not store.is_stored("deposit")
+        assert not store.is_stored("sum_lr_deposits_2")
+        assert FeatureStore(signal, event_ids[1:], path=path).path != \
+            store.path
+    finally:
+        shutil.rmtree(path)
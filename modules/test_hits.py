@@ -0,0 +1,262 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import atexit
+import shutil
+import tempfile
+from cylinder import CyDet
+from columnar import write_store, write_chunks_index, ColumnarEvents, \
+    ChunkedEvents, ChunkedColumn, open_events
+from hits import SignalHits, BackgroundHits, ResampledHits
+import numpy as np
+
+cydet = CyDet()
+store_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, store_dir)
+
+
+def make_store(path, prefix, n_events=40, seed=0, event_level=(),
+               replace=False):
+    """
+    Writes a columnar store of random events, with unique hit wires unless
+    replace is true
+    """
+    random = np.random.RandomState(seed)
+    counts = random.randint(0, 300, size=n_events)
+    wires = np.concatenate([random.choice(cydet.n_points, size=count,
+                                          replace=replace)
+                            for count in counts])
+    n_hits = len(wires)
+    hit_columns = {prefix + "_layerID": cydet.point_layer[wires],
+                   prefix + "_cellID": cydet.point_index[wires],
+                   prefix + "_edep": random.exponential(1e-5, size=n_hits),
+                   prefix + "_tstart": random.uniform(0, 2000, size=n_hits),
+                   prefix + "_t": random.uniform(0, 2000, size=n_hits),
+                   prefix + "_hittype": random.randint(0, 4, size=n_hits)}
+    event_columns = {}
+    for name in event_level:
+        event_columns[prefix + name] = random.uniform(0, 1000, size=n_events)
+    offsets = np.zeros(n_events + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+    write_store(path, offsets, hit_columns, event_columns)
+    return path
+
+
+signal_path = make_store(os.path.join(store_dir, "signal"), "CdcCell", event_level=["_mt"])
+signal = SignalHits(cydet, path=signal_path)
+repeated_path = make_store(os.path.join(store_dir, "repeated"), "CdcCell",
+                           seed=2, event_level=["_mt"], replace=True)
+background_path = make_store(os.path.join(store_dir, "background"), "O", seed=1)
+
+
+def test_columnar_events():
+    events = open_events(signal_path)
+    assert isinstance(events, ColumnarEvents)
+    assert len(events) == signal.n_events == 40
+    edep = events.get_hits("CdcCell_edep")
+    offsets = events.offsets
+    event = events[7]
+    assert np.array_equal(event["CdcCell_edep"], edep[offsets[7]:offsets[8]])
+    # Events are views of the memory mapped columns
+    assert np.may_share_memory(event["CdcCell_edep"], edep)
+    assert not event["CdcCell_edep"].flags.writeable
+    assert event["CdcCell_mt"] == events.get_column("CdcCell_mt")[7]
+
+
+def split_store(path, store_path, bounds):
+    """
+    Writes the events of a columnar store as a chunked store, cut at bounds
+    """
+    events = open_events(store_path)
+    names = []
+    for index, (first, last) in enumerate(zip(bounds[:-1], bounds[1:])):
+        offsets = events.offsets[first:last + 1]
+        hit_columns = dict(
+            (name, events.get_hits(name)[offsets[0]:offsets[-1]])
+            for name in events.hit_branches)
+        event_columns = dict((name, events.get_column(name)[first:last])
+                             for name in events.event_branches)
+        names.append("chunk_{}".format(index))
+        write_store(os.path.join(path, names[-1]), offsets - offsets[0],
+                    hit_columns, event_columns)
+    write_chunks_index(path, names)
+    return path
+
+
+def test_hits_from_chunked_store():
+    chunked = open_events(split_store(os.path.join(store_dir, "chunked"),
+                                      signal_path, [0, 15, 16, 40]))
+    assert isinstance(chunked, ChunkedEvents)
+    events = signal.data
+    assert np.array_equal(chunked.get_offsets(), events.offsets)
+    for name in events.hit_branches + events.event_branches:
+        assert np.array_equal(chunked.get_column(name),
+                              events.get_column(name))
+    # Columns are read chunk by chunk, where they are indexed
+    edep = chunked.get_hits("CdcCell_edep")
+    assert isinstance(edep, ChunkedColumn)
+    hit_ids = np.array([len(edep) - 1, 0, events.offsets[16] + 2, 5])
+    assert np.array_equal(edep[hit_ids],
+                          events.get_hits("CdcCell_edep")[hit_ids])
+    assert edep[-1] == events.get_hits("CdcCell_edep")[-1]
+    hits = SignalHits(cydet, path=chunked.path)
+    event_ids = [39, 0, 15, 16]
+    expected = signal.get_hit_matrix(event_ids)
+    hit_matrix = hits.get_hit_matrix(event_ids)
+    assert np.array_equal(hit_matrix.wires, expected.wires)
+    for name in expected.names:
+        assert np.array_equal(hit_matrix.get_column(name),
+                              expected.get_column(name))
+    background = BackgroundHits(cydet, path=split_store(
+        os.path.join(store_dir, "chunked_bkg"), background_path,
+        [0, 20, 40]), hits=200)
+    alone = BackgroundHits(cydet, path=background_path, hits=200)
+    assert np.array_equal(background.get_hit_wires(3),
+                          alone.get_hit_wires(3))
+
+
+def test_signal_hits_from_store():
+    events = signal.data
+    for event_id in [0, 5, 39]:
+        first, last = events.offsets[event_id], events.offsets[event_id + 1]
+        layers = events.get_hits("CdcCell_layerID")[first:last]
+        cells = events.get_hits("CdcCell_cellID")[first:last]
+        wires = cydet.point_lookup[layers, cells]
+        assert np.array_equal(signal.get_hit_wires(event_id), wires)
+        deposits = np.zeros(cydet.n_points)
+        deposits[wires] = events.get_hits("CdcCell_edep")[first:last]
+        assert np.array_equal(signal.get_energy_deposits(event_id), deposits)
+
+
+def test_batch_measurements():
+    event_ids = [3, 0, 17, 17, 39]
+    dense = signal.get_measurements(event_ids)
+    sparse = signal.get_measurements(event_ids, sparse=True)
+    assert set(dense) == set(SignalHits.measurements)
+    for name in SignalHits.measurements:
+        getter = getattr(signal, "get_" + name)
+        expected = np.vstack([getter(event_id) for event_id in event_ids])
+        assert dense[name].shape == (len(event_ids), cydet.n_points)
+        assert dense[name].dtype == expected.dtype
+        assert np.array_equal(dense[name], expected)
+        assert np.array_equal(sparse[name].toarray(), expected)
+    block = signal.get_measurements(slice(10, 20), ["energy_deposits"])
+    assert list(block) == ["energy_deposits"]
+    assert block["energy_deposits"].shape == (10, cydet.n_points)
+
+
+def test_time_neighbours_metric():
+    for hits in [signal, SignalHits(cydet, path=repeated_path)]:
+        for event_id in [0, 1, 25]:
+            # Sum the terms one hit at a time
+            t_hits = hits.get_hit_time(event_id)
+            expected = np.zeros(cydet.n_points)
+            for wire in hits.get_hit_wires(event_id):
+                for shift in [1, -1]:
+                    sh_wire = cydet.shift_wire(wire, shift)
+                    expected[wire] += abs((t_hits[sh_wire] + 1) /
+                                          (t_hits[wire] + 1))
+            assert np.array_equal(hits.get_time_neighbours_metric(event_id),
+                                  expected)
+        batch = hits.get_measurements([25, 0, 1], ["time_neighbours_metric"])
+        assert np.array_equal(batch["time_neighbours_metric"][1],
+                              hits.get_time_neighbours_metric(0))
+
+
+def test_background_resampling():
+    background = BackgroundHits(cydet, path=background_path, hits=450)
+    events, hit_ids, new_wires, ends = background._draw_sample(7, 450)
+    # Reproducible from the seed, and whole source events are used until
+    # there are enough hits
+    for this, other in zip([events, hit_ids, new_wires, ends],
+                           background._draw_sample(7, 450)):
+        assert np.array_equal(this, other)
+    assert not np.array_equal(new_wires, background._draw_sample(8, 450)[2])
+    assert ends[-1] == len(hit_ids) >= 450 > ends[-2]
+    # Each source event is rotated as a whole within the layers
+    old_wires = background.all_wires[hit_ids]
+    assert np.array_equal(cydet.point_layer[new_wires],
+                          cydet.point_layer[old_wires])
+    for event in np.unique(events):
+        event_hits = events == event
+        rotation = (cydet.point_phis[new_wires[event_hits]] -
+                    cydet.point_phis[old_wires[event_hits]]) % (2 * np.pi)
+        assert np.ptp(rotation) < 0.05 or np.ptp(rotation) > 2 * np.pi - 0.05
+    # The getters follow the number of hits, and reuse the generated events
+    assert np.array_equal(background.get_hit_wires(7), np.unique(new_wires))
+    background.get_energy_deposits(7)
+    assert background.sample_cache.stats["misses"] == 1
+    assert background.sample_cache.stats["hits"] == 1
+    assert not background.sample_wires.flags.writeable
+    background.n_hits = 100
+    assert len(background.sample_hits) >= 450
+    assert background.get_hit_wires(7).size < np.unique(new_wires).size
+    deposits = np.zeros(cydet.n_points)
+    np.add.at(deposits, background.sample_wires,
+              background.data.get_hits("O_edep")[background.sample_hits])
+    assert np.allclose(background.get_energy_deposits(7), deposits,
+                       rtol=1e-14)
+    times = np.zeros(cydet.n_points)
+    sample_times = background.data.get_hits("O_t")[background.sample_hits]
+    for wire, time in zip(background.sample_wires, sample_times % 1170):
+        if times[wire] == 0 or times[wire] > time:
+            times[wire] = time
+    assert np.array_equal(background.get_hit_time(7), times)
+    batch = background.get_hit_matrix([7, 3, 7])
+    assert np.array_equal(batch.get_dense("hit_time")[2], times)
+    assert np.array_equal(batch.get_dense("hit_vector")[1],
+                          np.isin(np.arange(cydet.n_points),
+                                  background.get_hit_wires(3)))
+    # A shared cache keeps the events of each draw size apart
+    misses = background.sample_cache.stats["misses"]
+    other = BackgroundHits(cydet, path=background_path, hits=100,
+                           draw_size=4, sample_cache=background.sample_cache)
+    alone = BackgroundHits(cydet, path=background_path, hits=100,
+                           draw_size=4)
+    assert np.array_equal(other.get_hit_wires(7), alone.get_hit_wires(7))
+    assert background.sample_cache.stats["misses"] == misses + 1
+
+
+def test_resampled_hit_matrix():
+    hits = ResampledHits(sig_path=signal_path, bkg_path=background_path,
+                         occupancy=0.05)
+    hit_matrix = hits.get_hit_matrix([2, 9])
+    assert set(hit_matrix.names) == set(ResampledHits.measurements)
+    for row, event_id in enumerate([2, 9]):
+        sig_types = hits.sig_hits.get_hit_types(event_id)
+        bkg_wires = hits.bkg_hits.get_hit_wires(event_id)
+        energy = hits.sig_hits.get_energy_deposits(event_id) + \
+            hits.bkg_hits.get_energy_deposits(event_id)
+        types = np.where(sig_types > 0, sig_types, 0)
+        types[bkg_wires] = np.where(sig_types[bkg_wires] == 1, 1, 2)
+        wires = np.union1d(np.where(sig_types > 0)[0], bkg_wires)
+        assert np.array_equal(hit_matrix.get_event_wires(row), wires)
+        assert np.array_equal(hits.get_hit_wires(event_id), wires)
+        assert np.array_equal(hit_matrix.get_dense("energy_deposits")[row],
+                              energy)
+        assert np.array_equal(hits.get_hit_types(event_id), types)
+        assert np.array_equal(hits.get_bkg_wires(event_id),
+                              np.where(types == 2)[0])
+
+
+def test_occupancy_sweep():
+    occupancies = [0.05, 0.2, 0.1]
+    hits = ResampledHits(sig_path=signal_path, bkg_path=background_path,
+                         max_occupancy=0.2)
+    sweep = hits.get_occupancy_sweep([4, 11], occupancies)
+    # Each background event was generated once
+    assert hits.bkg_hits.sample_cache.stats["misses"] == 2
+    for occupancy, hit_matrix in zip(occupancies, sweep):
+        alone = ResampledHits(sig_path=signal_path, bkg_path=background_path,
+                              occupancy=occupancy).get_hit_matrix([4, 11])
+        assert np.array_equal(hit_matrix.wires, alone.wires)
+        for name in ResampledHits.measurements:
+            assert np.array_equal(hit_matrix.get_column(name),
+                                  alone.get_column(name))
+        hits.set_occupancy(occupancy)
+        assert np.array_equal(hits.get_hit_wires(11),
+                              hit_matrix.get_event_wires(1))
+    # Lower occupancies have a part of the background of higher ones
+    low, high, middle = [hit_matrix.get_event_wires(0) for hit_matrix in sweep]
+    assert len(low) < len(middle) < len(high)
+    assert np.all(np.isin(low, middle)) and np.all(np.isin(middle, high))
@@ -0,0 +1,18 @@
+from __future__ import division, print_function, absolute_import
+
+from metrics import roc_auc
+from sklearn.metrics import roc_auc_score
+import numpy as np
+
+
+def test_roc_auc():
+    random = np.random.RandomState(0)
+    labels = random.randint(0, 2, size=500)
+    # Rounded scores so that there are ties
+    scores = np.round(random.normal(size=500) + labels, 1)
+    weights = random.exponential(size=500)
+    assert np.isclose(roc_auc(labels, scores),
+                      roc_auc_score(labels, scores), rtol=1e-12)
+    assert np.isclose(roc_auc(labels, scores, weights),
+                      roc_auc_score(labels, scores, sample_weight=weights),
+                      rtol=1e-12)
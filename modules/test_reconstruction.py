@@ -0,0 +1,48 @@
+from __future__ import division, print_function, absolute_import
+
+from classifier import WireClassifier
+from hits import ResampledHits
+from reconstruction import Reconstruction, STAGES
+from sklearn.ensemble import GradientBoostingClassifier
+from legacy import legacy_prepare_hough
+from test_hits import signal_path, background_path
+from tracking import Hough
+import numpy as np
+
+
+def test_reconstruction():
+    hits = ResampledHits(sig_path=signal_path, bkg_path=background_path,
+                         occupancy=0.05)
+    classifier = WireClassifier(
+        wire_estimator=GradientBoostingClassifier(n_estimators=3),
+        estimator=GradientBoostingClassifier(n_estimators=3))
+    classifier.fit(hits, np.arange(0, 10), np.arange(10, 20), batch_size=5)
+    hough = Hough(hits, rho_bins=4)
+    reco = Reconstruction(hits, classifier, hough, alpha=3., batch_size=4)
+    event_ids = np.arange(20, 31)
+    result = reco.run(event_ids)
+    assert np.array_equal(result.event_ids, event_ids)
+    assert set(result.names) == set(["signal_prob", "hough"])
+    timings = reco.get_timings()
+    assert list(timings) == STAGES + ["total"]
+    assert reco.n_events == len(event_ids)
+    assert all(timing >= 0 for timing in timings.values())
+    # Dense reconstruction of the notebook
+    expected = classifier.predict(hits, event_ids)
+    assert np.allclose(result.get_column("signal_prob"),
+                       expected.get_column("signal_prob"))
+    probs = expected.get_dense("signal_prob")
+    even, odd, _, _ = legacy_prepare_hough(hough, probs, alpha=3.)
+    rows = result.get_rows()
+    assert np.allclose(result.get_column("hough"),
+                       (even + odd)[rows, result.wires])
+    batch, _ = reco.process(event_ids)
+    assert np.allclose(batch.get_column("hough_even"),
+                       even[rows, result.wires])
+    assert np.allclose(batch.get_column("hough_odd"),
+                       odd[rows, result.wires])
+    # The same events run in one batch
+    reco.batch_size = 100
+    reco.reset_timings()
+    whole = reco.run(event_ids)
+    assert np.allclose(whole.get_column("hough"), result.get_column("hough"))
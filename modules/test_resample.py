@@ -0,0 +1,75 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import shutil
+import tempfile
+from columnar import ChunkedEvents
+from hits import ResampledHits
+from resample import generate, main
+from test_hits import signal_path, background_path
+import numpy as np
+
+
+def test_generate_resampled_store():
+    path = tempfile.mkdtemp()
+    try:
+        kwargs = dict(sig_path=signal_path, bkg_path=background_path,
+                      occupancy=0.05)
+        stores = [os.path.join(path, name) for name in ["one", "two"]]
+        event_ids = np.arange(3, 30)
+        generate(stores[0], event_ids, chunk_size=7, processes=1, **kwargs)
+        events = generate(stores[1], event_ids, chunk_size=5, processes=2,
+                          **kwargs)
+        assert isinstance(events, ChunkedEvents)
+        assert len(events) == len(event_ids)
+        assert events.metadata["occupancy"] == 0.05
+        lazy = ResampledHits(**kwargs)
+        expected = lazy.get_hit_matrix(event_ids)
+        for store in stores:
+            hits = ResampledHits(store_path=store)
+            assert hits.n_events == len(event_ids)
+            # The store starts from signal event 3, events are read by their
+            # signal event_ids in any order, across chunks
+            assert np.array_equal(hits.event_ids, event_ids)
+            rows = [26, 0, 6, 7, 12, 6]
+            hit_matrix = hits.get_hit_matrix(event_ids[rows])
+            assert np.array_equal(hit_matrix.event_ids, event_ids[rows])
+            selected = expected.select(rows)
+            assert np.array_equal(hit_matrix.event_ids, selected.event_ids)
+            assert np.array_equal(hit_matrix.indptr, selected.indptr)
+            assert np.array_equal(hit_matrix.wires, selected.wires)
+            for name in ResampledHits.measurements:
+                assert np.array_equal(hit_matrix.get_column(name),
+                                      selected.get_column(name))
+            assert np.array_equal(hits.get_hit_types(event_ids[4]),
+                                  lazy.get_hit_types(event_ids[4]))
+            try:
+                hits.get_hit_matrix([2])
+                assert False
+            except KeyError:
+                pass
+    finally:
+        shutil.rmtree(path)
+
+
+def test_main_from_first_event():
+    path = tempfile.mkdtemp()
+    try:
+        store = os.path.join(path, "store")
+        main([signal_path, background_path, store, "--occupancy", "0.05",
+              "--first", "5", "--last", "12", "--chunk-size", "3",
+              "--processes", "1"])
+        hits = ResampledHits(store_path=store)
+        assert hits.n_events == 7
+        assert np.array_equal(hits.event_ids, np.arange(5, 12))
+        hit_matrix = hits.get_hit_matrix([5, 8, 11])
+        assert np.array_equal(hit_matrix.event_ids, [5, 8, 11])
+        assert np.array_equal(hits.get_hit_matrix(slice(0, 3)).event_ids,
+                              [5, 6, 7])
+        lazy = ResampledHits(sig_path=signal_path, bkg_path=background_path,
+                             occupancy=0.05).get_hit_matrix([5, 8, 11])
+        assert np.array_equal(hit_matrix.wires, lazy.wires)
+        assert np.array_equal(hit_matrix.get_column("hit_types"),
+                              lazy.get_column("hit_types"))
+    finally:
+        shutil.rmtree(path)
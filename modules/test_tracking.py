@@ -0,0 +1,157 @@
+from __future__ import division, print_function, absolute_import
+
+from cylinder import CyDet
+from scipy.sparse import csr_matrix
+from tracking import Hough, HoughScan
+from metrics import roc_auc
+from legacy import legacy_wire_track_correspondence, GeometryOnly
+import numpy as np
+
+
+hits = GeometryOnly(CyDet())
+hough = Hough(hits, rho_bins=4)
+
+
+def test_dist_prob_arrays():
+    distances = np.linspace(hough.sig_rho_min, hough.sig_rho_max, 50)
+    probs = hough.dist_prob(distances)
+    assert probs.shape == distances.shape
+    assert np.allclose(probs, [hough.dist_prob(d) for d in distances],
+                       rtol=1e-15, atol=0)
+    assert np.all(probs > 0)
+
+
+def test_correspondence_matches_legacy():
+    legacy = legacy_wire_track_correspondence(hough)
+    new = hough.correspondence
+    assert new.format == 'csr'
+    assert np.array_equal(new.indptr, legacy.indptr)
+    assert np.array_equal(new.indices, legacy.indices)
+    assert np.allclose(new.data, legacy.data, rtol=1e-15, atol=0)
+
+
+def test_track_scores():
+    random = np.random.RandomState(0)
+    weights = random.uniform(size=(7, hits.cydet.n_points))
+    weights[random.uniform(size=weights.shape) > 0.1] = 0
+    weights[3] = 0
+    dense = hough.correspondence.T.toarray()
+    for norm, norms in [(None, np.ones(len(dense))),
+                        ("l1", abs(dense).sum(axis=1)),
+                        ("l2", np.sqrt((dense ** 2).sum(axis=1))),
+                        ("max", abs(dense).max(axis=1))]:
+        norms[norms == 0] = 1
+        expected = (dense / norms[:, None]).dot(weights.T).T
+        scores = hough.get_track_scores(csr_matrix(weights), norm=norm)
+        assert scores.shape == (7, hough.track.n_points)
+        assert np.allclose(scores, expected, rtol=1e-12, atol=0)
+        chunked = hough.get_track_scores(weights, norm=norm, chunk_size=3)
+        assert np.allclose(chunked, scores, rtol=1e-12, atol=0)
+    assert hough.get_normalized_correspondence("l2") is \
+        hough.get_normalized_correspondence("l2")
+
+
+def test_even_odd_predictions():
+    random = np.random.RandomState(1)
+    weights = random.uniform(size=(5, hits.cydet.n_points))
+    weights[random.uniform(size=weights.shape) > 0.1] = 0
+    # prepare_hough of LocalBasedFiltering.ipynb
+    odd = hits.cydet.point_pol == 1
+    even_forward = hough.correspondence.T.toarray()
+    odd_forward = even_forward.copy()
+    even_forward[:, odd] = 0
+    odd_forward[:, ~odd] = 0
+    even_inverse, odd_inverse = even_forward.T, odd_forward.T
+    expected = []
+    for forward, inverse in [(even_forward, even_inverse),
+                             (odd_forward, odd_inverse)]:
+        norms = forward.sum(axis=1)
+        norms[norms == 0] = 1
+        reweighted = np.exp(2.5 * (forward / norms[:, None]).dot(weights.T))
+        expected.append((inverse.dot(reweighted).T, reweighted.T))
+    for chunk_size in [None, 2]:
+        result = hough.get_even_odd_predictions(csr_matrix(weights),
+                                                alpha=2.5,
+                                                chunk_size=chunk_size)
+        # In the order of the notebook, the odd reweighted scores first
+        for index, array in enumerate([expected[0][0], expected[1][0],
+                                       expected[1][1], expected[0][1]]):
+            assert result[index].shape == array.shape
+            assert np.allclose(result[index], array, rtol=1e-12, atol=0)
+
+
+def test_scan_alphas():
+    random = np.random.RandomState(2)
+    weights = csr_matrix(random.exponential(
+        0.2, size=(6, hits.cydet.n_points)) *
+        (random.uniform(size=(6, hits.cydet.n_points)) < 0.1))
+    labels = random.randint(0, 2, size=weights.nnz)
+    sample_weight = random.exponential(size=weights.nnz)
+    rows = np.repeat(np.arange(6), np.diff(weights.indptr))
+    for alphas in [np.linspace(2., 6., 5), [4., 1.]]:
+        areas = hough.scan_alphas(weights, labels, alphas, sample_weight,
+                                  chunk_size=4)
+        assert areas.shape == (len(alphas),)
+        for alpha, area in zip(alphas, areas):
+            even, odd, _, _ = hough.get_even_odd_predictions(weights, alpha)
+            preds = even / even.max() + odd / odd.max()
+            expected = roc_auc(labels, preds[rows, weights.indices],
+                               sample_weight)
+            # Near ties may be ordered differently by rounding
+            assert np.isclose(area, expected, rtol=0, atol=1e-6)
+
+
+def test_top_tracks():
+    random = np.random.RandomState(1)
+    scores = random.uniform(size=(6, hough.track.n_points))
+    scores[1] = 0
+    scores[2] = np.round(scores[2] * 3)
+    scores[3, 1:] = 0
+    neighbours = hough.track.point_neighbours
+    for k in [1, 4]:
+        for suppress in [True, False]:
+            track_ids, top_scores = hough.get_top_tracks(
+                scores, k=k, suppress=suppress, block_size=8)
+            for event, event_scores in enumerate(scores):
+                candidates = []
+                for track_id, score in enumerate(event_scores):
+                    neighs = neighbours.indices[
+                        neighbours.indptr[track_id]:
+                        neighbours.indptr[track_id + 1]]
+                    beaten = np.any(event_scores[neighs] > score) or \
+                        np.any((event_scores[neighs] == score) &
+                               (neighs < track_id))
+                    if score > 0 and not (suppress and beaten):
+                        candidates.append((-score, track_id))
+                expected = [track_id for _, track_id in
+                            sorted(candidates)[:k]]
+                n_found = len(expected)
+                assert np.array_equal(track_ids[event, :n_found], expected)
+                assert np.all(track_ids[event, n_found:] == -1)
+                assert np.array_equal(top_scores[event, :n_found],
+                                      event_scores[expected])
+
+
+def test_hough_scan():
+    scan = HoughScan(hits, rho_bins=4)
+    settings = [dict(sig_rho=34., sig_rho_min=31.5, sig_rho_max=34.5,
+                     sig_rho_sgma=2.),
+                dict(sig_rho=33., sig_rho_min=30., sig_rho_max=35.,
+                     sig_rho_sgma=3.),
+                dict(sig_rho=33.5, sig_rho_min=28., sig_rho_max=34.5,
+                     sig_rho_sgma=1.5)]
+    found = []
+    for index, scanned in scan.iter_houghs(settings):
+        found.append(index)
+        expected = Hough(hits, rho_bins=4, **settings[index])
+        assert scanned.sig_rho == settings[index]["sig_rho"]
+        assert np.allclose(scanned.track.point_x, expected.track.point_x)
+        assert np.allclose(scanned.track.point_y, expected.track.point_y)
+        assert np.array_equal(scanned.correspondence.indptr,
+                              expected.correspondence.indptr)
+        assert np.array_equal(scanned.correspondence.indices,
+                              expected.correspondence.indices)
+        assert np.allclose(scanned.correspondence.data,
+                           expected.correspondence.data, rtol=1e-15, atol=0)
+    # Settings are grouped by sig_rho_max
+    assert found == [0, 2, 1]
@@ -1,8 +1,10 @@
+from collections import OrderedDict
 import numpy as np
-import math
-from scipy.sparse import lil_matrix, find
-from scipy.spatial.distance import cdist
+from scipy.sparse import csr_matrix, find, issparse
 from cylinder import TrackCenters
+from cache import hash_key, code_version, pack_sparse, unpack_sparse
+from metrics import roc_auc
+from columnar import get_hit_ids
 
 """
 Notation used below:
@@ -12,12 +14,132 @@ Notation used below:
 """
 
 
+def _get_neighbour_table(neighbours):
+    """
+    Returns the neighbours of each point as a table, padded with the point
+    itself for points with fewer neighbours than the most
+
+    :param neighbours: scipy.sparse.csr_matrix of shape [n_points, n_points],
+                       e.g. TrackCenters.point_neighbours
+    :return: numpy.array of shape [n_points, max_neighbours]
+    """
+    n_points = neighbours.shape[0]
+    counts = np.diff(neighbours.indptr)
+    table = np.repeat(np.arange(n_points)[:, None], max(counts.max(), 1),
+                      axis=1)
+    slots = np.arange(neighbours.nnz) - np.repeat(neighbours.indptr[:-1],
+                                                  counts)
+    table[np.repeat(np.arange(n_points), counts), slots] = neighbours.indices
+    return table
+
+
+def _normalize_columns(matrix, norm):
+    """
+    Returns a sparse matrix with the values of each column normalized, as
+    normalize(matrix.T, norm).T of sklearn.preprocessing would.  Columns
+    without values are left as they are.
+
+    :param matrix: scipy.sparse.csr_matrix
+    :param norm: "l1", "l2" or "max"
+    :return: scipy.sparse.csr_matrix of the same shape
+    """
+    values = abs(matrix.data)
+    if norm == "l1":
+        norms = np.bincount(matrix.indices, weights=values,
+                            minlength=matrix.shape[1])
+    elif norm == "l2":
+        norms = np.sqrt(np.bincount(matrix.indices, weights=values * values,
+                                    minlength=matrix.shape[1]))
+    elif norm == "max":
+        norms = np.zeros(matrix.shape[1])
+        np.maximum.at(norms, matrix.indices, values)
+    else:
+        raise ValueError("Unknown norm {}".format(norm))
+    norms[norms == 0] = 1.
+    return csr_matrix((matrix.data / norms[matrix.indices], matrix.indices,
+                       matrix.indptr), shape=matrix.shape)
+
+
+def _exp_scan(scores, alphas):
+    """
+    Returns exp(alpha * scores) for each alpha.  Evenly spaced alphas, as
+    in a scan, are made by repeated products rather than exponentials.
+
+    :param scores: numpy.array of shape [n_scores]
+    :param alphas: numpy.array of shape [n_alphas]
+    :return: numpy.array of shape [n_scores, n_alphas]
+    """
+    steps = np.diff(alphas)
+    if len(alphas) < 3 or not np.allclose(steps, steps[0], rtol=1e-9, atol=0):
+        return np.exp(scores[:, None] * alphas)
+    weights = np.empty((len(scores), len(alphas)))
+    np.exp(alphas[0] * scores, out=weights[:, 0])
+    step = np.exp(steps[0] * scores)
+    for index in range(1, len(alphas)):
+        np.multiply(weights[:, index - 1], step, out=weights[:, index])
+    return weights
+
+
+def _get_track_limits(cydet, sig_rho_max, trgt_rho):
+    """
+    Returns the radii of the inner and outer layers of track centers, so
+    that the signal tracks pass through the target and the CyDet volume.
+    Specifically, the track's outer most hits may lie in the first or last
+    layer.
+
+    :return: tuple of r_min and r_max of TrackCenters
+    """
+    r_max = cydet.r_by_layer[-1] - sig_rho_max
+    r_min = max(sig_rho_max - trgt_rho, cydet.r_by_layer[0] - sig_rho_max)
+    return r_min, r_max
+
+
+def _get_wire_track_pairs(cydet, track, sig_rho_min, sig_rho_max):
+    """
+    Returns the pairs of wire and track center within a window of distances.
+    Candidate pairs are found by a ball query of radius sig_rho_max between
+    the KD-trees of the wires and of the track centers, so that memory
+    scales with the number of pairs kept rather than with all the pairs.
+
+    :return: tuple of numpy.arrays of the wire_ids, track_ids and distances
+             of the pairs, ordered by wire then track center
+    """
+    # Pad the search radius so that rounding in the trees does not lose
+    # track centers on the edge of the window
+    radius = sig_rho_max * (1. + 1e-9)
+    pairs = cydet.point_dists.tree.sparse_distance_matrix(
+        track.point_dists.tree, radius, output_type='ndarray')
+    rows, cols = pairs['i'], pairs['j']
+    # Calculate how far the wires are from the signal track centered at
+    # each candidate track center, and keep those within tolerance
+    d_x = cydet.point_x[rows] - track.point_x[cols]
+    d_y = cydet.point_y[rows] - track.point_y[cols]
+    dists = np.sqrt(d_x * d_x + d_y * d_y)
+    keep = np.where((dists <= sig_rho_max) & (dists >= sig_rho_min))[0]
+    keep = keep[np.argsort(rows[keep] * track.n_points + cols[keep])]
+    return rows[keep], cols[keep], dists[keep]
+
+
+def _get_event_matrix(hit_weights):
+    """
+    Returns the hit weights of a batch of events as a sparse matrix
+
+    :param hit_weights: scipy.sparse matrix or numpy.array of shape
+                        [n_events, n_wires]
+    :return: scipy.sparse.csr_matrix
+    """
+    if not issparse(hit_weights):
+        hit_weights = csr_matrix(np.atleast_2d(hit_weights))
+    return hit_weights.tocsr()
+
+
 class Hough(object):
     # pylint: disable=too-many-instance-attributes
     # pylint: disable=bad-continuation
     # pylint: disable=no-name-in-module
     def __init__(self, hit_data, sig_rho=33.6, sig_rho_max=35.,
-                 sig_rho_min=24, sig_rho_sgma=3., trgt_rho=20., rho_bins=20):
+                 sig_rho_min=24, sig_rho_sgma=3., trgt_rho=20., rho_bins=20,
+                 arc_res=0, cache=None, track=None, pairs=None):
         """
         This class represents a Hough transform method. It initiates from a data
         file, and over lays a track center geometry on this.  It also defines a
@@ -46,6 +168,19 @@ class Hough(object):
         :param trgt_rho: radius of target.  Note: may be non-phyiscal, it
                          represents the constraint that the track started near
                          the origin.
+        :param rho_bins: number of radial layers of track centers
+        :param arc_res: arc length between track centers along the layers, see
+                        TrackCenters
+        :param cache: optional cache.DiskCache, from which the track center
+                      geometry and the correspondence are loaded if they were
+                      built before, and in which they are stored otherwise
+        :param track: optional TrackCenters built for the same sig_rho_max,
+                      trgt_rho, rho_bins and arc_res, see HoughScan
+        :param pairs: optional tuple of the wire_ids, track_ids and distances
+                      of the pairs of wire and track center of track, ordered
+                      by wire then track center, covering the window of
+                      sig_rho_min and sig_rho_max, from which the
+                      correspondence is made, see HoughScan
         """
 
         self.hit_data = hit_data
@@ -56,63 +191,100 @@ class Hough(object):
         self.trgt_rho = trgt_rho
 
         # Set the geometry of the TrackCenters to cover regions where the signal
-        # track passes through the target and the CyDet volume.  Specifically,
-        # enforce that the track's outer most hits may lie in the first or last
-        # layer.
-        r_max = self.hit_data.cydet.r_by_layer[-1] - self.sig_rho_max
-        r_min = max(self.sig_rho_max - self.trgt_rho,
-                    self.hit_data.cydet.r_by_layer[0] - self.sig_rho_max)
-        self.track = TrackCenters(rho_bins=rho_bins, r_min=r_min, r_max=r_max)
+        # track passes through the target and the CyDet volume.
+        if track is None:
+            r_min, r_max = _get_track_limits(self.hit_data.cydet,
+                                             self.sig_rho_max, self.trgt_rho)
+            track = TrackCenters(rho_bins=rho_bins, r_min=r_min, r_max=r_max,
+                                 arc_res=arc_res, cache=cache)
+        self.track = track
+
+        if pairs is not None:
+            self.correspondence = self._get_correspondence(*pairs)
+        elif cache is None:
+            self.correspondence = self._prepare_wire_track_correspondence()
+        else:
+            self.correspondence = unpack_sparse(
+                cache.fetch(self._get_cache_key(), self._get_cached_arrays),
+                'correspondence')
+        # Normalized correspondences, by norm, see get_track_scores
+        self._normalized = {}
+        # Neighbours of the track centers, see get_top_tracks
+        self._neighbour_table = None
+        # Inverse transforms of the layers of each parity, see _get_blocks
+        self._parity_blocks = None
+
+    def _get_cache_key(self):
+        """
+        Returns the key of the correspondence in the cache, made from the
+        geometries and the signal track parameters
 
-        self.track_wire_dists = self._prepare_track_distances()
-        self.correspondence = self._prepare_wire_track_correspondence()
+        :return: hexadecimal string
+        """
+        geometries = [[geom.n_by_layer, geom.r_by_layer, geom.phi0_by_layer]
+                      for geom in [self.hit_data.cydet, self.track]]
+        return hash_key("Hough", geometries, self.sig_rho, self.sig_rho_max,
+                        self.sig_rho_min, self.sig_rho_sgma,
+                        code_version(Hough, TrackCenters))
 
-    def _prepare_track_distances(self):
+    def _get_cached_arrays(self):
         """
-        Returns a numpy array of distances between tracks and wires
+        Builds the correspondence and returns the arrays to be cached
 
-        :return: numpy array of shape [n_wires,n_tracks]
+        :return: dict of numpy.arrays
         """
-        wire_xy = np.column_stack((self.hit_data.cydet.point_x,
-                                   self.hit_data.cydet.point_y))
-        trck_xy = np.column_stack((self.track.point_x, self.track.point_y))
-        distances = cdist(wire_xy, trck_xy)
-        return distances
+        return pack_sparse('correspondence',
+                           self._prepare_wire_track_correspondence())
 
     def dist_prob(self, distance):
         """
         Defines the probability distribution used for correspondence matrix
 
+        :param distance: distance, or numpy.array of distances, between wire
+                         and track center
         :return: Gaussian of distance
         """
-        distance -= self.sig_rho
+        distance = np.asarray(distance, dtype=float) - self.sig_rho
         # Lower radii return a fitted gaussian function
-        if distance < 0:
-            return math.exp(-(distance**2)/(2.*(self.sig_rho_sgma**2))) + 0.05
+        lower = np.exp(-(distance**2)/(2.*(self.sig_rho_sgma**2))) + 0.05
         # Higher radii retun a linear decrease to just over the max value
-        if distance >= 0:
-            return 1.05 - distance/(self.sig_rho_max - self.sig_rho + 0.1)
+        higher = 1.05 - distance/(self.sig_rho_max - self.sig_rho + 0.1)
+        return np.where(distance < 0, lower, higher)[()]
 
     def _prepare_wire_track_correspondence(self):
         """
         Defines the probability that a given wire belongs to a track centered at
-        a given track center bin
-
-        :returns: scipy.sparse matrix of shape [n_wires, n_track_bin]
-        """
-        corsp = lil_matrix((self.hit_data.cydet.n_points, self.track.n_points))
-        # Loop over all track centers
-        for trck in range(self.track.n_points):
-            # Loop over all wires in CyDet
-            for wire in range(self.hit_data.cydet.n_points):
-                # Calculate how far the wire is from the signal track centered
-                # at the current track center
-                this_dist = self.track_wire_dists[wire, trck]
-                # If its within tolerance, return a probability
-                if (this_dist <= self.sig_rho_max) and  \
-                   (this_dist >= self.sig_rho_min):
-                    corsp[wire, trck] = self.dist_prob(this_dist)
-        return corsp
+        a given track center bin.  Candidate pairs of wire and track center are
+        found by a ball query of radius sig_rho_max between the KD-trees of
+        the wires and of the track centers, so that memory scales with the
+        number of non-zero values rather than with the number of pairs.
+
+        :returns: scipy.sparse.csr_matrix of shape [n_wires, n_track_bin]
+        """
+        return self._get_correspondence(*_get_wire_track_pairs(
+            self.hit_data.cydet, self.track, self.sig_rho_min,
+            self.sig_rho_max))
+
+    def _get_correspondence(self, rows, cols, dists):
+        """
+        Returns the correspondence of the pairs of wire and track center
+        within sig_rho_min and sig_rho_max of each other
+
+        :param rows: numpy.array of the wire_ids of the pairs, in increasing
+                     order
+        :param cols: numpy.array of the track_ids of the pairs, in increasing
+                     order for each wire
+        :param dists: numpy.array of the distances of the pairs
+        :returns: scipy.sparse.csr_matrix of shape [n_wires, n_track_bin]
+        """
+        cydet = self.hit_data.cydet
+        keep = (dists <= self.sig_rho_max) & (dists >= self.sig_rho_min)
+        if not np.all(keep):
+            rows, cols, dists = rows[keep], cols[keep], dists[keep]
+        indptr = np.zeros(cydet.n_points + 1, dtype=int)
+        np.cumsum(np.bincount(rows, minlength=cydet.n_points), out=indptr[1:])
+        return csr_matrix((self.dist_prob(dists), cols, indptr),
+                          shape=(cydet.n_points, self.track.n_points))
 
     def get_track_correspondence(self, track_id, values=False):
         """
@@ -148,3 +320,528 @@ class Hough(object):
             return corr_track, corr_value
         else:
             return corr_track
+
+    def get_normalized_correspondence(self, norm="l2"):
+        """
+        Returns the correspondence with the values of each track center
+        normalized, as normalize(correspondence.T, norm).T of
+        sklearn.preprocessing would, which is built once for each norm
+
+        :param norm: "l1", "l2" or "max", or None for the correspondence
+        :return: scipy.sparse.csr_matrix of shape [n_wires, n_track_bin]
+        """
+        if norm is None:
+            return self.correspondence
+        if norm not in self._normalized:
+            self._normalized[norm] = _normalize_columns(self.correspondence,
+                                                        norm)
+        return self._normalized[norm]
+
+    def get_even_odd_correspondence(self, norm="l1"):
+        """
+        Returns the correspondences of the wires of the even layers and of the
+        odd layers, stacked along the track centers, with the values of each
+        track center of each parity normalized.  This is the
+        normalize(hough_even_forward, norm) and
+        normalize(hough_odd_forward, norm) of LocalBasedFiltering.ipynb in one
+        matrix, which is built once for each norm.  As each wire lies in one
+        layer, the matrix has the same entries as the correspondence.
+
+        :param norm: "l1", "l2" or "max", or None for the correspondence
+        :return: scipy.sparse.csr_matrix of shape [n_wires, 2 * n_track_bin],
+                 whose first n_track_bin columns are the track centers of the
+                 even layers, and the others those of the odd layers
+        """
+        key = ("even_odd", norm)
+        if key not in self._normalized:
+            if norm is None:
+                corsp = self.correspondence
+                n_wires, n_tracks = corsp.shape
+                odd = self.hit_data.cydet.point_pol == 1
+                wire_ids = np.repeat(np.arange(n_wires), np.diff(corsp.indptr))
+                self._normalized[key] = csr_matrix(
+                    (corsp.data, corsp.indices + n_tracks * odd[wire_ids],
+                     corsp.indptr), shape=(n_wires, 2 * n_tracks))
+            else:
+                self._normalized[key] = _normalize_columns(
+                    self.get_even_odd_correspondence(None), norm)
+        return self._normalized[key]
+
+    def get_track_scores(self, hit_weights, norm="l2", chunk_size=None):
+        """
+        Returns the Hough transform of the hit weights of a batch of events,
+        i.e. the score of each track center in each event.  This is the
+        normalize(correspondence.T, norm).dot(hit_weights.T).T of the
+        notebooks, made as one sparse product of the events with the
+        normalized correspondence.
+
+        :param hit_weights: scipy.sparse matrix of shape [n_events, n_wires]
+                            of the weight of each hit, e.g.
+                            HitMatrix.get_csr("hit_vector"), or the
+                            equivalent numpy.array
+        :param norm: normalization of the track centers, see
+                     get_normalized_correspondence
+        :param chunk_size: if set, events are transformed chunk_size at a
+                           time, which bounds the memory of the sparse
+                           products
+        :return: numpy.array of shape [n_events, n_track_bin]
+        """
+        corsp = self.get_normalized_correspondence(norm)
+        hit_weights = _get_event_matrix(hit_weights)
+        n_events = hit_weights.shape[0]
+        if chunk_size is None:
+            chunk_size = max(n_events, 1)
+        # Products are added into the rows of the chunk, starting from zero
+        scores = np.zeros((n_events, corsp.shape[1]))
+        for start in range(0, n_events, chunk_size):
+            stop = min(start + chunk_size, n_events)
+            hit_weights[start:stop].dot(corsp).toarray(out=scores[start:stop])
+        return scores
+
+    def get_even_odd_predictions(self, hit_weights, alpha=2., norm="l1",
+                                 chunk_size=None, scores=None):
+        """
+        Returns the prepare_hough of LocalBasedFiltering.ipynb: the Hough
+        transforms of the hit weights of the even and of the odd layers,
+        reweighted by exp(alpha * score), and transformed back onto the wires
+        of their layers.  Both parities go through one forward and one
+        inverse product with get_even_odd_correspondence, chunk_size events
+        at a time, written into the outputs.
+
+        :param hit_weights: scipy.sparse matrix of shape [n_events, n_wires]
+                            of the weight of each hit, e.g. the signal
+                            probabilities of the classifier, or the
+                            equivalent numpy.array
+        :param alpha: scaling of the exponent of the reweighting
+        :param norm: normalization of the track centers of the forward
+                     transform, see get_even_odd_correspondence
+        :param chunk_size: if set, events are transformed chunk_size at a
+                           time, which bounds the memory of the temporaries
+        :param scores: forward scores from get_even_odd_scores, which are
+                       reweighted in place, computed from hit_weights if not
+                       given
+        :return: tuple of
+         - numpy.array of shape [n_events, n_wires] of the inverse transform
+           of the even layers, zero on the odd layers
+         - numpy.array of shape [n_events, n_wires] of the inverse transform
+           of the odd layers, zero on the even layers
+         - numpy.array of shape [n_events, n_track_bin] of the reweighted
+           scores of the odd layers
+         - numpy.array of shape [n_events, n_track_bin] of the reweighted
+           scores of the even layers
+          in the order of the notebook
+        """
+        hit_weights = _get_event_matrix(hit_weights)
+        forward = self.get_even_odd_correspondence(norm)
+        n_events, n_wires = hit_weights.shape
+        n_tracks = self.correspondence.shape[1]
+        if chunk_size is None:
+            chunk_size = max(n_events, 1)
+        weights = scores
+        if weights is None:
+            weights = np.zeros((n_events, 2 * n_tracks))
+        even_preds = np.empty((n_events, n_wires))
+        odd_preds = np.empty((n_events, n_wires))
+        for start in range(0, n_events, chunk_size):
+            chunk = slice(start, min(start + chunk_size, n_events))
+            if scores is None:
+                hit_weights[chunk].dot(forward).toarray(out=weights[chunk])
+            np.multiply(weights[chunk], alpha, out=weights[chunk])
+            np.exp(weights[chunk], out=weights[chunk])
+            self._invert_even_odd(weights[chunk], even_preds[chunk],
+                                  odd_preds[chunk])
+        return (even_preds, odd_preds, weights[:, n_tracks:],
+                weights[:, :n_tracks])
+
+    def get_even_odd_scores(self, hit_weights, norm="l1", chunk_size=None):
+        """
+        Returns the forward Hough transforms of the hit weights of the even
+        and of the odd layers, before reweighting, see
+        get_even_odd_predictions
+
+        :return: numpy.array of shape [n_events, 2 * n_track_bin], whose first
+                 n_track_bin columns are the scores of the even layers
+        """
+        hit_weights = _get_event_matrix(hit_weights)
+        forward = self.get_even_odd_correspondence(norm)
+        n_events = hit_weights.shape[0]
+        if chunk_size is None:
+            chunk_size = max(n_events, 1)
+        scores = np.zeros((n_events, forward.shape[1]))
+        for start in range(0, n_events, chunk_size):
+            chunk = slice(start, min(start + chunk_size, n_events))
+            hit_weights[chunk].dot(forward).toarray(out=scores[chunk])
+        return scores
+
+    def scan_alphas(self, hit_weights, labels, alphas, sample_weight=None,
+                    norm="l1", scores=None, chunk_size=100):
+        """
+        Returns the area under the ROC curve of the hits for each alpha of a
+        scan, as in LocalBasedFiltering.ipynb: the hits score
+        even_pred / max(even_pred) + odd_pred / max(odd_pred) of
+        get_even_odd_predictions, the maxima being taken over all wires of
+        all events.
+
+        The forward transform is computed once for all alphas.  The inverse
+        transform is only computed on the hits, for all alphas in one sparse
+        product per chunk of events, and the maxima are only computed on the
+        events that can hold them, see _get_inverse_maxima.
+
+        :param hit_weights: scipy.sparse matrix of shape [n_events, n_wires],
+                            whose entries are the hits, e.g.
+                            HitMatrix.get_csr("signal_prob")
+        :param labels: numpy.array of the label of each entry of hit_weights,
+                       in the order of its csr form, 1 for signal and 0 for
+                       background, e.g. HitMatrix.get_column("labels")
+        :param alphas: scaling of the exponent of the reweighting, see
+                       get_even_odd_predictions
+        :param sample_weight: optional numpy.array of the weight of each hit
+        :param norm: normalization of the forward transform
+        :param scores: forward scores from get_even_odd_scores, computed from
+                       hit_weights if not given
+        :param chunk_size: number of events per product, which bounds the
+                           memory of the reweighted scores to
+                           chunk_size * 2 * n_track_bin * n_alphas
+        :return: numpy.array of shape [n_alphas] of the areas
+        """
+        hit_weights = _get_event_matrix(hit_weights)
+        if scores is None:
+            scores = self.get_even_odd_scores(hit_weights, norm)
+        alphas = np.atleast_1d(np.asarray(alphas, dtype=float))
+        inverse = self.get_even_odd_correspondence(None)
+        n_columns = inverse.shape[1]
+        n_events = hit_weights.shape[0]
+        preds = np.empty((hit_weights.nnz, len(alphas)))
+        for start in range(0, n_events, chunk_size):
+            stop = min(start + chunk_size, n_events)
+            hits = slice(hit_weights.indptr[start], hit_weights.indptr[stop])
+            # Rows of the inverse transform of the hit wires of the chunk,
+            # whose columns are shifted to the track centers of their event
+            wires = hit_weights.indices[hits]
+            events = np.repeat(np.arange(stop - start),
+                               np.diff(hit_weights.indptr[start:stop + 1]))
+            starts = inverse.indptr[wires]
+            counts = inverse.indptr[wires + 1] - starts
+            entries = get_hit_ids(starts, counts)
+            indptr = np.zeros(len(wires) + 1, dtype=int)
+            np.cumsum(counts, out=indptr[1:])
+            selector = csr_matrix(
+                (inverse.data[entries], inverse.indices[entries] +
+                 n_columns * np.repeat(events, counts), indptr),
+                shape=(len(wires), (stop - start) * n_columns))
+            preds[hits] = selector.dot(
+                _exp_scan(scores[start:stop].ravel(), alphas))
+        odd = self.hit_data.cydet.point_pol == 1
+        maxima = self._get_inverse_maxima(scores, alphas, chunk_size)
+        preds /= maxima[odd[hit_weights.indices].astype(int)]
+        return np.array([roc_auc(labels, preds[:, index], sample_weight)
+                         for index in range(len(alphas))])
+
+    def _get_inverse_maxima(self, scores, alphas, chunk_size=100,
+                            group_size=8):
+        """
+        Returns the maxima over all events and wires of the inverse
+        transforms of the reweighted scores of the even and of the odd layers.
+
+        The maxima of each event are computed for the smallest alpha, alpha_0.
+        For larger alphas, the prediction of a wire is at most its prediction
+        for alpha_0 times exp((alpha - alpha_0) * score) of the best track
+        center of the event, so only the events whose bound exceeds the
+        maxima found so far are computed, from the highest bound down.
+
+        :param scores: numpy.array of shape [n_events, 2 * n_track_bin], see
+                       get_even_odd_scores
+        :param alphas: numpy.array of shape [n_alphas]
+        :param chunk_size: number of events per product for alpha_0
+        :param group_size: number of events computed at once for the other
+                           alphas
+        :return: numpy.array of shape [2, n_alphas] of the maxima of the even
+                 and of the odd layers, one where the transform is zero
+        """
+        inverse = self.get_even_odd_correspondence(None)
+        odd = self.hit_data.cydet.point_pol == 1
+        n_events = scores.shape[0]
+        alpha_0 = alphas.min()
+        # Maxima of each event and parity for alpha_0
+        event_maxima = np.zeros((2, n_events))
+        for start in range(0, n_events, chunk_size):
+            chunk = slice(start, min(start + chunk_size, n_events))
+            preds = inverse.dot(np.exp(alpha_0 * scores[chunk].T))
+            for parity in [0, 1]:
+                if np.any(odd == parity):
+                    event_maxima[parity, chunk] = \
+                        preds[odd == parity].max(axis=0)
+        maxima = np.zeros((2, len(alphas)))
+        for parity, (_, tracks, block_inverse) in enumerate(
+                self._get_parity_blocks()):
+            block = scores[:, tracks]
+            bounds = event_maxima[parity][:, None] * np.exp(
+                (alphas - alpha_0) * block.max(axis=1)[:, None])
+            # The bound is exact for alpha_0
+            maxima[parity] = np.where(alphas == alpha_0,
+                                      event_maxima[parity].max(), 0.)
+            pending = np.ones(n_events, dtype=bool)
+            while True:
+                pending &= np.any(bounds > maxima[parity], axis=1)
+                candidates = np.where(pending)[0]
+                if not len(candidates):
+                    break
+                group = candidates[np.argsort(
+                    -bounds[candidates].max(axis=1))][:group_size]
+                for row in group:
+                    preds = block_inverse.dot(_exp_scan(block[row], alphas))
+                    maxima[parity] = np.maximum(maxima[parity],
+                                                preds.max(axis=0))
+                pending[group] = False
+        maxima[maxima == 0] = 1.
+        return maxima
+
+    def _get_parity_blocks(self):
+        """
+        Returns the blocks of the inverse transform of the layers of each
+        parity, i.e. the rows of get_even_odd_correspondence(None) of the
+        wires of the parity and its columns of the track centers of the
+        parity, which are built once
+
+        :return: list of the tuples of the wire_ids, the slice of the track
+                 center columns and the scipy.sparse.csr_matrix of shape
+                 [n_wires_of_parity, n_track_bin] of the even and of the odd
+                 layers
+        """
+        if self._parity_blocks is None:
+            inverse = self.get_even_odd_correspondence(None)
+            odd = self.hit_data.cydet.point_pol == 1
+            n_tracks = inverse.shape[1] // 2
+            self._parity_blocks = []
+            for parity in [0, 1]:
+                wire_ids = np.where(odd == parity)[0]
+                tracks = slice(parity * n_tracks, (parity + 1) * n_tracks)
+                self._parity_blocks.append(
+                    (wire_ids, tracks, inverse[wire_ids][:, tracks]))
+        return self._parity_blocks
+
+    def _invert_even_odd(self, weights, even_out, odd_out):
+        """
+        Writes the inverse Hough transforms of the reweighted scores of the
+        even and of the odd layers onto the wires of their layers, and zero
+        onto the other wires.  Each parity is transformed with its own block,
+        so the only temporary is its transform on the wires of its layers.
+
+        :param weights: numpy.array of shape [n_events, 2 * n_track_bin], see
+                        get_even_odd_correspondence
+        :param even_out: numpy.array of shape [n_events, n_wires]
+        :param odd_out: numpy.array of shape [n_events, n_wires]
+        """
+        for out, (wire_ids, tracks, block) in zip(
+                [even_out, odd_out], self._get_parity_blocks()):
+            out.fill(0.)
+            out[:, wire_ids] = block.dot(weights[:, tracks].T).T
+
+    def get_top_tracks(self, scores, k=1, suppress=True, min_score=0.,
+                       block_size=32):
+        """
+        Returns the k best track centers of each event of a batch, as found by
+        get_track_scores.  With suppress, only local maxima are returned,
+        i.e. track centers scoring higher than all their neighbours in
+        TrackCenters.point_neighbours (ties going to the lower track_id), so
+        that one track gives one candidate.
+
+        The track centers are cut into blocks of block_size, and the
+        candidates are first looked for in the blocks of highest maximum of
+        each event.  Events whose k-th candidate may lie in another block are
+        searched again with more blocks, so that the result is that of
+        searching all the track centers.
+
+        :param scores: numpy.array of shape [n_events, n_track_bin]
+        :param k: number of track centers per event
+        :param suppress: if true, only return local maxima
+        :param min_score: only track centers scoring more are returned
+        :param block_size: number of track centers per block
+        :return: tuple of
+         - numpy.array of shape [n_events, k] of track_ids, best first, -1
+           when an event has fewer than k candidates
+         - numpy.array of shape [n_events, k] of their scores, zero when
+           missing
+        """
+        scores = np.atleast_2d(scores)
+        n_events, n_tracks = scores.shape
+        if suppress and self._neighbour_table is None:
+            self._neighbour_table = _get_neighbour_table(
+                self.track.point_neighbours)
+        # Find the maximum of each block, the last one may be shorter
+        n_full = n_tracks - n_tracks % block_size
+        block_max = scores[:, :n_full].reshape(n_events, -1,
+                                               block_size).max(axis=2)
+        if n_full < n_tracks:
+            block_max = np.column_stack([block_max,
+                                         scores[:, n_full:].max(axis=1)])
+        track_ids = np.full((n_events, k), -1, dtype=int)
+        top_scores = np.zeros((n_events, k))
+        pending = np.arange(n_events)
+        n_searched = min(2 * k, block_max.shape[1])
+        n_kept = 4 * k
+        while len(pending):
+            sure = self._search_blocks(scores, block_max, pending, n_searched,
+                                       n_kept, block_size, suppress,
+                                       min_score, track_ids, top_scores)
+            pending = pending[~sure]
+            n_searched = min(2 * n_searched, block_max.shape[1])
+            n_kept *= 2
+        return track_ids, top_scores
+
+    def _search_blocks(self, scores, block_max, pending, n_searched, n_kept,
+                       block_size, suppress, min_score, track_ids,
+                       top_scores):
+        """
+        Finds the best candidates within the n_searched blocks of highest
+        maximum of each pending event, see get_top_tracks, and writes them
+        into the rows of track_ids and top_scores.  Only the n_kept track
+        centers of highest score that are not beaten by their neighbours in
+        the block are checked against all their neighbours.
+
+        :param pending: numpy.array of the events to search
+        :return: numpy.array of bool of whether the candidates of each event
+                 are those of searching all the blocks
+        """
+        # pylint: disable=too-many-locals
+        n_tracks = scores.shape[1]
+        k = track_ids.shape[1]
+        block_max = block_max[pending]
+        n_events, n_blocks = block_max.shape
+        rows = np.arange(n_events)[:, None]
+        if n_searched < n_blocks:
+            blocks = np.argpartition(-block_max, n_searched - 1,
+                                     axis=1)[:, :n_searched]
+            # Track centers of the other blocks score at most this
+            outside = block_max[rows, blocks].min(axis=1)
+        else:
+            blocks = np.repeat(np.arange(n_blocks)[None, :], n_events, axis=0)
+            outside = np.full(n_events, -np.inf)
+        ids = blocks[:, :, None] * block_size + np.arange(block_size)
+        in_range = ids < n_tracks
+        ids = np.minimum(ids, n_tracks - 1)
+        values = scores[pending[:, None, None], ids]
+        valid = in_range & (values > min_score)
+        if suppress:
+            # Most track centers are beaten by the next or previous one in
+            # their layer, which are next to them in their block
+            table = self._neighbour_table
+            points = np.arange(n_tracks)
+            has_next = (table == (points + 1)[:, None]).any(axis=1)
+            has_prev = (table == (points - 1)[:, None]).any(axis=1)
+            valid[:, :, :-1] &= ~(has_next[ids[:, :, :-1]] &
+                                  (values[:, :, 1:] > values[:, :, :-1]))
+            valid[:, :, 1:] &= ~(has_prev[ids[:, :, 1:]] &
+                                 (values[:, :, :-1] >= values[:, :, 1:]))
+        ids = ids.reshape(n_events, -1)
+        values = np.where(valid, values, -np.inf).reshape(n_events, -1)
+        if n_kept < values.shape[1]:
+            kept = np.argpartition(-values, n_kept - 1, axis=1)[:, :n_kept]
+            ids, values = ids[rows, kept], values[rows, kept]
+            # Track centers that were not kept score at most this
+            outside = np.maximum(outside, values.min(axis=1))
+        if suppress:
+            neighbours = self._neighbour_table[ids]
+            neigh_values = scores[pending[:, None, None], neighbours]
+            beaten = (neigh_values > values[:, :, None]) | \
+                ((neigh_values == values[:, :, None]) &
+                 (neighbours < ids[:, :, None]))
+            values[beaten.any(axis=2)] = -np.inf
+        # Rank the candidates by decreasing score, then increasing track_id
+        order = np.lexsort((ids, -values), axis=1)[:, :k]
+        found_ids, found_scores = ids[rows, order], values[rows, order]
+        found = np.isfinite(found_scores)
+        n_found = found.shape[1]
+        # The k-th candidate must beat all track centers of the other blocks,
+        # unless none of them can be a candidate
+        sure = outside <= min_score
+        if n_found == k:
+            sure |= found_scores[:, -1] > outside
+        done = pending[sure]
+        track_ids[done, :n_found] = np.where(found, found_ids, -1)[sure]
+        top_scores[done, :n_found] = np.where(found, found_scores, 0.)[sure]
+        return sure
+
+
+class HoughScan(object):
+    def __init__(self, hit_data, trgt_rho=20., rho_bins=20, arc_res=0,
+                 cache=None):
+        """
+        Builds the Hough transforms of many settings of the signal track
+        parameters sig_rho, sig_rho_min, sig_rho_max and sig_rho_sgma, for
+        parameter scans.
+
+        The track center geometry only depends on sig_rho_max, so the
+        settings are grouped by it.  The pairs of wire and track center are
+        found once for the widest window of each group, and the
+        correspondence of each setting is then cut from them and reweighted
+        by its dist_prob, rather than built from nothing.
+
+        :param hit_data: data of the hits, as for Hough
+        :param trgt_rho: radius of target, see Hough
+        :param rho_bins: number of radial layers of track centers
+        :param arc_res: arc length between track centers along the layers
+        :param cache: optional cache.DiskCache of the track center geometries
+        """
+        self.hit_data = hit_data
+        self.trgt_rho = trgt_rho
+        self.rho_bins = rho_bins
+        self.arc_res = arc_res
+        self.cache = cache
+        # Track centers and pairs of the last geometry, see _get_pairs
+        self._pairs = None
+
+    def _get_pairs(self, sig_rho_max, sig_rho_min):
+        """
+        Returns the track centers of sig_rho_max, and their pairs with the
+        wires within sig_rho_min and sig_rho_max.  The pairs of the last
+        geometry are kept, and reused while they cover the window.
+
+        :return: tuple of TrackCenters and tuple of numpy.arrays of the
+                 wire_ids, track_ids and distances of the pairs
+        """
+        if self._pairs is None or self._pairs[0] != sig_rho_max or \
+                self._pairs[1] > sig_rho_min:
+            cydet = self.hit_data.cydet
+            r_min, r_max = _get_track_limits(cydet, sig_rho_max,
+                                             self.trgt_rho)
+            track = TrackCenters(rho_bins=self.rho_bins, r_min=r_min,
+                                 r_max=r_max, arc_res=self.arc_res,
+                                 cache=self.cache)
+            pairs = _get_wire_track_pairs(cydet, track, sig_rho_min,
+                                          sig_rho_max)
+            self._pairs = (sig_rho_max, sig_rho_min, track, pairs)
+        return self._pairs[2:]
+
+    def get_hough(self, sig_rho=33.6, sig_rho_max=35., sig_rho_min=24,
+                  sig_rho_sgma=3.):
+        """
+        Returns the Hough transform of one setting, see Hough
+
+        :return: Hough
+        """
+        track, pairs = self._get_pairs(sig_rho_max, sig_rho_min)
+        return Hough(self.hit_data, sig_rho=sig_rho, sig_rho_max=sig_rho_max,
+                     sig_rho_min=sig_rho_min, sig_rho_sgma=sig_rho_sgma,
+                     trgt_rho=self.trgt_rho, rho_bins=self.rho_bins,
+                     arc_res=self.arc_res, track=track, pairs=pairs)
+
+    def iter_houghs(self, settings):
+        """
+        Returns the Hough transforms of many settings, grouped by track center
+        geometry, so that the pairs of each geometry are only found once
+
+        :param settings: list of dicts with the sig_rho, sig_rho_max,
+                         sig_rho_min and sig_rho_sgma of each setting
+        :return: generator of tuples of the position of the setting in
+                 settings and its Hough
+        """
+        groups = OrderedDict()
+        for index, setting in enumerate(settings):
+            groups.setdefault(setting["sig_rho_max"], []).append(index)
+        for sig_rho_max, indices in groups.items():
+            # Find the pairs of the widest window of the group first
+            self._get_pairs(sig_rho_max, min(settings[index]["sig_rho_min"]
+                                             for index in indices))
+            for index in indices:
+                yield index, self.get_hough(**settings[index])